@@ -1,21 +1,49 @@
-import socket
-import threading
-import json
+import os
+import queue
 import tkinter as tk
+from collections import deque
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 from datetime import datetime
+from client_cache import HistoryCache, default_path
+from client_core import ClientCore, group_message, private_message
+from logger import get_logger, setup_logging
+
+HISTORY_PAGE_SIZE = 50
+SYNC_PAGE_SIZE = 500   # mensagens por página ao sincronizar o cache na reconexão
+RENDER_WINDOW = 500    # mensagens mantidas no widget de chat
+WINDOW_STEP = 100      # mensagens locais acrescentadas no topo ao rolar para cima
+EVENT_POLL_MS = 20     # intervalo de processamento dos eventos de rede na thread do Tk
+EVENTS_PER_TICK = 200  # eventos processados por ciclo, para não travar a interface
+
+log = get_logger("interface")
 
 class ChatClient:
     def __init__(self):
         self.host = '127.0.0.1'
         self.port = 5050
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Toda a conversa de protocolo fica no ClientCore; esta classe é só a interface
+        self.core = ClientCore(self.host, self.port)
+        self.cache: HistoryCache = None  # aberto após o login (um arquivo por usuário)
         
         self.username = None
         self.current_chat = None
         self.current_chat_type = None
         self.my_groups = []
         self.chat_history = {}
+        self.chat_meta = {}      # {history_key: {'last_id': ..., 'unread': ...}} recebido no login
+        self.history_state = {}  # {history_key: {'oldest': id, 'has_more': bool, 'pending': bool}}
+        self.message_index = {}  # {history_key: {id: posição em chat_history[history_key]}}
+
+        # Estado da conversa exibida
+        self.view_key = None
+        self.rendered = deque()    # (tag, id, pertence à conversa) de cada mensagem no widget, em ordem
+        self.rendered_by_id = {}   # {id: tag} para editar/apagar só a linha da mensagem
+        self.render_start = 0      # posição em chat_history[view_key] da primeira mensagem renderizada
+        self._tag_seq = 0
+        self._extending = False
+
+        # Eventos de rede chegam em outra thread e só são tratados na thread do Tk
+        self.events = queue.Queue()
         
         self.setup_gui()
         
@@ -73,6 +101,7 @@ class ChatClient:
         # Área de mensagens
         self.chat_area = scrolledtext.ScrolledText(right_frame, state='disabled', wrap=tk.WORD, font=("Arial", 12))
         self.chat_area.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.chat_area.configure(yscrollcommand=self.on_chat_scroll)
         
         # Entrada de mensagem
         input_frame = tk.Frame(right_frame)
@@ -106,62 +135,176 @@ class ChatClient:
             return
             
         try:
-            self.client_socket.connect((self.host, self.port))
-            self.client_socket.send(self.username.encode('utf-8'))
-            
-            # Recebe confirmação e histórico inicial
-            response = json.loads(self.client_socket.recv(16384).decode('utf-8'))  # Buffer maior para histórico
-            if response.get('status') == 'success':
-                self.status_label.config(text=f"Conectado como {self.username}")
-                self.process_initial_history(response.get('history', {}))
-                threading.Thread(target=self.receive_messages, daemon=True).start()
-                self.root.mainloop()
-            else:
-                messagebox.showerror("Erro", response.get('message', "Erro desconhecido"))
-                self.root.destroy()
+            response = self.core.connect(self.username)
         except Exception as e:
             messagebox.showerror("Erro", f"Não foi possível conectar: {e}")
             self.root.destroy()
+            return
 
-    def process_initial_history(self, history_data):
-        """Processa o histórico inicial recebido do servidor"""
-        # Histórico individual
-        for key, messages in history_data.get('individual', {}).items():
-            other_user = key[0] if key[0] != self.username else key[1]
-            history_key = f"individual_{other_user}"
-            self.chat_history[history_key] = messages
-        
-        # Histórico de grupos
-        for group, messages in history_data.get('group', {}).items():
-            history_key = f"group_{group}"
-            self.chat_history[history_key] = messages
-
-    def receive_messages(self):
-        """Recebe mensagens do servidor"""
-        while True:
+        self.status_label.config(text=f"Conectado como {self.username}")
+        self.cache = HistoryCache(default_path(self.username, self.host, self.port))
+        self.process_chat_metadata(response.get('chats', {}))
+        self.core.start(self.events.put)
+        self.sync_cached_chats()
+        self.root.after(EVENT_POLL_MS, self.drain_events)
+        self.root.mainloop()
+        self.cache.close()
+
+    def process_chat_metadata(self, chats):
+        """Guarda os metadados das conversas (último id e não lidas); o histórico vem sob demanda"""
+        for chat_type in ('individual', 'group'):
+            for chat, meta in chats.get(chat_type, {}).items():
+                self.chat_meta[f"{chat_type}_{chat}"] = meta
+
+    def sync_cached_chats(self):
+        """
+        Para cada conversa em cache que mudou desde a última sessão (conforme os
+        metadados do connection_ack), pede só as mensagens novas e as edições.
+        """
+        for history_key, (_, last_id, edits) in self.cache.cursors().items():
+            meta = self.chat_meta.get(history_key)
+            if meta is None or (meta.get('last_id') == last_id and meta.get('edits') == edits):
+                continue
+            chat_type, chat = history_key.split('_', 1)
+            self.core.request_history(chat_type, chat, after=last_id, limit=SYNC_PAGE_SIZE, edits_since=edits)
+
+    def request_history(self, chat_type, chat, before=None):
+        """Busca uma página do histórico (as mais recentes ou anteriores a `before`), primeiro no cache local"""
+        history_key = f"{chat_type}_{chat}"
+        state = self.history_state.setdefault(history_key, {'oldest': None, 'has_more': True, 'pending': False})
+        if state['pending'] or not state['has_more']:
+            return
+
+        if before is not None:
+            cached = self.cache.load(history_key, before=before, limit=HISTORY_PAGE_SIZE)
+            if cached:
+                self.merge_page(history_key, cached, has_more=True)
+                return
+
+        state['pending'] = True
+
+        try:
+            self.core.request_history(chat_type, chat, before=before, limit=HISTORY_PAGE_SIZE)
+        except Exception as e:
+            state['pending'] = False
+            log.error("ERRO HISTÓRICO", f"Erro ao pedir histórico: {e}")
+
+    def process_history_page(self, page):
+        """Grava no cache uma página recebida do servidor e a mescla com a conversa"""
+        history_key = f"{page.get('chat_type')}_{page.get('chat')}"
+        if 'after' in page:
+            self.process_sync_page(history_key, page)
+            return
+
+        messages = page.get('messages', [])
+        if messages:
+            # Numa conversa ainda sem cache, a página já reflete todas as edições até agora
+            edits = page.get('edits') if self.cache.cursor(history_key) is None else None
+            self.cache.store(history_key, messages, span=(messages[0]['id'], messages[-1]['id']), edits=edits)
+        self.history_state.setdefault(history_key, {'oldest': None, 'has_more': True, 'pending': False})['pending'] = False
+        self.merge_page(history_key, messages, page.get('has_more', False))
+
+    def process_sync_page(self, history_key, page):
+        """Aplica uma página de sincronização: mensagens depois de `after` e edições desde a última sessão"""
+        if page.get('reset'):
+            # O servidor não tem o que o cache conhece: descarta e recomeça pela página mais recente
+            self.cache.reset(history_key)
+            for state in (self.chat_history, self.message_index, self.history_state):
+                state.pop(history_key, None)
+            if history_key == self.view_key:
+                self.load_chat_history()
+            return
+
+        messages = page.get('messages', [])
+        after = page['after']
+        new_ids = [m['id'] for m in messages if m['id'] > after]
+        self.cache.store(history_key, messages, span=(after + 1, new_ids[-1]) if new_ids else None,
+                         edits=page.get('edits'))
+
+        # Conversas já carregadas nesta sessão recebem as mudanças como mensagens novas
+        if history_key in self.chat_history:
+            for message in messages:
+                self.process_received_message(message, live=False)
+
+        if page.get('has_more') and new_ids:
+            self.core.request_history(page['chat_type'], page['chat'], after=new_ids[-1], limit=SYNC_PAGE_SIZE)
+
+    def merge_page(self, history_key, messages, has_more, render=True):
+        """Mescla uma página (do servidor ou do cache) com as mensagens já conhecidas da conversa"""
+        state = self.history_state.setdefault(history_key, {'oldest': None, 'has_more': True, 'pending': False})
+        first_page = state['oldest'] is None
+        state['has_more'] = has_more
+
+        if messages:
+            oldest = messages[0].get('id')
+            state['oldest'] = oldest if state['oldest'] is None else min(state['oldest'], oldest)
+
+        known = self.chat_history.get(history_key, [])
+        by_id = {m['id']: m for m in messages}
+        by_id.update({m['id']: m for m in known if m.get('id') is not None})
+        local_only = [m for m in known if m.get('id') is None]
+        merged = [by_id[i] for i in sorted(by_id)] + local_only
+        added = len(merged) - len(known)
+        self.chat_history[history_key] = merged
+        self.message_index[history_key] = {m['id']: i for i, m in enumerate(merged) if m.get('id') is not None}
+
+        if render and history_key == self.view_key and added:
+            if first_page:
+                self.load_chat_history()
+            else:
+                # Páginas anteriores só acrescentam mensagens no início da lista
+                self.render_start += added
+                self.extend_window(added)
+
+    def on_chat_scroll(self, first, last):
+        """Atualiza a barra de rolagem e mostra mensagens mais antigas ao chegar no topo"""
+        self.chat_area.vbar.set(first, last)
+        if float(first) > 0.0 or self.view_key is None or self._extending:
+            return
+        if self.render_start > 0:
+            # Ainda há mensagens locais fora da janela renderizada
+            self._extending = True
+            self.root.after_idle(self.extend_window, WINDOW_STEP)
+            return
+        state = self.history_state.get(self.view_key)
+        if state is not None and state['oldest'] is not None:
+            self.request_history(self.current_chat_type, self.current_chat, before=state['oldest'])
+
+    def drain_events(self):
+        """Processa na thread do Tk, em lotes, os eventos recebidos pela thread de rede"""
+        handled = 0
+        while handled < EVENTS_PER_TICK:
             try:
-                data = self.client_socket.recv(4096)
-                if not data:
-                    break
-                    
-                message = json.loads(data.decode('utf-8'))
-                print(f"Cliente recebeu: {message}")
-                
-                if message.get('type') == 'update':
-                    self.update_contact_list(message.get('contacts', []), message.get('groups', []))
-                elif message.get('type') == 'group_invite':
-                    self.handle_group_invite(message)
-                elif message.get('type') in ['text', 'private_message', 'group_message', 'system']:
-                    self.process_received_message(message)
-                    
-            except json.JSONDecodeError:
-                print("Erro ao decodificar mensagem")
-            except Exception as e:
-                print(f"Erro ao receber mensagem: {e}")
-                self.status_label.config(text="Desconectado do servidor")
+                event = self.events.get_nowait()
+            except queue.Empty:
                 break
+            handled += 1
+            try:
+                self.handle_event(event)
+            except Exception as e:
+                log.error("ERRO EVENTO", f"Erro ao processar evento: {e}", exc_info=True, type=event.get('type'))
+        if handled:
+            self.cache.flush()
+        # Se ainda sobrou evento na fila, volta logo; senão espera o próximo ciclo
+        self.root.after(1 if handled == EVENTS_PER_TICK else EVENT_POLL_MS, self.drain_events)
 
-    def process_received_message(self, message):
+    def handle_event(self, message):
+        """Trata um evento recebido do servidor (chamado na thread do Tk por drain_events)"""
+        if message.get('type') == 'update':
+            self.update_contact_list(message.get('contacts', []), message.get('groups', []))
+        elif message.get('type') == 'presence_delta':
+            self.apply_presence_delta(message)
+        elif message.get('type') == 'group_invite':
+            self.handle_group_invite(message)
+        elif message.get('type') == 'history_page':
+            self.process_history_page(message)
+        elif message.get('type') in ['text', 'private_message', 'group_message', 'system']:
+            self.process_received_message(message)
+        elif message.get('type') == 'disconnected':
+            log.warning("DESCONECTADO", f"Erro ao receber mensagem: {message.get('error')}")
+            self.status_label.config(text="Desconectado do servidor")
+
+    def process_received_message(self, message, live=True):
         if message.get('type') == 'group_message':
             history_key = f"group_{message.get('group')}"
         elif message.get('type') == 'private_message':
@@ -170,63 +313,130 @@ class ChatClient:
         else:
             history_key = "system"
 
-        if history_key not in self.chat_history:
-            self.chat_history[history_key] = []
+        history = self.chat_history.setdefault(history_key, [])
+        index = self.message_index.setdefault(history_key, {})
+        message_id = message.get('id')
 
-        if 'id' in message and message.get('type') == 'group_message':
-            for idx, m in enumerate(self.chat_history[history_key]):
-                if m.get('id') == message['id'] and m.get('sender') == message.get('sender'):
-                    self.chat_history[history_key][idx] = message
-                    break
-            else:
-                self.chat_history[history_key].append(message)
-        else:
-            self.chat_history[history_key].append(message)
+        # Edição/remoção: substitui a mensagem e atualiza apenas a linha dela
+        if live and message_id is not None and history_key != "system":
+            self.cache.store(history_key, [message], span=(message_id, message_id))
+
+        if message_id is not None and message_id in index:
+            history[index[message_id]] = message
+            if history_key == self.view_key:
+                self.patch_message(message)
+            return
 
-        current_key = f"{self.current_chat_type}_{self.current_chat}" if self.current_chat else None
+        if message_id is not None:
+            index[message_id] = len(history)
+        history.append(message)
 
-        if message.get('sender') == 'Server' and message.get('type') == 'private_message':
-            self.display_message(message)
+        if live and message.get('sender') == 'Server' and message.get('type') == 'private_message':
+            # Respostas de comandos aparecem na conversa aberta
+            self.append_to_view(message, in_history=history_key == self.view_key)
             return
 
-        if history_key == current_key or message.get('type') == 'system':
-            self.load_chat_history()
+        if history_key == self.view_key or message.get('type') == 'system':
+            self.append_to_view(message, in_history=history_key == self.view_key)
 
-    def display_message(self, message_data):
-        """Exibe uma mensagem no chat"""
-        self.chat_area.config(state='normal')
-        
+    def format_message(self, message_data):
+        """Texto e tags de exibição de uma mensagem"""
         try:
             if message_data.get('type') == 'system':
-                msg = f"SISTEMA: {message_data.get('message', '')}\n"
-                self.chat_area.insert(tk.END, msg, 'system')
-            else:
-                sender = message_data.get('sender', '')
-                msg_content = message_data.get('message', '')
-                if isinstance(msg_content, dict):
-                    msg_content = msg_content.get('message', '')
-                
-                timestamp = message_data.get('timestamp', datetime.now().strftime("%H:%M:%S"))
-                
-                if message_data.get('deleted', False):
-                    msg = f"[{timestamp}] {sender} apagou uma mensagem\n"
-                    self.chat_area.insert(tk.END, msg, 'deleted')
-                else:
-                    is_my_message = sender == self.username
-                    prefix = f"[{timestamp}] {sender}: "
-                    if message_data.get('edited', False):
-                        prefix = f"[{timestamp}] {sender} (editado): "
-                    
-                    msg = prefix + str(msg_content) + "\n"
-                    tags = ('my_message',) if is_my_message else ()
-                    self.chat_area.insert(tk.END, msg, tags)
+                return f"SISTEMA: {message_data.get('message', '')}\n", ('system',)
+
+            sender = message_data.get('sender', '')
+            msg_content = message_data.get('message', '')
+            if isinstance(msg_content, dict):
+                msg_content = msg_content.get('message', '')
+            
+            timestamp = message_data.get('timestamp', datetime.now().strftime("%H:%M:%S"))
+            
+            if message_data.get('deleted', False):
+                return f"[{timestamp}] {sender} apagou uma mensagem\n", ('deleted',)
+
+            is_my_message = sender == self.username
+            prefix = f"[{timestamp}] {sender}: "
+            if message_data.get('edited', False):
+                prefix = f"[{timestamp}] {sender} (editado): "
+            
+            tags = ('my_message',) if is_my_message else ()
+            return prefix + str(msg_content) + "\n", tags
         
         except Exception as e:
-            print(f"Erro ao exibir mensagem: {e}")
-            self.chat_area.insert(tk.END, f"Erro ao processar mensagem\n")
-        
+            log.error("ERRO EXIBIÇÃO", f"Erro ao exibir mensagem: {e}")
+            return "Erro ao processar mensagem\n", ()
+
+    def render_message(self, message_data, index, in_history=True):
+        """
+        Insere uma mensagem no chat com uma tag própria, que acompanha o trecho
+        mesmo quando há inserções antes dele; o mapa id → tag permite alterar
+        só essa linha depois. Retorna a entrada em self.rendered.
+        """
+        text, tags = self.format_message(message_data)
+        self._tag_seq += 1
+        tag = f"msg{self._tag_seq}"
+        self.chat_area.insert(index, text, tags + (tag,))
+        message_id = message_data.get('id') if in_history else None
+        if message_id is not None:
+            self.rendered_by_id[message_id] = tag
+        return (tag, message_id, in_history)
+
+    def append_to_view(self, message, in_history=True):
+        """Acrescenta uma mensagem no fim do chat aberto"""
+        at_bottom = self.chat_area.yview()[1] >= 0.999
+        self.chat_area.config(state='normal')
+        self.rendered.append(self.render_message(message, tk.END, in_history))
+        if at_bottom:
+            self.trim_window()
         self.chat_area.config(state='disabled')
-        self.chat_area.see(tk.END)
+        if at_bottom:
+            self.chat_area.see(tk.END)
+
+    def patch_message(self, message):
+        """Reescreve apenas o trecho de uma mensagem já exibida (edição/remoção)"""
+        tag = self.rendered_by_id.get(message.get('id'))
+        ranges = self.chat_area.tag_ranges(tag) if tag else ()
+        if not ranges:
+            return
+        text, tags = self.format_message(message)
+        self.chat_area.config(state='normal')
+        self.chat_area.delete(ranges[0], ranges[1])
+        self.chat_area.insert(ranges[0], text, tags + (tag,))
+        self.chat_area.config(state='disabled')
+
+    def trim_window(self):
+        """Remove do topo as mensagens que excedem a janela renderizada"""
+        while len(self.rendered) > RENDER_WINDOW:
+            tag, message_id, in_history = self.rendered.popleft()
+            ranges = self.chat_area.tag_ranges(tag)
+            if ranges:
+                self.chat_area.delete(ranges[0], ranges[1])
+            self.chat_area.tag_delete(tag)
+            if message_id is not None and self.rendered_by_id.get(message_id) == tag:
+                del self.rendered_by_id[message_id]
+            if in_history:
+                self.render_start += 1
+
+    def extend_window(self, count):
+        """Renderiza no topo até `count` mensagens anteriores à janela atual"""
+        try:
+            if self.view_key is None or self.render_start <= 0:
+                return
+            history = self.chat_history.get(self.view_key, [])
+            start = max(0, self.render_start - count)
+
+            self._extending = True
+            self.chat_area.config(state='normal')
+            # Mantém na tela a linha que o usuário estava lendo
+            self.chat_area.mark_set('view_anchor', '@0,0')
+            for message in reversed(history[start:self.render_start]):
+                self.rendered.appendleft(self.render_message(message, '1.0'))
+            self.render_start = start
+            self.chat_area.config(state='disabled')
+            self.chat_area.yview('view_anchor')
+        finally:
+            self._extending = False
 
     def handle_group_invite(self, invite_data):
         """Lida com convite para grupo"""
@@ -235,20 +445,17 @@ class ChatClient:
             f"{invite_data['invited_by']} te convidou para o grupo {invite_data['group_name']}.\nDeseja entrar?",
             parent=self.root
         )
-        ans = 'accept_invite' if response else 'reject_invite'
         try:
-            self.client_socket.send(json.dumps({
-                'type': ans,
-                'group_name': invite_data['group_name'],
-                'username': self.username
-            }).encode('utf-8'))
+            if response:
+                self.core.accept_invite(invite_data['group_name'])
+            else:
+                self.core.reject_invite(invite_data['group_name'])
         except Exception as e:
             messagebox.showerror("Erro", f"Falha ao aceitar convite: {e}")
 
     def update_contact_list(self, contacts, groups):
         """Atualiza as listas de contatos e grupos"""
-        print(f"Contatos atualizados: {contacts}")
-        print(f"Grupos atualizados: {groups}")
+        log.debug("ATUALIZAÇÃO", "Contatos e grupos atualizados", contacts=len(contacts), groups=len(groups))
         self.contacts_list.delete(0, tk.END)
         for contact in contacts:
             if contact != self.username:
@@ -259,6 +466,23 @@ class ChatClient:
         for group in groups:
             self.groups_list.insert(tk.END, group)
 
+    def apply_presence_delta(self, delta):
+        """Aplica um delta de presença/grupos às listas sem reconstruí-las"""
+        contacts = self.contacts_list.get(0, tk.END)
+        for contact in delta.get('offline', []):
+            if contact in contacts:
+                self.contacts_list.delete(contacts.index(contact))
+                contacts = self.contacts_list.get(0, tk.END)
+        for contact in delta.get('online', []):
+            if contact != self.username and contact not in contacts:
+                self.contacts_list.insert(tk.END, contact)
+                contacts += (contact,)
+
+        for group, members in delta.get('joined', {}).items():
+            if self.username in members and group not in self.my_groups:
+                self.my_groups.append(group)
+                self.groups_list.insert(tk.END, group)
+
     def send_message(self):
         """Envia uma mensagem"""
         message = self.message_entry.get().strip()
@@ -269,12 +493,7 @@ class ChatClient:
             timestamp = datetime.now().strftime("%H:%M:%S")
 
             if self.current_chat_type == 'group':
-                msg_data = {
-                    'type': 'group_message',
-                    'group': self.current_chat,
-                    'message': message,
-                    'timestamp':  timestamp
-                }
+                msg_data = group_message(self.current_chat, message)
             # Atualização local imediata APENAS para o remetente
                 """
                 self.process_received_message({
@@ -287,15 +506,7 @@ class ChatClient:
                 })
                 """
             else:
-                msg_data = {
-                    'type': 'private_message',
-                    'recipient': self.current_chat,
-                    'message': {
-                        'recipient': self.current_chat,
-                        'message': message
-                    },
-                    'timestamp': timestamp
-                }
+                msg_data = private_message(self.current_chat, message)
             
 
             
@@ -308,7 +519,7 @@ class ChatClient:
                 'recipient': self.current_chat,
                 'self_sent': True
             })
-            self.client_socket.send(json.dumps(msg_data).encode('utf-8'))
+            self.core.send(msg_data)
             self.message_entry.delete(0, tk.END)
         
         except Exception as e:
@@ -320,7 +531,7 @@ class ChatClient:
         if selection:
             self.current_chat = self.contacts_list.get(selection[0])
             self.current_chat_type = 'individual'
-            self.chat_title.config(text=f"Chat com {self.current_chat}")
+            self.chat_title.config(text=f"Chat com {self.current_chat}{self.unread_label()}")
             self.load_chat_history()
 
     def select_group(self, event):
@@ -329,34 +540,61 @@ class ChatClient:
         if selection:
             self.current_chat = self.groups_list.get(selection[0])
             self.current_chat_type = 'group'
-            self.chat_title.config(text=f"Grupo: {self.current_chat}")
+            self.chat_title.config(text=f"Grupo: {self.current_chat}{self.unread_label()}")
             self.load_chat_history()
 
+    def unread_label(self):
+        """Texto com as mensagens não lidas da conversa atual (zera o contador)"""
+        meta = self.chat_meta.get(f"{self.current_chat_type}_{self.current_chat}")
+        if not meta or not meta.get('unread'):
+            return ""
+        unread = meta['unread']
+        meta['unread'] = 0
+        return f" ({unread} não lidas)"
+
     def load_chat_history(self):
-        """Carrega o histórico do chat selecionado"""
+        """
+        Renderiza do zero a conversa selecionada, apenas com as RENDER_WINDOW
+        mensagens mais recentes (as anteriores entram ao rolar até o topo).
+        A primeira página é buscada no servidor.
+        """
         self.chat_area.config(state='normal')
         self.chat_area.delete(1.0, tk.END)
-        
-        if not self.current_chat:
+        for tag, _, _ in self.rendered:
+            self.chat_area.tag_delete(tag)
+        self.rendered.clear()
+        self.rendered_by_id.clear()
+        
+        self.view_key = f"{self.current_chat_type}_{self.current_chat}" if self.current_chat else None
+        if self.view_key is None:
+            self.chat_area.config(state='disabled')
             return
             
-        history_key = f"{self.current_chat_type}_{self.current_chat}"
+        if self.view_key not in self.history_state:
+            # Primeira abertura na sessão: lê do cache local; sem cache, pede a página mais recente
+            cached = self.cache.load(self.view_key, limit=RENDER_WINDOW)
+            if cached:
+                self.merge_page(self.view_key, cached, has_more=True, render=False)
+            else:
+                self.request_history(self.current_chat_type, self.current_chat)
         
-        if history_key in self.chat_history:
-            for message in self.chat_history[history_key]:
-                self.display_message(message)
+        history = self.chat_history.get(self.view_key, [])
+        self.render_start = max(0, len(history) - RENDER_WINDOW)
+        for message in history[self.render_start:]:
+            self.rendered.append(self.render_message(message, tk.END))
         
         self.chat_area.config(state='disabled')
+        self.chat_area.see(tk.END)
 
     def add_contact(self):
         """Adiciona um novo contato"""
         contact = simpledialog.askstring("Adicionar Contato", "Nome do contato:", parent=self.root)
         if contact:
             try:
-                self.client_socket.send(json.dumps({
+                self.core.send({
                     'type': 'add_contact',
                     'contact_name': contact
-                }).encode('utf-8'))
+                })
             except Exception as e:
                 messagebox.showerror("Erro", f"Falha ao adicionar contato: {e}")
 
@@ -365,10 +603,7 @@ class ChatClient:
         group_name = simpledialog.askstring("Novo Grupo", "Nome do grupo:", parent=self.root)
         if group_name:
             try:
-                self.client_socket.send(json.dumps({
-                    'type': 'create_group',
-                    'group_name': group_name
-                }).encode('utf-8'))
+                self.core.create_group(group_name)
             except Exception as e:
                 messagebox.showerror("Erro", f"Falha ao criar grupo: {e}")
 
@@ -394,11 +629,7 @@ class ChatClient:
             selected = [contacts_listbox.get(i) for i in contacts_listbox.curselection()]
             for contact in selected:
                 try:
-                    self.client_socket.send(json.dumps({
-                        'type': 'invite_to_group',
-                        'group_name': self.current_chat,
-                        'contact_name': contact
-                    }).encode('utf-8'))
+                    self.core.invite(self.current_chat, contact)
                 except Exception as e:
                     messagebox.showerror("Erro", f"Falha ao convidar {contact}: {e}", parent=invite_window)
             invite_window.destroy()
@@ -421,4 +652,6 @@ class ChatClient:
         pass
 
 if __name__ == "__main__":
+    # MENSAGERIA_LOG=TRACE mostra cada mensagem recebida
+    setup_logging({"level": os.environ.get("MENSAGERIA_LOG", "INFO")})
     client = ChatClient()
\ No newline at end of file
@@ -1,257 +1,852 @@
+import argparse
+import os
 import socket
+import sys
 import threading
 import json
-import traceback
-from datetime import datetime
-from dtos import CommandDTO
+import time
+from concurrent.futures import ThreadPoolExecutor
+from admin import AdminServer
+from async_engine import AsyncioEngine
+from bus import LocalBus, ProcessBus, supervise
+from cluster import ClusterBus
+from commands import CommandRegistry, ParsedCommand, split_command
+from delivery import Mailbox, Mailboxes, parse_delivery
+from heartbeat import PING, PONG, HeartbeatMonitor, parse_heartbeat
+from codec import JSON, HistoryPage, Message, build_codecs, negotiate, parse_hello
+from dtos import OutboundPolicyDTO, SocketOptionsDTO
+from framing import HEADER_SIZE, FrameDecoder, FrameTooLarge, encode_json, recv_frame
+from logger import TRACE, dropped_records, get_logger, setup_logging
+from membership import Membership
+from message_store import MessageRecord, MessageStore, format_timestamp
+from metrics import Metrics, rss_kb
+from outbound import POLICIES, ClientConnection, SlowConsumerError, configure_socket
+from persistence import Persistence
+from presence import PresenceCoalescer
+from ratelimit import RateLimiter
+from retention import parse_retention
+from search_index import SearchIndex
+
+ENGINES = ('thread', 'asyncio')
+
+log = get_logger("servidor")
 
 class Server:
-    def __init__(self, host='127.0.0.1', port=5050):
+    def __init__(self, host='127.0.0.1', port=5050, engine='thread', config_path="config/server.json",
+                 worker_id: int = None, bus_path: str = None, node_id: str = None):
+        if engine not in ENGINES:
+            raise ValueError(f"Engine desconhecida: {engine}")
         self.host = host
         self.port = port
+        self.engine = engine
+        # No modo multiprocesso (ver bus.py) vários trabalhadores escutam na mesma porta
+        self.worker_id = worker_id
+        # No modo cluster (ver cluster.py) cada nó é um servidor com a sua própria porta
+        self.node_id = node_id
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bus_path is not None:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((self.host, self.port))
-        self.server.listen()
+        if bus_path is None:
+            self.server.listen()
         
         self.clients = {}
         self.contacts = {}
-        self.groups = {'Geral': set()}
-        self.messages = {'individual': {}, 'group': {'Geral': []}}
+        self.membership = Membership()
+        self.membership.create_group('Geral')
+        self.store = MessageStore()
+        self.store.create_group('Geral')
         self.running = True
         self.pending_invites = {}  # {username: [{'group': group_name, 'invited_by': sender}]}
+        self.read_cursors = {}     # {username: {(tipo, conversa): último id entregue}}
+        self._login_marks = {}     # {username: {(tipo, conversa): último id no momento do login}}
+        self._held = {}            # {username: [(mensagem, seq)]} retidas até o connection_ack
+        self._held_lock = threading.RLock()
+        self.mailboxes: Mailboxes = None  # {username: Mailbox} mensagens ainda não confirmadas (ver delivery.py)
+        self.metrics = Metrics()
+        self._event_time = None    # horário do evento replicado em aplicação (modo multiprocesso)
+
+        self.config = {}
+        self.outbound_policy: OutboundPolicyDTO = None
+        self._load_config(config_path)
+
+        # Histórico, grupos e convites persistidos em disco (WAL + snapshots)
+        self.persistence: Persistence = None
+        self._load_persistence()
+
+        # Índice invertido do histórico para o /search (construído em segundo plano)
+        self.search: SearchIndex = None
+        self._load_search()
 
-        self.commands: list[CommandDTO] = []
+        # Eventos de presença são agrupados e enviados como delta a cada janela
+        self.call_later = self._timer_call_later
+        # Onde os eventos do barramento são aplicados (a engine asyncio troca pelo event loop)
+        self.call_soon = lambda fn, *args: fn(*args)
+        self.presence = PresenceCoalescer(
+            self.config.get("presence", {}).get("coalesce_window_ms", 100) / 1000,
+            self._broadcast_presence,
+            lambda delay, fn: self.call_later(delay, fn)
+        )
+
+        # Comandos: descrição em config/commands.json (recarregado ao mudar) e handler aqui
+        self.commands: CommandRegistry = None
+        self.command_pool: ThreadPoolExecutor = None
+        self.command_handlers = {
+            'history': self._history_command,
+            'delete': self._delete_command,
+            'edit': self._edit_command,
+            'stats': self._stats_command,
+            'search': self._search_command,
+        }
         self._load_commands()
-        
-        print(f"[SERVIDOR OUVINDO] {self.host}:{self.port}")
 
-    def update_all_clients(self):
-        online_users = list(self.clients.keys())
-        for username, client in self.clients.items():
-            try:
-                user_groups = [g for g in self.groups if username in self.groups[g]]
-                update_data = {
-                    'type': 'update',
-                    'contacts': [u for u in online_users if u != username],
-                    'groups': user_groups,
-                    'all_groups': list(self.groups.keys())
-                }
-                client.send(json.dumps(update_data).encode('utf-8'))
-            except Exception as e:
-                print(f"[ERRO UPDATE] {username}: {e}")
-                self.handle_disconnect(username)
+        # Ping das conexões inativas e remoção das que pararam de responder
+        self.heartbeat: HeartbeatMonitor = None
+        self._load_heartbeat()
+
+        # Endpoint local com as métricas e o profiler (opcional)
+        self.admin: AdminServer = None
+        self._load_admin()
+
+        # Todo pedido de cliente, conexão e desconexão passa pelo barramento, que no
+        # modo multiprocesso os replica em todos os trabalhadores na mesma ordem e
+        # no modo cluster os leva ao nó dono da conversa
+        if bus_path is not None:
+            self.bus = ProcessBus(self, bus_path, worker_id)
+        elif node_id is not None:
+            self.bus = ClusterBus(self, node_id, self.config.get("cluster", {}).get("nodes", {}))
+        else:
+            self.bus = LocalBus(self)
+
+        log.info("SERVIDOR OUVINDO", f"{self.host}:{self.port}")
+
+    # Estado completo (contatos online e grupos), enviado apenas no login
+    def _snapshot(self, username: str) -> Message:
+        return Message({
+            'type': 'update',
+            'contacts': [u for u in self.online_users() if u != username],
+            'groups': self.membership.groups_of(username),
+            'all_groups': self.membership.group_names()
+        })
+
+    # Usuários online em qualquer trabalhador (self.clients tem só as conexões deste processo)
+    def online_users(self) -> list[str]:
+        return [u for u, contact in list(self.contacts.items()) if contact['status'] == 'online']
+
+    # Envia o delta acumulado pelo PresenceCoalescer, serializado uma única vez por codec
+    def _broadcast_presence(self, delta: dict):
+        message = Message(delta)
+        for username in list(self.clients.keys()):
+            self._send_to(username, message)
+
+    def _timer_call_later(self, delay: float, fn):
+        timer = threading.Timer(delay, fn)
+        timer.daemon = True
+        timer.start()
+
+    """
+    Enfileira uma mensagem na fila de saída do usuário, no codec negociado por ele.
+    `message` é qualquer objeto com frame(codec) (Message, MessageRecord, HistoryPage),
+    que guarda o frame já serializado para os próximos destinatários.
+    Mensagens de conversa (`tracked`) para quem tem caixa de entrega recebem a
+    próxima sequência e ficam guardadas até o ack, mesmo com o usuário offline.
+    Se a conexão já caiu ou o cliente não acompanha o ritmo (conforme a política
+    da fila), ele é desconectado.
+    """
+    def _send_to(self, username: str, message) -> bool:
+        client = self.clients.get(username)
+        if client is None and self.bus.remote(username):
+            # Usuário conectado em outro nó do cluster
+            return self.bus.forward((username,), message)
+        mailbox = self.mailboxes.get(username) if message.tracked else None
+        if mailbox is None:
+            return client is not None and self._deliver(username, client, message)
+        # A sequência é atribuída e escrita sob o lock para sair na ordem
+        with mailbox.lock:
+            seq = mailbox.push(message)
+            if client is None:
+                # Offline (ou em outro trabalhador): fica na caixa para a retomada
+                return True
+            return self._deliver(username, client, message, seq)
+
+    def _deliver(self, username: str, client, message, seq: int = None) -> bool:
+        if self._held.get(username) is not None:
+            with self._held_lock:
+                held = self._held.get(username)
+                if held is not None:
+                    held.append((message, seq))
+                    return True
+            # O connection_ack saiu nesse meio tempo: segue direto
+        return self._write(username, client, message, seq)
+
+    def _write(self, username: str, client, message, seq: int = None) -> bool:
+        try:
+            frame = message.frame(client.codec)
+        except (TypeError, ValueError) as e:
+            # O codec do destinatário não representa esta mensagem: só ela é descartada
+            self.metrics.incr('encode_errors')
+            log.error("ERRO CODIFICAÇÃO", str(e), user=username, codec=client.codec.name)
+            return True
+        try:
+            if seq is not None and client.sequenced:
+                frame = client.codec.sequenced(frame, seq)
+            client.send(frame)
+            self.metrics.incr('frames_out')
+            self.metrics.incr('bytes_out', len(frame))
+            return True
+        except SlowConsumerError as e:
+            self.metrics.incr('slow_consumers')
+            log.warning("CLIENTE LENTO", str(e), user=username)
+        except Exception as e:
+            self.metrics.incr('send_errors')
+            log.error("ERRO ENVIO", str(e), user=username)
+        self.handle_disconnect(username)
+        return False
+
+    # Profundidade da fila de saída e mensagens descartadas de cada usuário conectado
+    def queue_stats(self) -> dict:
+        return {
+            username: {'depth': client.depth, 'dropped': client.dropped}
+            for username, client in list(self.clients.items())
+        }
+
+    """
+    Métricas do servidor: contadores e histogramas acumulados desde o início
+    (handler_us.<tipo> e command_us.<comando> em microssegundos, fanout em
+    destinatários) mais o estado atual das filas e dos grupos.
+    """
+    def stats(self) -> dict:
+        stats = self.metrics.snapshot()
+        queues = self.queue_stats()
+        deepest = sorted(queues.items(), key=lambda item: item[1]['depth'], reverse=True)[:5]
+        stats['engine'] = self.engine
+        stats['connections'] = len(queues)
+        stats['queues'] = {
+            'total_depth': sum(q['depth'] for q in queues.values()),
+            'max_depth': max((q['depth'] for q in queues.values()), default=0),
+            'dropped': sum(q['dropped'] for q in queues.values()),
+            'deepest': {username: q['depth'] for username, q in deepest if q['depth']}
+        }
+        stats['groups'] = {
+            group_name: {'messages': len(chat_log), 'members': len(self.membership.members(group_name))}
+            for group_name, chat_log in list(self.store.groups.items())
+        }
+        stats['private_chats'] = len(self.store.private)
+        stats['memory'] = dict(self.store.memory(), rss_kb=rss_kb())
+        stats['log_dropped'] = dropped_records()
+        if self.search is not None:
+            stats['search'] = self.search.stats()
+        if self.heartbeat is not None:
+            stats['heartbeat'] = {'watched': len(self.heartbeat)}
+        mailboxes = list(self.mailboxes.values())
+        stats['delivery'] = {
+            'mailboxes': len(mailboxes),
+            'pending': sum(len(mailbox) for mailbox in mailboxes),
+            'dropped': sum(mailbox.dropped for mailbox in mailboxes),
+            'expired': self.mailboxes.expired
+        }
+        cluster = self.bus.stats()
+        if cluster is not None:
+            stats['cluster'] = cluster
+        return stats
 
     def handle_disconnect(self, username):
-        if username in self.clients:
+        client = self.clients.pop(username, None)
+        marks = None
+        if client is not None:
             try:
-                self.clients[username].close()
+                client.close()
             except:
                 pass
-            del self.clients[username]
-        
+            self.metrics.incr('disconnections')
+            marks = self._login_marks.pop(username, {})
+            if self.heartbeat is not None:
+                self.heartbeat.forget(client)
+        self._held.pop(username, None)
+        if self.limiter is not None:
+            self.limiter.forget(username)
+
+        log.info("DESCONECTADO", username)
+        self.bus.disconnected(username, marks)
+
+    # Aplicado em todos os trabalhadores; `marks` é None se a conexão já tinha sido removida
+    def _user_offline(self, username: str, marks: dict, created: float = None):
         if username in self.contacts:
             self.contacts[username]['status'] = 'offline'
-        
-        for group in self.groups.values():
-            if username in group:
-                group.remove(username)
-        
-        print(f"[DESCONECTADO] {username}")
-        self.update_all_clients()
 
-    def broadcast(self, message, sender=None, group_name='Geral', msg_type='text'):
-        try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            msg_data = {
-                'type': 'group_message' if group_name != 'individual' else 'private_message',
-                'sender': sender,
-                'message': message['message'] if group_name == 'individual' else message,
-                'timestamp': timestamp,
-                'group': group_name if group_name != 'individual' else None
-            }
+        if marks is not None:
+            self._save_read_cursors(username, marks)
+        self.membership.remove_user(username)
+        self.presence.user_offline(username)
 
-            if group_name != 'individual' and msg_data["message"]["message"].startswith("/"):
-                self._handle_command(msg_data)
-                return
+        # A caixa de entrega continua guardando o que chegar até expirar (offline_ttl);
+        # no modo multiprocesso `created` é o horário do evento, igual em todas as réplicas
+        now = created or time.time()
+        self.mailboxes.user_offline(username, now)
+        self.mailboxes.expire(now)
 
+    def broadcast(self, message, sender=None, group_name='Geral', msg_type='text'):
+        try:
             if group_name == 'individual':
                 recipient = message['recipient']
-                msg_data['recipient'] = recipient
-                
-                key = tuple(sorted((sender, recipient)))
-                if key not in self.messages['individual']:
-                    self.messages['individual'][key] = []
-                
-                msg_data['id'] = len(self.messages['individual'][key])
-                self.messages['individual'][key].append(msg_data)
+                text = message['message']
+                if isinstance(text, dict):
+                    text = text.get('message', '')
+
+                if not self.bus.owns_private(sender, recipient):
+                    # Modo cluster: a conversa é de outro nó, que atribui o id e entrega
+                    self.bus.relay(sender, {'type': 'private_message', 'recipient': recipient,
+                                            'message': {'recipient': recipient, 'message': text}})
+                    return
+
+                record = self.store.append_private(sender, recipient, text, created=self._event_time)
                 
-                if recipient in self.clients:
-                    try:
-                        self.clients[recipient].send(json.dumps(msg_data).encode('utf-8'))
-                        print(f"[MSG PRIVADA] {sender} -> {recipient}")
-                    except:
-                        self.handle_disconnect(recipient)
+                if self._send_to(recipient, record):
+                    log.debug("MSG PRIVADA", f"{sender} -> {recipient}", id=record.id)
             else:
-                if group_name not in self.messages['group']:
-                    self.messages['group'][group_name] = []
-                
-                msg_data['id'] = len(self.messages['group'][group_name])
-                self.messages['group'][group_name].append(msg_data)
-                
-                print(f"[DEBUG] Enviando para grupo {group_name}: {self.groups[group_name]}")
-                
-                for member in self.groups.get(group_name, set()):
-                    if member in self.clients:
-                        try:
-                            self.clients[member].send(json.dumps(msg_data).encode('utf-8'))
-                            print(f"[MSG GRUPO] {group_name}: {sender} -> {member}")
-                        except:
-                            self.handle_disconnect(member)
-            
-                    
+                if message["message"].startswith("/"):
+                    self._handle_command({'sender': sender, 'group': group_name, 'message': message})
+                    return
+
+                record = self.store.append_group(group_name, sender, message["message"], created=self._event_time)
+                members = self._fan_out(group_name, sender, record)
+                log.debug("MSG GRUPO", f"{sender} -> {group_name}", id=record.id, members=members)
+
         except Exception as e:
-            error_info = traceback.format_exc()
-            print(f"[ERRO BROADCAST] {error_info}")
+            log.error("ERRO BROADCAST", str(e), exc_info=True, user=sender, group=group_name)
+
+    """
+    Entrega uma mensagem de grupo (nova ou atualizada) a todos os membros. O registro
+    guarda o frame de cada codec, serializado uma única vez; membros em outros nós
+    do cluster recebem um único evento por nó. Retorna a quantidade de membros.
+    """
+    def _fan_out(self, group_name: str, sender: str, record: MessageRecord) -> int:
+        members = self.membership.members(group_name)
+        self.metrics.observe('fanout', len(members))
+        trace = log.enabled(TRACE)
+        remote = []
+        for member in members:
+            if member in self.clients:
+                if self._send_to(member, record) and trace:
+                    log.trace("ENTREGA", f"{group_name}: {sender} -> {member}", id=record.id)
+            elif self.bus.remote(member):
+                remote.append(member)
+            elif member in self.mailboxes:
+                # Conectado em outro trabalhador: a réplica da caixa também numera a mensagem
+                self._send_to(member, record)
+        if remote:
+            self.bus.forward(remote, record)
+        return len(members)
 
     def handle_client(self, conn, addr):
         username = None
+        client = None
+        decoder = FrameDecoder()
         try:
-            username = conn.recv(1024).decode('utf-8').strip()
+            # O primeiro frame da conexão traz o nome de usuário e os codecs aceitos
+            frame = recv_frame(conn, decoder)
+            username, codecs, resume = parse_hello(frame) if frame else (None, [], None)
             if not username:
                 raise ValueError("Nome de usuário vazio")
-                
-            self.clients[username] = conn
-            self.contacts[username] = {'status': 'online'}
-            self.groups['Geral'].add(username)
-            
-            print(f"[NOVA CONEXÃO] {username} de {addr}")
-            
-            conn.send(json.dumps({
-                'type': 'connection_ack',
-                'message': f"Bem-vindo {username}",
-                'status': 'success',
-                'your_name': username,
-                'history': {
-                    'individual': {k: v for k, v in self.messages['individual'].items() if username in k},
-                    'group': {g: msgs for g, msgs in self.messages['group'].items() if username in self.groups.get(g, set())}
-                }
-            }).encode('utf-8'))
-            
-            self.update_all_clients()
+
+            configure_socket(conn, self.socket_options)
+            client = ClientConnection(conn, self.outbound_policy)
+            self._register_client(username, client, addr, codecs, resume)
             
             while self.running:
                 try:
-                    data = conn.recv(4096)
+                    data = conn.recv(65536)
                     if not data:
                         break
-                        
-                    data = json.loads(data.decode('utf-8'))
-                    print(f"[MSG RECEBIDA] {username}: {data.get('type')}")
-                    
-                    if data.get('type') == 'group_message':
-                        self.broadcast(data, username, data['group'])
-                    elif data.get('type') == 'private_message':
-                        self.broadcast(data, username, 'individual')
-                    elif data.get('type') == 'create_group':
-                        group_name = data['group_name']
-                        if group_name not in self.groups:
-                            self.groups[group_name] = set([username])
-                            self.messages['group'][group_name] = []
-                            print(f"[NOVO GRUPO] {group_name} por {username}")
-                            self.update_all_clients()
-                    elif data.get('type') == 'invite_to_group':
-                        group_name = data['group_name']
-                        contact_name = data['contact_name']
-                        if group_name in self.groups and contact_name in self.clients:
-                            # Adiciona o convite à lista de pendentes em vez de adicionar direto ao grupo
-                            if contact_name not in self.pending_invites:
-                                self.pending_invites[contact_name] = []
-                            self.pending_invites[contact_name].append({
-                                'group': group_name,
-                                'invited_by': username
-                            })
-                            print(f"[CONVITE ENVIADO] {username} convidou {contact_name} para {group_name}")
-                            self.clients[contact_name].send(json.dumps({
-                                'type': 'group_invite',
-                                'group_name': group_name,
-                                'invited_by': username
-                            }).encode('utf-8'))
-
-                    elif data.get('type') == 'accept_invite':
-                        group_name = data['group_name']
-                        username = data['username']
-                        # Verifica se o convite existe
-                        if username in self.pending_invites:
-                            for invite in self.pending_invites[username]:
-                                if invite['group'] == group_name:
-                                    # Adiciona ao grupo apenas agora que aceitou
-                                    self.groups[group_name].add(username)
-                                    # Remove o convite pendente
-                                    self.pending_invites[username].remove(invite)
-                                    if not self.pending_invites[username]:
-                                        del self.pending_invites[username]
-                                    print(f"[CONVITE ACEITO] {username} entrou em {group_name}")
-                                    self.update_all_clients()
-                                    break
-
-                    elif data.get('type') == 'reject_invite':
-                        group_name = data['group_name']
-                        username = data['username']
-                        # Remove o convite pendente sem adicionar ao grupo
-                        if username in self.pending_invites:
-                            self.pending_invites[username] = [invite for invite in self.pending_invites[username] 
-                                                            if invite['group'] != group_name]
-                            if not self.pending_invites[username]:
-                                del self.pending_invites[username]
-                            print(f"[CONVITE REJEITADO] {username} recusou entrar em {group_name}")
-                            
-                except json.JSONDecodeError:
-                    print(f"[ERRO JSON] {username}")
+
+                    client.last_seen = time.monotonic()
+                    # Um recv pode trazer vários frames (ou só parte de um)
+                    decoder.feed(data)
+                    for frame in decoder:
+                        data, delay = self._process_frame(username, frame, client.codec)
+                        if delay:
+                            # Acima do limite de taxa: espera repor a ficha antes de tratar o frame
+                            # e, enquanto isso, não lê mais nada do socket
+                            time.sleep(delay)
+                        if data is not None:
+                            self._dispatch_frame(username, frame, data, client.codec)
+
+                except FrameTooLarge as e:
+                    log.warning("ERRO FRAME", str(e), user=username)
+                    break
                 except Exception as e:
-                    print(f"[ERRO CLIENTE] {username}: {e}")
+                    log.error("ERRO CLIENTE", str(e), user=username)
                     break
                     
         except Exception as e:
-            print(f"[ERRO CONEXÃO] {addr}: {e}")
+            log.warning("ERRO CONEXÃO", str(e), addr=addr)
         finally:
-            if username:
+            # Se a conexão já foi removida (ex.: cliente lento derrubado), não desconecta de novo
+            if username and client is not None and self.clients.get(username) is client:
                 self.handle_disconnect(username)
+            elif client is not None:
+                client.close()
+            else:
+                conn.close()
+
+    """
+    Registra um usuário recém-conectado, escolhe o codec entre os oferecidos e
+    envia a confirmação (sempre em JSON; os frames seguintes já usam o codec).
+    Se o hello trouxe a posição de retomada, ela segue pelo barramento como um
+    pedido 'resume' logo depois da conexão.
+    Compartilhado pelas engines thread e asyncio; `conn` é a fila de saída da conexão.
+    """
+    def _register_client(self, username: str, conn, addr, codecs: list = (), resume: dict = None):
+        conn.codec = negotiate(codecs, self.codecs)
+        conn.metrics = self.metrics
+        conn.sequenced = resume is not None and self.delivery is not None
+        # Até o connection_ack (JSON) entrar na fila, o que for enviado ao usuário fica retido;
+        # sem isso um frame no codec negociado poderia chegar antes da confirmação
+        self._held[username] = []
+        self.clients[username] = conn
+        self.metrics.incr('connections')
+
+        log.info("NOVA CONEXÃO", f"{username} de {addr}", codec=conn.codec.name, resume=conn.sequenced)
+        if self.heartbeat is not None:
+            self.heartbeat.watch(username, conn)
+        self.bus.connected(username)
+        if conn.sequenced:
+            data = {'type': 'resume', 'epoch': resume.get('epoch'), 'seq': resume.get('seq', 0)}
+            self.bus.publish_frame(username, JSON, JSON.frame(data)[HEADER_SIZE:], data)
+
+    # Aplicado em todos os trabalhadores; a confirmação sai só do que tem a conexão
+    def _user_online(self, username: str, created: float = None):
+        self.contacts[username] = {'status': 'online'}
+        self.membership.add('Geral', username)
+        # Expira antes, para que quem volta depois de offline_ttl não encontre a caixa antiga
+        self.mailboxes.expire(created or time.time())
+        self.mailboxes.user_online(username)
+
+        if username in self.clients:
+            self.bus.gather_chats(username, self._send_ack)
+
+        self.presence.user_online(username)
+        self.presence.member_joined('Geral', username)
+
+    """
+    Envia o connection_ack e o estado inicial; depois libera o que ficou retido
+    nesse meio tempo. Tudo sob o lock e antes de remover a retenção, para que
+    nada enviado em paralelo passe na frente.
+    """
+    def _send_ack(self, username: str, chats: dict):
+        with self._held_lock:
+            conn = self.clients.get(username)
+            if conn is None:
+                self._held.pop(username, None)
+                return
+            held = self._held.get(username) or []
+            try:
+                conn.send(self._build_connection_ack(username, chats, conn.codec))
+            except Exception as e:
+                log.error("ERRO ENVIO", str(e), user=username)
+                self.handle_disconnect(username)
+                return
+            ok = self._write(username, conn, self._snapshot(username))
+            for message, seq in held:
+                if not ok:
+                    break
+                ok = self._write(username, conn, message, seq)
+            self._held.pop(username, None)
+
+    """
+    Metadados (último id, revisão de edições e quantidade não lida) das conversas
+    do usuário que ficam neste servidor, guardando a marca do login para os
+    cursores de leitura. No cluster cada nó responde pelas conversas de que é dono.
+    """
+    def _chat_meta(self, username: str) -> dict:
+        cursors = self.read_cursors.get(username, {})
+        marks = {}
+        chats = {'group': {}, 'individual': {}}
+        for chat_type, chat, chat_log in self._chats_of(username):
+            last_id = len(chat_log) - 1 if chat_log is not None else -1
+            cursor = cursors.get((chat_type, chat), -1)
+            chats[chat_type][chat] = {
+                'last_id': last_id,
+                'edits': len(chat_log.edits) if chat_log is not None else 0,
+                'unread': max(0, last_id - cursor)
+            }
+            marks[(chat_type, chat)] = last_id
+        self._login_marks[username] = marks
+        return chats
+
+    """
+    Monta o frame de connection_ack. Em vez do histórico completo, envia apenas os
+    metadados de cada conversa; as mensagens são buscadas sob demanda com history_request.
+    """
+    def _build_connection_ack(self, username: str, chats: dict, codec=JSON) -> bytes:
+        return encode_json({
+            'type': 'connection_ack',
+            'message': f"Bem-vindo {username}",
+            'status': 'success',
+            'your_name': username,
+            'codec': codec.name,
+            'chats': chats
+        })
 
-    def _load_commands(self, path="config/commands.json"):
-        data = []
+    # (tipo, nome, ChatLog) de cada conversa visível para o usuário (no cluster, só as deste nó)
+    def _chats_of(self, username: str) -> list[tuple]:
+        chats = [('group', g, self.store.group_log(g)) for g in self.membership.groups_of(username)
+                 if self.bus.owns_group(g)]
+        chats += [('individual', other, chat_log) for other, chat_log in self.store.private_chats(username).items()]
+        return chats
+
+    """
+    Atualiza os cursores de leitura quando o usuário sai. O que chegou enquanto ele
+    estava online foi entregue; se havia mensagens não lidas anteriores ao login que
+    ele não buscou, o cursor permanece onde estava.
+    """
+    def _save_read_cursors(self, username: str, marks: dict):
+        cursors = self.read_cursors.setdefault(username, {})
+        for chat_type, chat, chat_log in self._chats_of(username):
+            key = (chat_type, chat)
+            if key not in marks or cursors.get(key, -1) >= marks[key]:
+                cursors[key] = len(chat_log) - 1 if chat_log is not None else -1
+
+    """
+    Responde um history_request com uma página de mensagens de uma conversa.
+    Sem cursor retorna as mais recentes; `before` pagina para trás e `after` para frente.
+
+    Com `after` e `edits_since` (revisão de edições que o cliente já tem em cache),
+    a página inclui também as mensagens até `after` editadas/apagadas depois dessa
+    revisão. Se o cliente conhece mais do que o servidor (ex.: histórico perdido),
+    a resposta vem com `reset` para ele descartar o cache da conversa.
+    """
+    def _history_request(self, username: str, data: dict):
+        chat_type = data.get('chat_type')
+        chat = data.get('chat')
+        if chat_type == 'group':
+            chat_log = self.store.group_log(chat) if self.membership.is_member(chat, username) else None
+        else:
+            chat_type = 'individual'
+            chat_log = self.store.private_log(username, chat)
+
+        history = self.config.get("history", {})
+        limit = min(int(data.get('limit') or history.get("page_size", 50)), history.get("max_page_size", 500))
+        total = len(chat_log) if chat_log is not None else 0
+
+        if data.get('after') is not None:
+            start = max(int(data['after']) + 1, 0)
+            stop = min(total, start + limit)
+            has_more = stop < total
+        else:
+            stop = total if data.get('before') is None else min(int(data['before']), total)
+            start = max(0, stop - limit)
+            has_more = start > 0
+
+        records = chat_log.records(start, stop) if chat_log is not None else []
+        header = {
+            'type': 'history_page',
+            'chat_type': chat_type,
+            'chat': chat,
+            'has_more': has_more,
+            'edits': len(chat_log.edits) if chat_log is not None else 0
+        }
+        if data.get('after') is not None:
+            header['after'] = int(data['after'])
+            if data.get('edits_since') is not None:
+                revision = int(data['edits_since'])
+                if revision > header['edits'] or header['after'] >= total:
+                    header['reset'] = True
+                    records = []
+                elif chat_log is not None:
+                    updated = chat_log.edited_since(revision, header['after'])
+                    records = [chat_log.get(i) for i in updated] + records
+
+        if records:
+            cursors = self.read_cursors.setdefault(username, {})
+            cursors[(chat_type, chat)] = max(cursors.get((chat_type, chat), -1), records[-1].id)
+
+        self._send_to(username, HistoryPage(header, records))
+
+    # Ack cumulativo do cliente: libera da caixa tudo até a sequência confirmada
+    def _ack(self, username: str, data: dict):
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            return
+        with mailbox.lock:
+            mailbox.ack(int(data.get('seq', 0)))
+        self.metrics.incr('acks')
+
+    """
+    Retomada pedida no hello (ou no meio da sessão, quando o cliente percebe uma
+    lacuna): cria a caixa de entrega na primeira vez e reenvia, em ordem, o que
+    ainda não foi confirmado depois da posição do cliente. Roda em todas as
+    réplicas para que as caixas andem juntas; só quem tem a conexão responde.
+    """
+    def _resume(self, username: str, data: dict):
+        if self.delivery is None:
+            return
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            # A época identifica a caixa; réplicas usam o horário do evento e chegam à mesma
+            epoch = int((self._event_time or time.time()) * 1000)
+            mailbox = self.mailboxes[username] = Mailbox(self.delivery.max_pending, epoch)
+        with mailbox.lock:
+            base, pending, reset = mailbox.resume(data.get('epoch'), int(data.get('seq', 0)))
+            client = self.clients.get(username)
+            if client is None:
+                return
+            client.sequenced = True
+            self.metrics.incr('resumes')
+            self.metrics.incr('replayed', len(pending))
+            log.debug("RETOMADA", username, seq=base, replayed=len(pending), reset=reset)
+            if not self._deliver(username, client, Message({
+                'type': 'resume_ack', 'epoch': mailbox.epoch, 'after': base,
+                'replayed': len(pending), 'reset': reset
+            })):
+                return
+            for seq, message in pending:
+                if not self._deliver(username, client, message, seq):
+                    break
+
+    def _process_frame(self, username: str, frame: bytes, codec=JSON) -> tuple:
+        """
+        Decodifica o frame e cobra o limite de taxa. Devolve (mensagem, espera):
+        a mensagem é None se o frame for inválido, e quem lê o socket espera os
+        segundos indicados antes de passá-la para _dispatch_frame.
+        """
+        self.metrics.incr('frames_in')
+        self.metrics.incr('bytes_in', len(frame) + HEADER_SIZE)
+        try:
+            data = codec.decode(frame)
+        except ValueError as e:
+            self.metrics.incr('decode_errors')
+            log.warning("ERRO DECODIFICAÇÃO", str(e), user=username, codec=codec.name)
+            return None, 0.0
+
+        if self.limiter is None:
+            return data, 0.0
+        delay = self.limiter.acquire(username, data)
+        if delay:
+            self.metrics.incr('throttled')
+            self.metrics.observe('throttle_ms', delay * 1000)
+            log.debug("LIMITE DE TAXA", username, type=data.get('type'), delay_ms=round(delay * 1000, 1))
+        return data, delay
+
+    def _dispatch_frame(self, username: str, frame: bytes, data: dict, codec=JSON):
+        kind = data.get('type')
+        log.debug("MSG RECEBIDA", username, type=kind)
+        if kind == 'ping':
+            # Heartbeat é só desta conexão: respondido aqui, sem passar pelo barramento
+            self._send_to(username, PONG)
+        elif kind != 'pong':
+            self.bus.publish_frame(username, codec, frame, data)
+
+    """
+    Trata um pedido de cliente vindo do barramento. No modo multiprocesso roda em
+    todos os trabalhadores, na mesma ordem, com o horário em que o pedido chegou
+    (`created`), para que as réplicas atribuam os mesmos ids e horários.
+    """
+    def _apply_frame(self, username: str, data: dict, created: float = None):
+        # Tempo de tratamento por tipo de mensagem, incluindo o fan-out
+        start = time.perf_counter()
+        self._event_time = created
+        try:
+            self._dispatch(username, data)
+        finally:
+            self._event_time = None
+        self.metrics.timed(f"handler_us.{data.get('type')}", start)
+
+    def _dispatch(self, username: str, data: dict):
+        if data.get('type') == 'group_message':
+            self.broadcast(data, username, data['group'])
+        elif data.get('type') == 'private_message':
+            self.broadcast(data, username, 'individual')
+        elif data.get('type') == 'history_request':
+            self._history_request(username, data)
+        elif data.get('type') == 'ack':
+            self._ack(username, data)
+        elif data.get('type') == 'resume':
+            self._resume(username, data)
+        elif data.get('type') == 'create_group':
+            group_name = data['group_name']
+            if group_name not in self.membership:
+                self.store.create_group(group_name)
+                self._group_created(group_name, username)
+                self.bus.group_created(group_name, username)
+                log.info("NOVO GRUPO", f"{group_name} por {username}")
+        elif data.get('type') == 'invite_to_group':
+            group_name = data['group_name']
+            contact_name = data['contact_name']
+            if group_name in self.membership and self.contacts.get(contact_name, {}).get('status') == 'online':
+                # Adiciona o convite à lista de pendentes em vez de adicionar direto ao grupo
+                if contact_name not in self.pending_invites:
+                    self.pending_invites[contact_name] = []
+                self.pending_invites[contact_name].append({
+                    'group': group_name,
+                    'invited_by': username
+                })
+                if self.persistence:
+                    self.persistence.invite_added(contact_name, group_name, username)
+                log.info("CONVITE ENVIADO", f"{username} convidou {contact_name} para {group_name}")
+                self._send_to(contact_name, Message({
+                    'type': 'group_invite',
+                    'group_name': group_name,
+                    'invited_by': username
+                }))
+
+        elif data.get('type') == 'accept_invite':
+            group_name = data['group_name']
+            username = data['username']
+            # Verifica se o convite existe
+            if username in self.pending_invites:
+                for invite in self.pending_invites[username]:
+                    if invite['group'] == group_name:
+                        # Adiciona ao grupo apenas agora que aceitou
+                        self._member_joined(group_name, username)
+                        self.bus.member_joined(group_name, username)
+                        # Remove os convites pendentes para esse grupo
+                        self._close_invites(username, group_name)
+                        log.info("CONVITE ACEITO", f"{username} entrou em {group_name}")
+                        break
+
+        elif data.get('type') == 'reject_invite':
+            group_name = data['group_name']
+            username = data['username']
+            # Remove o convite pendente sem adicionar ao grupo
+            if username in self.pending_invites:
+                self._close_invites(username, group_name)
+                log.info("CONVITE REJEITADO", f"{username} recusou entrar em {group_name}")
+
+    # Também aplicados quando outro nó do cluster cria um grupo ou aceita um convite
+    def _group_created(self, group_name: str, owner: str = None):
+        if self.membership.create_group(group_name):
+            self.presence.group_created(group_name)
+        if owner is not None:
+            self._member_joined(group_name, owner)
+
+    def _member_joined(self, group_name: str, username: str):
+        if self.membership.add(group_name, username):
+            self.presence.member_joined(group_name, username)
+
+    def _close_invites(self, username: str, group_name: str):
+        self.pending_invites[username] = [invite for invite in self.pending_invites[username] 
+                                        if invite['group'] != group_name]
+        if not self.pending_invites[username]:
+            del self.pending_invites[username]
+        if self.persistence:
+            self.persistence.invite_closed(username, group_name)
+
+    def _load_config(self, path="config/server.json"):
         with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+            self.config = json.load(f)
+        if self.worker_id is not None:
+            tag = f"w{self.worker_id}"
+        else:
+            tag = self.node_id
+        setup_logging(self.config.get("logging"), tag)
+
+        outbound = self.config.get("outbound", {})
+        self.outbound_policy = OutboundPolicyDTO(
+            outbound.get("max_queue", 1024),
+            outbound.get("policy", "drop_oldest"),
+            outbound.get("block_timeout", 2.0),
+            outbound.get("flush_window_ms", 0) / 1000,
+            max(1, outbound.get("max_batch", 64))
+        )
+        if self.outbound_policy.policy not in POLICIES:
+            raise ValueError(f"Política de fila desconhecida: {self.outbound_policy.policy}")
+        log.info("INFO", "Fila de saída", max_queue=self.outbound_policy.max_queue, policy=self.outbound_policy.policy,
+                 flush_window_ms=outbound.get("flush_window_ms", 0), max_batch=self.outbound_policy.max_batch)
+
+        sockets = self.config.get("socket", {})
+        self.socket_options = SocketOptionsDTO(
+            sockets.get("tcp_nodelay", True),
+            sockets.get("send_buffer_kb", 0) * 1024,
+            sockets.get("recv_buffer_kb", 0) * 1024
+        )
+
+        self.codecs = build_codecs(self.config.get("codec", {}))
+        log.info("INFO", f"Codecs habilitados: {', '.join(self.codecs)}")
 
-        if len(data) == 0:
-            print(f"[ERRO] Falha ao carregar comandos em: {path}")
+        rate_limit = self.config.get("rate_limit", {})
+        self.limiter = RateLimiter(rate_limit) if rate_limit.get("enabled", False) else None
+
+        self.delivery = parse_delivery(self.config.get("delivery", {}))
+        self.mailboxes = Mailboxes(self.delivery.offline_ttl if self.delivery is not None else 0)
+
+    def _load_admin(self):
+        admin = self.config.get("admin", {})
+        if not admin.get("enabled", False):
             return
+        try:
+            port = admin.get("port", 5051) + (self.worker_id or 0)
+            if self.node_id is not None:
+                port += sorted(self.config.get("cluster", {}).get("nodes", {})).index(self.node_id)
+            self.admin = AdminServer(self.stats, admin.get("host", "127.0.0.1"), port)
+        except OSError as e:
+            log.error("ERRO", f"Endpoint de administração indisponível: {e}")
+            return
+        self.admin.start()
 
-        for command in data:
-            self.commands.append(
-                CommandDTO(
-                    command["name"],
-                    command["description"],
-                    command["usage"],
-                    command["min_args"]
-                ))
-        print(f"[INFO] {len(data)} comandos carregados.")
-
-    def _get_command(self, command_name: str) -> CommandDTO:
-        for c in self.commands:
-            if c.name == command_name:
-                return c
-        return None
+    def _load_persistence(self):
+        persistence = self.config.get("persistence", {})
+        retention = parse_retention(self.config.get("retention", {}))
+        if not persistence.get("enabled", False):
+            log.info("INFO", "Persistência desativada, histórico apenas em memória")
+            if retention is not None:
+                log.warning("RETENÇÃO", "A retenção precisa da persistência (camada fria em disco); desativada")
+            return
+
+        directory = persistence.get("directory", "data")
+        if self.node_id is not None:
+            # Cada nó do cluster guarda apenas as conversas de que é dono
+            directory = os.path.join(directory, f"node-{self.node_id}")
+        journal = Persistence(
+            directory,
+            self.store,
+            self.pending_invites,
+            fsync=persistence.get("fsync", "interval"),
+            fsync_interval=persistence.get("fsync_interval_ms", 50) / 1000,
+            segment_bytes=persistence.get("segment_mb", 64) * 1024 * 1024,
+            snapshot_every=persistence.get("snapshot_every", 100000),
+            retention=retention
+        )
+        # No modo multiprocesso só o trabalhador 0 grava; os demais só carregam o estado
+        writer = self.worker_id in (None, 0)
+        stats = journal.recover(writer)
+        if writer:
+            self.persistence = journal
+        for group_name in list(self.store.groups):
+            self.membership.create_group(group_name)
+        log.info("INFO", "Histórico recuperado", snapshot_messages=stats['snapshot_messages'],
+                 replayed=stats['replayed'], seconds=round(stats['seconds'], 2))
+
+    def _load_heartbeat(self):
+        policy = parse_heartbeat(self.config.get("heartbeat", {}))
+        if policy is None:
+            return
+        self.heartbeat = HeartbeatMonitor(policy, self._ping, self._reap)
+        log.info("INFO", "Heartbeat", ping_interval_s=policy.ping_interval, idle_timeout_s=policy.idle_timeout)
+
+    def _load_search(self):
+        search = self.config.get("search", {})
+        if not search.get("enabled", True):
+            return
+        self.search = SearchIndex()
+        self.search.attach(self.store)
+
+    def _load_commands(self):
+        commands = self.config.get("commands", {})
+        self.commands = CommandRegistry(
+            commands.get("path", "config/commands.json"),
+            commands.get("reload_interval_ms", 1000) / 1000
+        )
+        self.command_pool = ThreadPoolExecutor(commands.get("workers", 2), thread_name_prefix="comando")
 
     def _handle_command(self, msg_data):
-        user_message = msg_data["message"]["message"]
-        command_str = user_message[1:]
         sender = msg_data["sender"]
+        args = split_command(msg_data["message"]["message"])
+        command = self.commands.get(args[0]) if args else None
+        handler = self.command_handlers.get(command.name) if command is not None else None
 
-        args = command_str.split()
-        command = self._get_command(args[0])
-
-        if command == None:
+        if handler is None:
             self._send_private_message(sender, "Comando não existe.")
             return
 
@@ -259,28 +854,51 @@ class Server:
             self._send_private_message(sender, f"\ndesc: {command.description}\nusage:\n    {command.usage}")
             return
 
-        self._interpret_command(command, msg_data)
+        parsed = ParsedCommand(command, sender, msg_data["group"], args)
+        if not command.offload:
+            self._run_command(handler, parsed)
+            return
+        # Só o processo que atende o usuário (no cluster, o dono do grupo) executa;
+        # as réplicas do modo multiprocesso não repetem o trabalho
+        if sender not in self.clients and not self.bus.remote(sender):
+            return
+        self.metrics.incr('commands_offloaded')
+        self.command_pool.submit(self._run_command, handler, parsed)
 
-    def _interpret_command(self, command: CommandDTO, msg_data: dict):
-        sender = msg_data["sender"]
-        group_name = msg_data["group"]
-        args = msg_data["message"]["message"][1:].split()
-        match command.name:
-            case "history":
-                self._history_command(sender, group_name)
-            case "delete":
-                self._delete_command(sender, group_name, args)
-            case "edit":
-                self._edit_command(sender, group_name, args)
+    """
+    Executa o handler de um comando, que devolve o texto da resposta (ou None).
+    A resposta volta por call_soon para o contexto em que as mensagens são
+    tratadas, pois o comando pode ter rodado no pool de threads.
+    """
+    def _run_command(self, handler, parsed: ParsedCommand):
+        start = time.perf_counter()
+        try:
+            reply = handler(parsed.sender, parsed.group, parsed.args)
+        except Exception as e:
+            log.error("ERRO COMANDO", str(e), exc_info=True, user=parsed.sender, command=parsed.command.name)
+            return
+        finally:
+            self.metrics.timed(f"command_us.{parsed.command.name}", start)
+        if reply is not None:
+            self.call_soon(self._reply, parsed.sender, reply)
+
+    # Resposta efêmera (não vai para o histórico) de um comando, como mensagem privada do 'Server'
+    def _reply(self, receiver: str, text: str):
+        self._send_to(receiver, Message({
+            'type': 'private_message',
+            'sender': 'Server',
+            'recipient': receiver,
+            'message': {'recipient': receiver, 'message': text},
+            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
+        }))
 
     def _edit_command(self, sender: str, group_name: str, args: list[str]):
         message_id = int(args[1])
         new_message = args[2]
 
         message = self._get_message_by_id(group_name, message_id, sender)
-        if len(message) > 0:
-            message["message"] = new_message
-            message["edited"] = True
+        if message is not None:
+            self.store.edit(message, new_message)
             self._update_message(message, group_name, sender)
 
 
@@ -288,52 +906,131 @@ class Server:
         message_id = int(args[1])
         message = self._get_message_by_id(group_name, message_id, sender)
 
-        if len(message) > 0:
-            message["deleted"] = True
+        if message is not None:
+            self.store.delete(message)
             self._update_message(message, group_name, sender)
 
-    def _history_command(self, sender: str, group_name: str):
+    def _history_command(self, sender: str, group_name: str, args: list[str]) -> str:
         history = self._get_user_message_history(sender, group_name)
         string_builder = "\n"
         string_builder += f"ID: Mensagem\n"
         for message in history:
             string_builder += f"{message[0]}: {message[1]}\n"
 
-        self._send_private_message(sender, string_builder)
-        print(f"[HISTORY] {sender} solicitou o histórico do grupo {group_name}")
+        log.info("HISTORY", f"{sender} solicitou o histórico do grupo {group_name}")
+        return string_builder
 
-    def _get_message_by_id(self, group_name: str, message_id: int, sender: str) -> dict:
-        group = self.messages["group"][group_name]
-        for message in group:
-            if message["id"] == message_id and message["sender"] == sender:
-                return message
-        return {}
+    def _stats_command(self, sender: str, group_name: str, args: list[str]) -> str:
+        # Resposta do processo que atende o usuário (no cluster, do nó dono do grupo,
+        # encaminhada ao nó do usuário)
+        if sender not in self.clients and not self.bus.remote(sender):
+            return None
+        stats = self.stats()
+        counters = stats['counters']
+        histograms = stats['histograms']
+        worker = f", trabalhador {self.worker_id}" if self.worker_id is not None else ""
+        if self.node_id is not None:
+            worker = f", nó {self.node_id}"
+        lines = [
+            "",
+            f"Conexões: {stats['connections']} (engine {stats['engine']}{worker}, {stats['uptime_seconds']}s no ar)",
+            f"Frames: {counters.get('frames_in', 0)} recebidos, {counters.get('frames_out', 0)} enviados",
+            f"Bytes: {counters.get('bytes_in', 0)} recebidos, {counters.get('bytes_out', 0)} enviados",
+            f"Filas: {stats['queues']['total_depth']} frames pendentes (máx. {stats['queues']['max_depth']}), "
+            f"{stats['queues']['dropped']} descartados",
+        ]
+        fanout = histograms.get('fanout', {'count': 0})
+        if fanout['count']:
+            lines.append(f"Fan-out: p50 {fanout['p50']}, p99 {fanout['p99']}, máx. {fanout['max']}")
+        for name, histogram in histograms.items():
+            if name.startswith(('handler_us.', 'command_us.')):
+                lines.append(f"{name}: {histogram['count']}x, p50 {histogram['p50']}µs, "
+                             f"p99 {histogram['p99']}µs, máx. {histogram['max']}µs")
+        for group, info in stats['groups'].items():
+            lines.append(f"Grupo {group}: {info['messages']} mensagens, {info['members']} membros")
+        memory = stats['memory']
+        rss = f"RSS {memory['rss_kb'] // 1024} MiB, " if memory['rss_kb'] is not None else ""
+        lines.append(f"Memória: {rss}{memory['hot_messages']} mensagens em memória "
+                     f"(~{memory['hot_bytes'] // 1024} KiB), {memory['cold_messages']} no disco")
+        if 'heartbeat' in stats:
+            lines.append(f"Heartbeat: {stats['heartbeat']['watched']} conexões monitoradas, "
+                         f"{counters.get('pings', 0)} pings, {counters.get('reaped', 0)} derrubadas por inatividade")
+        delivery = stats['delivery']
+        if delivery['mailboxes']:
+            lines.append(f"Entrega: {delivery['pending']} mensagens sem ack em {delivery['mailboxes']} caixas, "
+                         f"{delivery['dropped']} descartadas, {counters.get('replayed', 0)} reenviadas, "
+                         f"{delivery['expired']} caixas expiradas")
+        if 'search' in stats:
+            search = stats['search']
+            lines.append(f"Índice de busca: {search['terms']} termos, {search['postings']} ocorrências, "
+                         f"{search['bytes'] // 1024} KiB" + (" (em construção)" if search['building'] else ""))
+        return "\n".join(lines) + "\n"
+
+    """
+    /search [-p página] <termos>: mensagens com todos os termos nas conversas do
+    usuário (grupos e privadas), da mais nova para a mais antiga, com o id de cada uma.
+    """
+    def _search_command(self, sender: str, group_name: str, args: list[str]) -> str:
+        if sender not in self.clients and not self.bus.remote(sender):
+            return None
+        if self.search is None:
+            return "Busca desativada no servidor."
+
+        terms = args[1:]
+        page = 1
+        if len(terms) >= 2 and terms[0] in ("-p", "--page"):
+            if not terms[1].isdigit() or int(terms[1]) < 1:
+                return "Página inválida."
+            page = int(terms[1])
+            terms = terms[2:]
+        query = " ".join(terms)
+        page_size = self.config.get("search", {}).get("page_size", 10)
+
+        chats = {}
+        for chat_type, chat, chat_log in self._chats_of(sender):
+            if chat_type == 'group':
+                chats[('group', chat)] = (chat, chat_log)
+            else:
+                chats[('individual', self.store.private_key(sender, chat))] = (f"@{chat}", chat_log)
+        hits, has_more = self.search.search(
+            [(key, chat_log) for key, (_, chat_log) in chats.items()],
+            query, (page - 1) * page_size, page_size
+        )
+
+        log.info("SEARCH", f"{sender} buscou '{query}'", hits=len(hits), page=page)
+        if not hits:
+            return "Nenhuma mensagem encontrada."
+        lines = ["", f"Resultados para '{query}' (página {page}):"]
+        for key, record in hits:
+            text = record.text if len(record.text) <= 80 else record.text[:77] + "..."
+            lines.append(f"[{chats[key][0]} #{record.id}] {record.sender} "
+                         f"({format_timestamp(int(record.created))}): {text}")
+        if has_more:
+            lines.append(f"Mais resultados: /search -p {page + 1} {query}")
+        return "\n".join(lines) + "\n"
+
+    def _get_message_by_id(self, group_name: str, message_id: int, sender: str) -> MessageRecord:
+        message = self.store.get_group_message(group_name, message_id)
+        if message is not None and message.sender == sender:
+            return message
+        return None
 
     """
     Reenvia uma mensagem para todos os membros de um grupo(usado para atualizar uma mensagem quando ela é apagada/editada)
     """
-    def _update_message(self, message: dict, group_name: str, sender: str):
-        for member in self.groups.get(group_name, set()):
-            if member in self.clients:
-                try:
-                    self.clients[member].send(json.dumps(message).encode('utf-8'))
-                    print(f"[MSG GRUPO] {group_name}: {sender} -> {member}")
-                except:
-                    self.handle_disconnect(member)
+    def _update_message(self, message: MessageRecord, group_name: str, sender: str):
+        self._fan_out(group_name, sender, message)
 
     """ 
     Retorna uma lista com o histórico de mensagens de um usuário em um grupo no seguinte formato:
         (id_mensagem, mensagem)
     """
     def _get_user_message_history(self, username: str, group_name: str) -> list[tuple]:
-        history = []
-        group = self.messages["group"][group_name]
-        for message in group:
-            if message["sender"] == username and not message.get("deleted", False):
-                message_data = (message["id"], message["message"]["message"])
-                history.append(message_data)
-
-        return history
+        return [
+            (message.id, message.text)
+            for message in self.store.sender_messages(group_name, username)
+            if not message.deleted
+        ]
 
     # Envia mensagem do servidor para um usuário
     def _send_private_message(self, receiver: str, message: str):
@@ -341,16 +1038,15 @@ class Server:
         self.broadcast(message_dict, sender="Server", group_name='individual')
 
     def start(self):
-        print(f"[SERVIDOR INICIADO] {self.host}:{self.port}")
+        log.info("SERVIDOR INICIADO", f"{self.host}:{self.port}", engine=self.engine, worker=self.worker_id,
+                 node=self.node_id)
         try:
-            while self.running:
-                conn, addr = self.server.accept()
-                thread = threading.Thread(target=self.handle_client, args=(conn, addr))
-                thread.daemon = True
-                thread.start()
-                print(f"[CONEXÕES ATIVAS] {threading.active_count() - 1}")
+            if self.engine == 'asyncio':
+                AsyncioEngine(self).run()
+            else:
+                self._accept_loop()
         except KeyboardInterrupt:
-            print("\n[DESLIGANDO SERVIDOR]")
+            log.info("DESLIGANDO SERVIDOR")
             self.running = False
             for client in list(self.clients.values()):
                 try:
@@ -358,7 +1054,81 @@ class Server:
                 except:
                     pass
             self.server.close()
+            self.bus.close()
+            self.commands.close()
+            self.command_pool.shutdown(wait=False)
+            if self.admin:
+                self.admin.close()
+            if self.persistence:
+                self.persistence.close()
+
+    """
+    No modo multiprocesso, espera todos os trabalhadores carregarem o estado e só
+    então passa a escutar, para o kernel distribuir as conexões entre todos.
+    """
+    def wait_start(self):
+        self.bus.wait_start()
+        self.server.listen()
+        if self.heartbeat is not None:
+            self.call_later(self.heartbeat.policy.tick, self._heartbeat_tick)
+
+    # Um tick da roda do heartbeat; reagenda a si mesmo (em timer ou no event loop)
+    def _heartbeat_tick(self):
+        try:
+            pings, _ = self.heartbeat.tick()
+            if pings:
+                self.metrics.incr('pings', pings)
+        except Exception as e:
+            log.error("ERRO HEARTBEAT", str(e), exc_info=True)
+        if self.running:
+            self.call_later(self.heartbeat.policy.tick, self._heartbeat_tick)
+
+    def _ping(self, username: str, conn):
+        if self.clients.get(username) is conn:
+            self._send_to(username, PING)
+
+    # Conexão sem nenhuma leitura há idle_timeout segundos (ex.: socket meio aberto)
+    def _reap(self, username: str, conn):
+        if self.clients.get(username) is not conn:
+            return
+        self.metrics.incr('reaped')
+        log.info("INATIVO", f"{username} sem resposta há {self.heartbeat.policy.idle_timeout}s, desconectando")
+        self.handle_disconnect(username)
+
+    # Engine padrão: uma thread por conexão
+    def _accept_loop(self):
+        self.wait_start()
+        while self.running:
+            conn, addr = self.server.accept()
+            thread = threading.Thread(target=self.handle_client, args=(conn, addr))
+            thread.daemon = True
+            thread.start()
+            log.debug("CONEXÕES ATIVAS", str(threading.active_count() - 1))
 
 if __name__ == "__main__":
-    server = Server()
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Servidor de mensageria")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--engine', choices=ENGINES, default='thread',
+                        help="thread: uma thread por conexão; asyncio: um único event loop")
+    parser.add_argument('--config', default="config/server.json")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processos trabalhadores na mesma porta, ligados por um barramento local")
+    parser.add_argument('--worker-id', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--bus', help=argparse.SUPPRESS)
+    parser.add_argument('--node', help="id deste nó em cluster.nodes da configuração (modo cluster)")
+    args = parser.parse_args()
+    if args.node is not None and args.workers > 1:
+        parser.error("--node e --workers não podem ser usados juntos")
+
+    if args.workers > 1 and args.bus is None:
+        with open(args.config, "r", encoding="utf-8") as f:
+            setup_logging(json.load(f).get("logging"), "hub")
+        supervise(lambda worker_id, bus_path: [
+            sys.executable, __file__, '--host', args.host, '--port', str(args.port), '--engine', args.engine,
+            '--config', args.config, '--worker-id', str(worker_id), '--bus', bus_path
+        ], args.workers)
+    else:
+        server = Server(args.host, args.port, engine=args.engine, config_path=args.config,
+                        worker_id=args.worker_id, bus_path=args.bus, node_id=args.node)
+        server.start()
@@ -0,0 +1,82 @@
+"""
+Endpoint HTTP de administração, para uso local (escuta em 127.0.0.1 por padrão):
+
+    GET /stats                          métricas do servidor em JSON
+    GET /profile?seconds=5&top=20       liga o profiler por amostragem pelo tempo
+                                        pedido e devolve as funções mais quentes
+
+Roda em threads próprias, fora das engines de mensagens.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from logger import get_logger
+from metrics import profile
+
+MAX_PROFILE_SECONDS = 60
+
+log = get_logger("admin")
+
+
+class AdminServer:
+    """`stats` é uma função sem argumentos que devolve o dicionário de métricas"""
+
+    def __init__(self, stats, host: str = '127.0.0.1', port: int = 5051):
+        self.stats = stats
+        self._profile_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    def _handler_class(self):
+        admin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == '/stats':
+                    self._reply(200, admin.stats())
+                elif url.path == '/profile':
+                    try:
+                        seconds = min(float(query.get('seconds', ['5'])[0]), MAX_PROFILE_SECONDS)
+                        top = int(query.get('top', ['20'])[0])
+                    except ValueError:
+                        self._reply(400, {'error': "parâmetros inválidos"})
+                        return
+                    # Um profiling por vez: amostras de dois ao mesmo tempo se misturariam
+                    if not admin._profile_lock.acquire(blocking=False):
+                        self._reply(409, {'error': "já existe um profiling em andamento"})
+                        return
+                    try:
+                        log.info("PROFILING", f"{seconds}s")
+                        self._reply(200, profile(seconds, top=top))
+                    finally:
+                        admin._profile_lock.release()
+                else:
+                    self._reply(404, {'error': "rota desconhecida", 'routes': ['/stats', '/profile']})
+
+            def _reply(self, status: int, body: dict):
+                payload = json.dumps(body, ensure_ascii=False, default=str).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                log.debug("ADMIN", format % args)
+
+        return Handler
+
+    @property
+    def address(self) -> tuple:
+        return self.httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        log.info("ADMIN", f"http://{self.address[0]}:{self.address[1]}/stats")
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from codec import parse_hello
+from dtos import OutboundPolicyDTO
+from framing import FrameDecoder, FrameTooLarge
+from logger import get_logger
+from outbound import OutboundQueue, SlowConsumerError, configure_socket
+
+log = get_logger("asyncio")
+
+
+class StreamConnection(OutboundQueue):
+    """
+    Conexão da engine asyncio: a fila é drenada por uma task escritora, que passa
+    ao transporte até max_batch frames por vez (após esperar flush_window, se
+    configurada). Como o event loop não pode bloquear, a política 'block' tolera
+    a fila acima do limite por até block_timeout segundos e só então desconecta
+    o cliente.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, policy: OutboundPolicyDTO):
+        super().__init__(policy)
+        self.writer = writer
+        self._full_since = None
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def send(self, data: bytes):
+        """Enfileira um frame já codificado"""
+        if self.closed or self.writer.is_closing():
+            raise ConnectionError("conexão encerrada")
+        self._admit()
+        if len(self._queue) < self.policy.max_queue:
+            self._full_since = None
+        self._queue.append(data)
+        self._wakeup.set()
+
+    def _wait_for_room(self):
+        now = time.monotonic()
+        if self._full_since is None:
+            self._full_since = now
+        elif now - self._full_since > self.policy.block_timeout:
+            raise SlowConsumerError(f"fila de saída cheia por mais de {self.policy.block_timeout}s")
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if self.policy.flush_window and len(self._queue) < self.policy.max_batch:
+                    await asyncio.sleep(self.policy.flush_window)
+                while self._queue and not self.closed:
+                    batch = self._take_batch()
+                    # Quantas chamadas de envio o lote custa é decisão do transporte (não
+                    # é visível daqui), então só o tamanho do lote entra nas métricas
+                    self.writer.writelines(batch)
+                    self._count_write(len(batch))
+                    await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        self.writer.close()
+
+
+class AsyncioEngine:
+    """
+    Engine alternativa ao thread-por-conexão: todas as conexões são atendidas
+    por um único event loop usando streams do asyncio. O estado e o tratamento
+    das mensagens continuam no Server, então as duas engines se comportam igual.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        # Timers do servidor (ex.: flush de presença) passam a rodar no event loop
+        self.server.call_later = lambda delay, fn: loop.call_soon_threadsafe(loop.call_later, delay, fn)
+        # Eventos do barramento (modo multiprocesso) também são aplicados no event loop
+        self.server.call_soon = loop.call_soon_threadsafe
+        await loop.run_in_executor(None, self.server.wait_start)
+        self.server.server.setblocking(False)
+        listener = await asyncio.start_server(self._handle_client, sock=self.server.server)
+        async with listener:
+            await listener.serve_forever()
+
+    async def _read_frame(self, reader: asyncio.StreamReader, decoder: FrameDecoder) -> bytes:
+        frame = decoder.next_frame()
+        while frame is None:
+            data = await reader.read(65536)
+            if not data:
+                return None
+            decoder.feed(data)
+            frame = decoder.next_frame()
+        return frame
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        server = self.server
+        addr = writer.get_extra_info('peername')
+        configure_socket(writer.get_extra_info('socket'), server.socket_options)
+        conn = StreamConnection(writer, server.outbound_policy)
+        decoder = FrameDecoder()
+        username = None
+        try:
+            # O primeiro frame da conexão traz o nome de usuário e os codecs aceitos
+            frame = await self._read_frame(reader, decoder)
+            username, codecs, resume = parse_hello(frame) if frame else (None, [], None)
+            if not username:
+                raise ValueError("Nome de usuário vazio")
+
+            server._register_client(username, conn, addr, codecs, resume)
+
+            while server.running:
+                try:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+
+                    conn.last_seen = time.monotonic()
+                    decoder.feed(data)
+                    for frame in decoder:
+                        data, delay = server._process_frame(username, frame, conn.codec)
+                        if delay:
+                            # Acima do limite de taxa: espera repor a ficha antes de tratar o frame
+                            # e, enquanto isso, não lê mais nada do socket
+                            await asyncio.sleep(delay)
+                        if data is not None:
+                            server._dispatch_frame(username, frame, data, conn.codec)
+
+                except FrameTooLarge as e:
+                    log.warning("ERRO FRAME", str(e), user=username)
+                    break
+                except Exception as e:
+                    log.error("ERRO CLIENTE", str(e), user=username)
+                    break
+
+        except Exception as e:
+            log.warning("ERRO CONEXÃO", str(e), addr=addr)
+        finally:
+            # Se a conexão já foi removida (ex.: cliente lento derrubado), não desconecta de novo
+            if username and server.clients.get(username) is conn:
+                server.handle_disconnect(username)
+            else:
+                conn.close()
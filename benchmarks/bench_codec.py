@@ -0,0 +1,68 @@
+"""
+Compara os codecs JSON e binário: tempo de codificação/decodificação e bytes
+no fio para os frames mais comuns (mensagem de grupo, mensagem enviada pelo
+cliente, delta de presença e página de histórico).
+
+    python benchmarks/bench_codec.py --iterations 20000 --page-size 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from codec import JSON, BinaryCodec, HistoryPage, Message
+from framing import HEADER_SIZE
+from message_store import MessageRecord
+
+
+def samples(page_size: int) -> list[tuple]:
+    """(nome, função que monta o objeto a enviar) para cada tipo de frame"""
+    records = [MessageRecord(i, f"usuario{i % 20}", f"mensagem de teste numero {i}", group="grupo1")
+               for i in range(page_size)]
+    client_message = {'type': 'group_message', 'group': 'grupo1',
+                      'message': 'mensagem de teste', 'timestamp': '12:00:00'}
+    delta = {'type': 'presence_delta', 'online': [f"usuario{i}" for i in range(10)],
+             'offline': ['usuario42'], 'groups_created': [], 'joined': {'grupo1': ['usuario3']}}
+    header = {'type': 'history_page', 'chat_type': 'group', 'chat': 'grupo1', 'has_more': True}
+    return [
+        # Registros guardam o frame em cache; aqui cada iteração usa um registro novo
+        ("mensagem de grupo", lambda: MessageRecord(7, "usuario7", "mensagem de teste", group="grupo1")),
+        ("mensagem do cliente", lambda: Message(client_message)),
+        ("delta de presença", lambda: Message(delta)),
+        (f"página de histórico ({page_size})", lambda: HistoryPage(header, records)),
+    ]
+
+
+def bench(codec, build, iterations: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        frame = build().frame(codec)
+    encode = (time.perf_counter() - start) / iterations
+
+    payload = frame[HEADER_SIZE:]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(payload)
+    decode = (time.perf_counter() - start) / iterations
+    return encode, decode, len(frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--compress-threshold', type=int, default=1024)
+    args = parser.parse_args()
+
+    codecs = [JSON, BinaryCodec(args.compress_threshold)]
+    print(f"{'frame':<28} {'codec':<7} {'codificar':>11} {'decodificar':>12} {'bytes':>7}")
+    for label, build in samples(args.page_size):
+        for codec in codecs:
+            encode, decode, size = bench(codec, build, args.iterations)
+            print(f"{label:<28} {codec.name:<7} {encode * 1e6:8.2f} µs {decode * 1e6:9.2f} µs {size:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Mede o custo do heartbeat com muitas conexões: tempo de cada tick da roda de
+temporização (p50/p99/máx.) e quantas conexões ele examina, comparado a
+percorrer todas as conexões a cada tick. O tempo é simulado, então dois
+minutos de servidor rodam em poucos segundos.
+
+    python benchmarks/bench_heartbeat.py --connections 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dtos import HeartbeatDTO
+from heartbeat import HeartbeatMonitor
+
+
+class FakeConnection:
+    __slots__ = ('last_seen', 'closed')
+
+    def __init__(self, now: float):
+        self.last_seen = now
+        self.closed = False
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--seconds', type=int, default=120, help="tempo simulado")
+    parser.add_argument('--active', type=float, default=0.2,
+                        help="fração das conexões que manda algo a cada segundo")
+    parser.add_argument('--dead', type=float, default=0.01, help="fração de sockets meio abertos")
+    parser.add_argument('--ping-interval', type=float, default=30)
+    parser.add_argument('--idle-timeout', type=float, default=90)
+    parser.add_argument('--tick-ms', type=float, default=1000)
+    args = parser.parse_args()
+
+    policy = HeartbeatDTO(args.ping_interval, args.idle_timeout, args.tick_ms / 1000)
+    counts = {'pings': 0, 'reaped': 0}
+    monitor = HeartbeatMonitor(policy, lambda username, conn: None, lambda username, conn: None)
+    rng = random.Random(42)
+    now = time.monotonic()
+
+    start = time.perf_counter()
+    connections = [FakeConnection(now) for _ in range(args.connections)]
+    for i, conn in enumerate(connections):
+        monitor.watch(f"usuario{i}", conn)
+    print(f"watch: {(time.perf_counter() - start) / args.connections * 1e6:.2f} µs por conexão")
+
+    alive = connections[:int(len(connections) * (1 - args.dead))]
+    per_tick = int(len(alive) * args.active * policy.tick)
+    wheel_times, scan_times = [], []
+    for step in range(1, int(args.seconds / policy.tick) + 1):
+        now += policy.tick
+        # Atividade: só atualiza last_seen, como a leitura do socket faz
+        for conn in rng.sample(alive, per_tick):
+            conn.last_seen = now
+        start = time.perf_counter()
+        pings, reaped = monitor.tick(now)
+        wheel_times.append(time.perf_counter() - start)
+        counts['pings'] += pings
+        counts['reaped'] += reaped
+
+        # Alternativa ingênua: olhar todas as conexões a cada tick
+        start = time.perf_counter()
+        idle = 0
+        for conn in connections:
+            if now - conn.last_seen >= policy.ping_interval:
+                idle += 1
+        scan_times.append(time.perf_counter() - start)
+
+    for label, samples in (("roda", wheel_times), ("varredura", scan_times)):
+        print(f"{label:<10} tick p50 {percentile(samples, 0.5) * 1e3:7.2f} ms  "
+              f"p99 {percentile(samples, 0.99) * 1e3:7.2f} ms  máx. {max(samples) * 1e3:7.2f} ms  "
+              f"({sum(samples) / args.seconds * 1e3:.1f} ms de CPU por segundo)")
+    print(f"{counts['pings']} pings, {counts['reaped']} derrubadas "
+          f"(esperado {len(connections) - len(alive)}), {len(monitor)} monitoradas")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compara a memória por mensagem do histórico antigo (listas de dicionários)
+com o MessageStore (registros com __slots__ e nomes internados).
+
+    python benchmarks/bench_message_store.py --messages 200000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from message_store import MessageStore
+
+
+def sample(i: int, senders: int, groups: int):
+    # Nomes montados em tempo de execução, como chegam do socket (não internados)
+    sender = "".join(["usuario", str(i % senders)])
+    group = "".join(["grupo", str(i % groups)])
+    return sender, group, f"mensagem de teste numero {i}"
+
+
+def build_dicts(count: int, senders: int, groups: int) -> dict:
+    """Formato anterior: {'group': {nome: [dict]}} com o dicionário do cliente aninhado"""
+    messages = {'individual': {}, 'group': {}}
+    for i in range(count):
+        sender, group, text = sample(i, senders, groups)
+        msgs = messages['group'].setdefault(group, [])
+        msgs.append({
+            'type': 'group_message',
+            'sender': sender,
+            'message': {'type': 'group_message', 'group': group, 'message': text, 'timestamp': '12:00:00'},
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'group': group,
+            'id': len(msgs)
+        })
+    return messages
+
+
+def build_store(count: int, senders: int, groups: int, with_frames: bool) -> MessageStore:
+    store = MessageStore()
+    for i in range(count):
+        sender, group, text = sample(i, senders, groups)
+        record = store.append_group(group, sender, text)
+        if with_frames:
+            record.frame()
+    return store
+
+
+def measure(label: str, count: int, build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<34} {current / count:8.1f} bytes/msg  {current / 2**20:8.1f} MiB  {elapsed:6.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--senders', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{args.messages} mensagens, {args.senders} remetentes, {args.groups} grupos")
+    measure("dicionários (formato anterior)", args.messages,
+            lambda: build_dicts(args.messages, args.senders, args.groups))
+    measure("MessageStore", args.messages,
+            lambda: build_store(args.messages, args.senders, args.groups, False))
+    store = measure("MessageStore + frames em cache", args.messages,
+                    lambda: build_store(args.messages, args.senders, args.groups, True))
+
+    # Busca por id e histórico por remetente
+    start = time.perf_counter()
+    for i in range(10000):
+        store.get_group_message(f"grupo{i % args.groups}", i // args.groups)
+    lookup = (time.perf_counter() - start) / 10000
+    start = time.perf_counter()
+    store.sender_messages("grupo0", "usuario0")
+    history = time.perf_counter() - start
+    print(f"busca por id: {lookup * 1e6:.2f} µs   histórico de um remetente: {history * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Mede o índice de busca do /search: custo de indexar cada mensagem nova,
+tempo da construção inicial (histórico já existente), memória do índice e
+latência das consultas (p50/p99) sobre todos os grupos.
+
+    python benchmarks/bench_search.py --messages 1000000
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from message_store import MessageStore
+from search_index import SearchIndex
+
+
+def vocabulary(size: int) -> tuple:
+    words = [f"palavra{i}" for i in range(size)]
+    # Frequência de Zipf: poucas palavras muito comuns, muitas raras
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(size)))
+    return words, weights
+
+
+def build_store(count: int, groups: int, words: list, weights: list, index: SearchIndex = None) -> MessageStore:
+    rng = random.Random(42)
+    store = MessageStore()
+    if index is not None:
+        index.attach(store)
+    for i in range(count):
+        text = " ".join(rng.choices(words, cum_weights=weights, k=8))
+        store.append_group(f"grupo{i % groups}", f"usuario{i % 1000}", text)
+    return store
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--words', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+    words, weights = vocabulary(args.words)
+    print(f"{args.messages} mensagens, {args.groups} grupos, vocabulário de {args.words} palavras")
+
+    # Indexação a cada mensagem nova (dentro do append)
+    start = time.perf_counter()
+    build_store(args.messages, args.groups, words, weights)
+    plain = time.perf_counter() - start
+    index = SearchIndex()
+    start = time.perf_counter()
+    build_store(args.messages, args.groups, words, weights, index)
+    indexed = time.perf_counter() - start
+    print(f"append sem índice: {plain / args.messages * 1e6:6.2f} µs/msg   "
+          f"com índice: {indexed / args.messages * 1e6:6.2f} µs/msg")
+
+    # Construção inicial sobre um histórico já carregado
+    store = build_store(args.messages, args.groups, words, weights)
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.attach(store)
+    while index.building:
+        time.sleep(0.01)
+    print(f"construção inicial: {time.perf_counter() - start:.2f}s")
+
+    stats = index.stats()
+    print(f"memória do índice: {stats['bytes'] / 2**20:.1f} MiB ({stats['bytes'] / args.messages:.1f} bytes/msg), "
+          f"{stats['terms']} termos, {stats['postings']} ocorrências")
+
+    chats = [(('group', name), log) for name, log in store.groups.items()]
+    rng = random.Random(7)
+    queries = {
+        "termo comum": lambda: words[rng.randrange(3)],
+        "termo raro": lambda: words[rng.randrange(args.words // 2, args.words)],
+        "comum + médio": lambda: f"{words[rng.randrange(3)]} {words[rng.randrange(50, 500)]}",
+        "dois médios": lambda: f"{words[rng.randrange(50, 500)]} {words[rng.randrange(50, 500)]}",
+        "inexistente": lambda: "naoexiste",
+    }
+    for label, make_query in queries.items():
+        for page in (1, 10):
+            latencies = []
+            for _ in range(args.queries):
+                query = make_query()
+                start = time.perf_counter()
+                index.search(chats, query, (page - 1) * 10, 10)
+                latencies.append(time.perf_counter() - start)
+            print(f"{label:<14} página {page:<2}  p50 {percentile(latencies, 0.5) * 1e3:7.2f} ms  "
+                  f"p99 {percentile(latencies, 0.99) * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Mede o tempo de inicialização do servidor com histórico persistido:
+carga do snapshot via mmap + replay do final do log, comparado com o replay
+do log inteiro (sem snapshot).
+
+    python benchmarks/bench_startup.py --messages 10000000 --tail 100000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from message_store import MessageStore
+from persistence import Persistence
+
+
+def open_store(directory: str, snapshot_every: int = 10**12):
+    store = MessageStore()
+    persistence = Persistence(directory, store, {}, fsync='none', snapshot_every=snapshot_every)
+    stats = persistence.recover()
+    return store, persistence, stats
+
+
+def populate(directory: str, messages: int, tail: int, groups: int, users: int, snapshot: bool):
+    store, persistence, _ = open_store(directory)
+    for g in range(groups):
+        store.create_group(f"grupo{g}")
+
+    def write(start, stop):
+        for i in range(start, stop):
+            sender = f"usuario{i % users}"
+            if i % 10 == 0:
+                store.append_private(sender, f"usuario{(i + 1) % users}", f"privada {i}")
+            else:
+                record = store.append_group(f"grupo{i % groups}", sender, f"mensagem de teste numero {i}")
+                if i % 1000 == 1:
+                    store.edit(record, "editada")
+
+    start = time.perf_counter()
+    write(0, messages - tail)
+    if snapshot:
+        persistence.snapshot()
+    write(messages - tail, messages)
+    persistence.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--tail', type=int, default=10000, help="mensagens gravadas depois do snapshot")
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--dir', default=None, help="diretório de dados (padrão: temporário)")
+    args = parser.parse_args()
+
+    base = args.dir or tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        for snapshot in (True, False):
+            directory = os.path.join(base, "snapshot" if snapshot else "wal_only")
+            shutil.rmtree(directory, ignore_errors=True)
+            write_time = populate(directory, args.messages, args.tail, args.groups, args.users, snapshot)
+            size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+            store, persistence, stats = open_store(directory)
+            first = time.perf_counter()
+            store.get_group_message("grupo1", 0).frame()
+            store.sender_messages("grupo1", "usuario1")
+            first_access = time.perf_counter() - first
+            persistence.close()
+
+            label = "snapshot + final do log" if snapshot else "apenas log"
+            print(f"{label}: {args.messages} mensagens ({size / 2**20:.1f} MiB em disco, gravadas em {write_time:.1f}s)")
+            print(f"  inicialização: {stats['seconds']:.3f}s "
+                  f"({stats['snapshot_messages']} do snapshot, {stats['replayed']} registros reaplicados)")
+            print(f"  primeiro acesso (mensagem + histórico de um remetente): {first_access * 1000:.2f} ms")
+            if len(store) != args.messages:
+                print(f"  ERRO: {len(store)} mensagens recuperadas")
+    finally:
+        if args.dir is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+Gerador de carga sem interface gráfica. Sobe um servidor local (subprocesso),
+conecta N usuários simulados que entram em grupos, trocam mensagens privadas
+e de grupo em uma taxa fixa e usam /history, /edit e /delete.
+
+Mede vazão, latência de fan-out (do envio até a entrega em cada destinatário),
+tempo de conexão e memória do servidor, e grava o resultado em JSON para
+comparar engines, codecs e commits.
+
+    python benchmarks/loadgen.py --users 200 --groups 10 --rate 5 --duration 30 --engine asyncio
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from client_core import create_group, group_message, invite, invite_answer, private_message
+from codec import CODEC_NAMES, JSON, build_codecs, hello_frame
+from framing import FrameDecoder
+
+MARKER = "lg"
+
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p95/p99 e máximo em milissegundos"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50), 3),
+        'p95_ms': round(pick(0.95), 3),
+        'p99_ms': round(pick(0.99), 3),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.connect = []
+        self.latency = []
+        self.sent = 0
+        self.delivered = 0
+        self.commands = 0
+
+
+class SimulatedUser:
+    """
+    Um usuário simulado. Usa as mensagens montadas pelo client_core, mas com
+    transporte asyncio para simular centenas de usuários em um único processo.
+    """
+
+    def __init__(self, name: str, codec_name: str, stats: Stats):
+        self.name = name
+        self.codec_name = codec_name
+        self.codec = JSON
+        self.stats = stats
+        self.decoder = FrameDecoder()
+        self.groups = ['Geral']
+        self.own_ids = {}  # {grupo: [ids de mensagens próprias ainda não apagadas]}
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host: str, port: int):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(hello_frame(self.name, [self.codec_name]))
+        ack = json.loads((await self._read_frame()).decode('utf-8'))
+        self.codec = build_codecs({'enabled': CODEC_NAMES}).get(ack.get('codec'), JSON)
+        self.stats.connect.append(time.perf_counter() - start)
+
+    async def _read_frame(self) -> bytes:
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("conexão encerrada pelo servidor")
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    def send(self, data: dict):
+        self.writer.write(self.codec.frame(data))
+
+    async def receive_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    return
+                self.decoder.feed(data)
+                now = time.perf_counter()
+                for frame in self.decoder:
+                    self._handle(self.codec.decode(frame), now)
+        except (ConnectionError, asyncio.CancelledError):
+            return
+
+    def _handle(self, message: dict, now: float):
+        msg_type = message.get('type')
+        if msg_type in ('group_message', 'private_message'):
+            text = message.get('message', {}).get('message', '')
+            parts = text.split(' ', 2)
+            if parts[0] == MARKER and len(parts) > 1 and not message.get('edited'):
+                self.stats.delivered += 1
+                self.stats.latency.append(now - float(parts[1]))
+            if msg_type == 'group_message' and message.get('sender') == self.name and not message.get('deleted'):
+                ids = self.own_ids.setdefault(message['group'], [])
+                if not ids or ids[-1] != message['id']:
+                    ids.append(message['id'])
+        elif msg_type == 'ping':
+            self.send({'type': 'pong'})
+        elif msg_type == 'group_invite':
+            self.groups.append(message['group_name'])
+            self.send(invite_answer(message['group_name'], self.name, True))
+
+    def send_group(self, group: str):
+        self.send(group_message(group, f"{MARKER} {time.perf_counter():.6f} mensagem de {self.name}"))
+        self.stats.sent += 1
+
+    def send_private(self, recipient: str):
+        self.send(private_message(recipient, f"{MARKER} {time.perf_counter():.6f} oi"))
+        self.stats.sent += 1
+
+    def send_command(self, group: str):
+        ids = self.own_ids.get(group)
+        choice = random.choice(('history', 'edit', 'delete')) if ids else 'history'
+        if choice == 'history':
+            command = "/history"
+        elif choice == 'edit':
+            command = f"/edit {random.choice(ids)} editada"
+        else:
+            command = f"/delete {ids.pop(random.randrange(len(ids)))}"
+        self.send(group_message(group, command))
+        self.stats.commands += 1
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def run_user(user: SimulatedUser, names: list[str], args, deadline: float):
+    interval = 1.0 / args.rate
+    await asyncio.sleep(random.random() * interval)
+    while time.perf_counter() < deadline:
+        roll = random.random()
+        if roll < args.command_ratio:
+            user.send_command(random.choice(user.groups))
+        elif roll < args.command_ratio + args.private_ratio:
+            user.send_private(random.choice([n for n in random.sample(names, 2) if n != user.name]))
+        else:
+            user.send_group(random.choice(user.groups))
+        await user.writer.drain()
+        await asyncio.sleep(interval)
+
+
+async def run_load(args, ports: list[int]) -> Stats:
+    stats = Stats()
+    names = [f"user{i}" for i in range(args.users)]
+    users = [SimulatedUser(name, args.codec, stats) for name in names]
+
+    # Conexões em lotes para não estourar o backlog do listen
+    # No modo cluster os usuários são distribuídos entre os nós
+    for start in range(0, len(users), args.connect_batch):
+        await asyncio.gather(*(u.connect(args.host, ports[(start + i) % len(ports)])
+                               for i, u in enumerate(users[start:start + args.connect_batch])))
+    receivers = [asyncio.create_task(u.receive_loop()) for u in users]
+
+    # Os primeiros usuários criam os grupos e convidam os demais (que aceitam ao receber o convite)
+    for g in range(min(args.groups, len(users))):
+        owner = users[g]
+        group_name = f"lg-grupo{g}"
+        owner.send(create_group(group_name))
+        owner.groups.append(group_name)
+        for user in users[g + args.groups::args.groups]:
+            owner.send(invite(group_name, user.name))
+    await asyncio.sleep(args.settle)
+
+    deadline = time.perf_counter() + args.duration
+    await asyncio.gather(*(run_user(u, names, args, deadline) for u in users))
+    # Espera as últimas entregas
+    await asyncio.sleep(args.settle)
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*(u.close() for u in users))
+    return stats
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(pid: int) -> dict:
+    """RSS atual e pico do processo em KiB e tempo de CPU gasto até agora (Linux, via /proc)"""
+    rss = {}
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+            # utime e stime vêm depois do nome do processo (que pode ter espaços)
+            fields = f.read().rsplit(")", 1)[1].split()
+        rss['cpu_s'] = round((int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), 2)
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss['rss_kb'] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    rss['peak_rss_kb'] = int(line.split()[1])
+    except OSError:
+        pass
+    return rss
+
+
+def child_pids(pid: int) -> list[int]:
+    """Processos filhos (no modo multiprocesso, os trabalhadores do supervisor), via /proc"""
+    pids = []
+    for path in glob.glob(f"/proc/{pid}/task/*/children"):
+        try:
+            with open(path, encoding="utf-8") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return sorted(pids)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def server_stats(host: str, admin_port: int) -> dict:
+    """Métricas internas do servidor pelo endpoint de administração"""
+    try:
+        with urllib.request.urlopen(f"http://{host}:{admin_port}/stats", timeout=5) as response:
+            return json.load(response)
+    except OSError:
+        return None
+
+
+def start_server(args, port: int, admin_port: int, workdir: str, node: str = None,
+                 cluster: dict = None) -> subprocess.Popen:
+    with open(os.path.join(ROOT, "config", "server.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    config.setdefault("persistence", {})
+    config["persistence"]["enabled"] = not args.no_persistence
+    config["persistence"]["directory"] = os.path.join(workdir, "data")
+    # Cada trabalhador (ou nó do cluster) usa a porta de administração base + o seu índice
+    config["admin"] = {"enabled": True, "host": args.host, "port": admin_port}
+    # O binário é opcional no servidor: habilita o codec pedido em --codec
+    enabled = config.setdefault("codec", {}).setdefault("enabled", ["json"])
+    if args.codec not in enabled:
+        enabled.append(args.codec)
+    config.setdefault("outbound", {})
+    if args.flush_window_ms is not None:
+        config["outbound"]["flush_window_ms"] = args.flush_window_ms
+    if args.max_batch is not None:
+        config["outbound"]["max_batch"] = args.max_batch
+    command = [sys.executable, "SERVIDOR.py", "--host", args.host, "--port", str(port),
+               "--engine", args.engine, "--workers", str(args.workers)]
+    if node is not None:
+        config["cluster"] = {"nodes": cluster}
+        command += ["--node", node]
+    config_path = os.path.join(workdir, f"server-{node}.json" if node else "server.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+
+    server = subprocess.Popen(command + ["--config", config_path],
+                              cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, port), timeout=0.2).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("o servidor encerrou durante a inicialização")
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("o servidor não começou a ouvir a tempo")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--groups', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=2.0, help="mensagens por segundo por usuário")
+    parser.add_argument('--duration', type=float, default=10.0, help="segundos de carga")
+    parser.add_argument('--private-ratio', type=float, default=0.2)
+    parser.add_argument('--command-ratio', type=float, default=0.05)
+    parser.add_argument('--settle', type=float, default=1.0, help="espera após montar os grupos e ao final")
+    parser.add_argument('--connect-batch', type=int, default=50)
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--workers', type=int, default=1, help="processos do servidor (modo multiprocesso)")
+    parser.add_argument('--nodes', type=int, default=1, help="servidores ligados em cluster (modo cluster)")
+    parser.add_argument('--codec', choices=('json', 'binary'), default='json')
+    parser.add_argument('--flush-window-ms', type=float, help="janela de flush da fila de saída (padrão: a do config)")
+    parser.add_argument('--max-batch', type=int, help="frames por escrita no socket (padrão: o do config)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--no-persistence', action='store_true')
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: loadgen-<engine>-<codec>.json)")
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error("--users precisa ser pelo menos 2")
+    if args.nodes > 1 and args.workers > 1:
+        parser.error("--nodes e --workers não podem ser usados juntos")
+
+    admin_port = free_port()
+    ports = [free_port() for _ in range(args.nodes)]
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.nodes > 1:
+            # Ids com largura fixa: a ordem alfabética (usada nas portas de administração) é a dos índices
+            cluster = {f"n{i:02d}": f"{args.host}:{free_port()}" for i in range(args.nodes)}
+            servers = [start_server(args, port, admin_port, workdir, node, cluster)
+                       for port, node in zip(ports, sorted(cluster))]
+            # Espera as ligações entre os nós antes de conectar os usuários
+            time.sleep(2)
+        else:
+            servers = [start_server(args, ports[0], admin_port, workdir)]
+        try:
+            start = time.perf_counter()
+            stats = asyncio.run(run_load(args, ports))
+            elapsed = time.perf_counter() - start
+            if args.workers > 1:
+                # O supervisor só roda o hub: a memória que importa é a de cada trabalhador
+                rss = {'supervisor_rss': read_rss(servers[0].pid),
+                       'worker_rss': [read_rss(pid) for pid in child_pids(servers[0].pid)]}
+            elif len(servers) == 1:
+                rss = read_rss(servers[0].pid)
+            else:
+                rss = {'node_rss': [read_rss(server.pid) for server in servers]}
+            internal = [server_stats(args.host, admin_port + i) for i in range(max(args.workers, args.nodes))]
+        finally:
+            for server in servers:
+                server.terminate()
+            for server in servers:
+                server.wait()
+
+    # Chamadas de envio (sendmsg) do servidor por mensagem entregue e por frame enviado;
+    # só a engine thread as conta (na asyncio quem escreve no socket é o transporte)
+    counters = [(server or {}).get('counters', {}) for server in internal]
+    syscalls = sum(c.get('send_syscalls', 0) for c in counters) if args.engine == 'thread' else None
+    frames_out = sum(c.get('frames_out', 0) for c in counters)
+    result = {
+        'commit': git_commit(),
+        'engine': args.engine,
+        'workers': args.workers,
+        'nodes': args.nodes,
+        'codec': args.codec,
+        'flush_window_ms': args.flush_window_ms,
+        'max_batch': args.max_batch,
+        'users': args.users,
+        'groups': args.groups,
+        'rate': args.rate,
+        'duration': args.duration,
+        'persistence': not args.no_persistence,
+        'sent': stats.sent,
+        'commands': stats.commands,
+        'delivered': stats.delivered,
+        'sent_per_second': round(stats.sent / args.duration, 1),
+        'delivered_per_second': round(stats.delivered / args.duration, 1),
+        'elapsed_seconds': round(elapsed, 2),
+        'connect': percentiles(stats.connect),
+        'fanout_latency': percentiles(stats.latency),
+        'send_syscalls': syscalls,
+        'syscalls_per_delivered': round(syscalls / stats.delivered, 3) if syscalls is not None and stats.delivered else None,
+        'syscalls_per_frame': round(syscalls / frames_out, 3) if syscalls is not None and frames_out else None,
+        **rss,
+        'server': internal
+    }
+    output = args.output or f"loadgen-{args.engine}-{args.codec}-w{args.workers}-n{args.nodes}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Resultado gravado em {output}")
+
+
+if __name__ == "__main__":
+    main()
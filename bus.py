@@ -0,0 +1,316 @@
+"""
+Modo multiprocesso: N processos trabalhadores aceitam conexões na mesma porta
+(SO_REUSEPORT) e são ligados por um barramento local em socket Unix.
+
+O hub, no processo supervisor, recebe os eventos de todos os trabalhadores
+(mensagens dos clientes, conexões e desconexões) e repassa cada um a todos os
+trabalhadores, na mesma ordem. Cada trabalhador mantém uma réplica completa
+do estado (grupos, membros, histórico, presença, cursores de leitura) e aplica
+os eventos nessa ordem, então os ids das mensagens são os mesmos em todas as
+réplicas. As entregas só acontecem para os usuários conectados ao próprio
+trabalhador, de modo que o I/O do fan-out fica dividido entre os processos.
+O tratamento dos eventos não: cada trabalhador repete todo ele na sua réplica,
+e esse custo não cai com mais trabalhadores (para dividi-lo, ver cluster.py).
+
+Só o trabalhador 0 grava o histórico em disco; os demais apenas leem os
+arquivos na inicialização, antes de o hub liberar as conexões.
+
+Evento no barramento (um frame de framing.py):
+    [tipo: 1 byte][horário: float64][tamanho do usuário: 1 byte][usuário][corpo]
+"""
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+from codec import CODEC_NAMES
+from framing import MAX_FRAME_SIZE, FrameDecoder, encode_frame
+from logger import get_logger, shutdown_logging
+
+EV_READY = 1          # trabalhador → hub: estado carregado, pronto para aceitar conexões
+EV_START = 2          # hub → trabalhadores: todos prontos
+EV_FRAME = 3          # frame de um cliente (corpo: índice do codec + payload)
+EV_CONNECTED = 4
+EV_DISCONNECTED = 5   # corpo: marcas de leitura do login, em JSON (vazio se não houver)
+
+HEADER = struct.Struct("!BdB")
+# Um frame de cliente do tamanho máximo ainda cabe em um evento
+MAX_EVENT_SIZE = MAX_FRAME_SIZE + 1024
+
+log = get_logger("barramento")
+
+
+def encode_event(kind: int, username: str = '', body: bytes = b'', created: float = 0.0) -> bytes:
+    name = username.encode('utf-8')
+    return encode_frame(HEADER.pack(kind, created, len(name)) + name + body, MAX_EVENT_SIZE)
+
+
+def decode_event(payload: bytes) -> tuple:
+    """(tipo, horário, usuário, corpo)"""
+    kind, created, size = HEADER.unpack_from(payload)
+    start = HEADER.size
+    return kind, created, payload[start:start + size].decode('utf-8'), payload[start + size:]
+
+
+class LocalBus:
+    """Barramento do modo de processo único: os eventos são aplicados na hora, na thread de quem publica"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def publish_frame(self, username: str, codec, frame: bytes, data: dict):
+        self.server._apply_frame(username, data)
+
+    def connected(self, username: str):
+        self.server._user_online(username)
+
+    def disconnected(self, username: str, marks: dict):
+        self.server._user_offline(username, marks)
+
+    def gather_chats(self, username: str, callback):
+        """Metadados das conversas para o connection_ack (no cluster, vêm de todos os nós)"""
+        callback(username, self.server._chat_meta(username))
+
+    # Sem cluster toda conversa é deste processo e não há usuários em outros nós
+    def owns_group(self, group_name: str) -> bool:
+        return True
+
+    def owns_private(self, user_a: str, user_b: str) -> bool:
+        return True
+
+    def remote(self, username: str) -> bool:
+        return False
+
+    def forward(self, usernames, message) -> bool:
+        return False
+
+    def relay(self, username: str, data: dict):
+        pass
+
+    def group_created(self, group_name: str, owner: str):
+        pass
+
+    def member_joined(self, group_name: str, username: str):
+        pass
+
+    def wait_start(self):
+        pass
+
+    def stats(self) -> dict:
+        return None
+
+    def close(self):
+        pass
+
+
+class ProcessBus(LocalBus):
+    """
+    Ligação de um trabalhador com o hub. Publicar só enfileira o evento (uma
+    thread escritora envia); a thread leitora entrega os eventos ao servidor
+    por server.call_soon, que na engine asyncio os leva para o event loop.
+    Cada trabalhador tem a réplica completa, então o roteamento é o do LocalBus.
+    """
+
+    def __init__(self, server, path: str, worker_id: int):
+        self.server = server
+        self.worker_id = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._outbox = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._started = threading.Event()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _publish(self, kind: int, username: str = '', body: bytes = b''):
+        event = encode_event(kind, username, body, time.time())
+        with self._cond:
+            self._outbox.append(event)
+            self._cond.notify()
+
+    def publish_frame(self, username: str, codec, frame: bytes, data: dict):
+        # Repassa o payload original; cada réplica decodifica com o mesmo codec
+        self._publish(EV_FRAME, username, bytes((CODEC_NAMES.index(codec.name),)) + frame)
+
+    def connected(self, username: str):
+        self._publish(EV_CONNECTED, username)
+
+    def disconnected(self, username: str, marks: dict):
+        body = b''
+        if marks is not None:
+            body = json.dumps([[chat_type, chat, last_id] for (chat_type, chat), last_id in marks.items()]).encode('utf-8')
+        self._publish(EV_DISCONNECTED, username, body)
+
+    def wait_start(self):
+        """Avisa o hub que este trabalhador está pronto e espera a liberação"""
+        self._publish(EV_READY, str(self.worker_id))
+        self._started.wait()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._outbox and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                pending, self._outbox = self._outbox, []
+            try:
+                self.sock.sendall(b''.join(pending))
+            except OSError as e:
+                self._lost(str(e))
+                return
+
+    def _read_loop(self):
+        decoder = FrameDecoder(MAX_EVENT_SIZE)
+        try:
+            while True:
+                data = self.sock.recv(262144)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in decoder:
+                    kind, created, username, body = decode_event(frame)
+                    if kind == EV_START:
+                        self._started.set()
+                    else:
+                        self.server.call_soon(self._apply, kind, created, username, body)
+        except OSError as e:
+            self._lost(str(e))
+            return
+        self._lost("hub encerrou a conexão")
+
+    def _apply(self, kind: int, created: float, username: str, body: bytes):
+        try:
+            if kind == EV_FRAME:
+                codec = self.server.codecs[CODEC_NAMES[body[0]]]
+                self.server._apply_frame(username, codec.decode(body[1:]), created)
+            elif kind == EV_CONNECTED:
+                self.server._user_online(username, created)
+            elif kind == EV_DISCONNECTED:
+                marks = {(chat_type, chat): last_id for chat_type, chat, last_id in json.loads(body)} if body else None
+                self.server._user_offline(username, marks, created)
+        except Exception as e:
+            log.error("ERRO EVENTO", str(e), exc_info=True, kind=kind, user=username)
+
+    def _lost(self, reason: str):
+        if self._closed:
+            return
+        # Sem o barramento a réplica deixa de acompanhar as demais: o trabalhador encerra
+        log.error("BARRAMENTO", f"Conexão com o hub perdida: {reason}", worker=self.worker_id)
+        shutdown_logging()
+        os._exit(1)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.sock.close()
+
+
+class BusHub:
+    """Repassa cada evento recebido a todos os trabalhadores, na ordem de chegada"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writers = []
+        self.ready = 0
+        self._ready_changed = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.append(writer)
+        decoder = FrameDecoder(MAX_EVENT_SIZE)
+        try:
+            while True:
+                data = await reader.read(262144)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in decoder:
+                    if frame[0] == EV_READY:
+                        self.ready += 1
+                        self._ready_changed.set()
+                        continue
+                    packed = encode_frame(frame, MAX_EVENT_SIZE)
+                    for target in self.writers:
+                        target.write(packed)
+        finally:
+            self.writers.remove(writer)
+            writer.close()
+
+    async def wait_ready(self, count: int):
+        while self.ready < count:
+            self._ready_changed.clear()
+            await self._ready_changed.wait()
+
+    def start_workers(self):
+        packed = encode_event(EV_START)
+        for writer in self.writers:
+            writer.write(packed)
+
+    def close(self):
+        self.server.close()
+
+
+def supervise(worker_command, workers: int):
+    """
+    Processo supervisor: sobe o hub e os trabalhadores (`worker_command(id, caminho_do_barramento)`
+    devolve a linha de comando de cada um). Se um trabalhador cai, encerra todos:
+    sem ele as réplicas deixariam de receber os mesmos eventos.
+    """
+    directory = tempfile.mkdtemp(prefix="mensageria-")
+    try:
+        asyncio.run(_supervise(worker_command, workers, os.path.join(directory, "bus.sock")))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+async def _supervise(worker_command, workers: int, path: str):
+    # SIGTERM encerra os trabalhadores junto com o supervisor
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    hub = BusHub(path)
+    await hub.start()
+    processes = []
+    try:
+        # O trabalhador 0 grava o log: recupera (e repara o final do WAL) antes de os outros lerem os arquivos
+        processes.append(await asyncio.create_subprocess_exec(*worker_command(0, path)))
+        await _until_ready(hub, 1, processes)
+        for worker_id in range(1, workers):
+            processes.append(await asyncio.create_subprocess_exec(*worker_command(worker_id, path)))
+        await _until_ready(hub, workers, processes)
+
+        hub.start_workers()
+        log.info("SUPERVISOR", f"{workers} trabalhadores prontos", pids=[p.pid for p in processes])
+
+        waits = [asyncio.create_task(p.wait()) for p in processes]
+        await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        log.error("SUPERVISOR", "Um trabalhador encerrou; encerrando os demais",
+                  codes=[p.returncode for p in processes])
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        for process in processes:
+            await process.wait()
+        hub.close()
+
+
+async def _until_ready(hub: BusHub, count: int, processes: list):
+    ready = asyncio.create_task(hub.wait_ready(count))
+    exits = [asyncio.create_task(p.wait()) for p in processes]
+    done, _ = await asyncio.wait([ready] + exits, return_when=asyncio.FIRST_COMPLETED)
+    for task in exits:
+        task.cancel()
+    if ready not in done:
+        ready.cancel()
+        raise RuntimeError("um trabalhador encerrou durante a inicialização")
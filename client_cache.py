@@ -0,0 +1,124 @@
+"""
+Cache local do histórico do cliente (sqlite3), um arquivo por usuário e servidor.
+
+Para cada conversa o cache guarda um intervalo contínuo de ids
+[first_id, last_id] e a revisão de edições já aplicada. Na reconexão o
+cliente pede apenas o que veio depois de last_id e as edições posteriores à
+revisão; ao abrir uma conversa as mensagens são lidas daqui, e o servidor só
+é consultado para o que está fora do intervalo.
+"""
+import json
+import os
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chats (
+    chat TEXT PRIMARY KEY,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    edits INTEGER NOT NULL
+);
+"""
+
+
+def default_path(username: str, host: str, port: int) -> str:
+    directory = os.path.join(os.path.expanduser("~"), ".mensageria")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{username}@{host}_{port}.sqlite3")
+
+
+class HistoryCache:
+    """
+    Acesso ao cache. Não é thread-safe: deve ser usado sempre pela mesma
+    thread (na interface Tk, a thread que processa os eventos). As escritas
+    ficam na transação corrente até flush().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._dirty = False
+
+    def cursors(self) -> dict:
+        """{chat: (first_id, last_id, edits)} de todas as conversas em cache"""
+        rows = self.db.execute("SELECT chat, first_id, last_id, edits FROM chats")
+        return {chat: (first_id, last_id, edits) for chat, first_id, last_id, edits in rows}
+
+    def cursor(self, chat: str) -> tuple:
+        row = self.db.execute("SELECT first_id, last_id, edits FROM chats WHERE chat = ?", (chat,)).fetchone()
+        return tuple(row) if row else None
+
+    def load(self, chat: str, before: int = None, limit: int = None) -> list[dict]:
+        """Mensagens do intervalo contínuo da conversa, em ordem de id (as mais recentes se houver `limit`)"""
+        cursor = self.cursor(chat)
+        if cursor is None:
+            return []
+        first_id, last_id, _ = cursor
+        if before is not None:
+            last_id = min(last_id, before - 1)
+        query = "SELECT data FROM messages WHERE chat = ? AND id BETWEEN ? AND ? ORDER BY id DESC"
+        params = [chat, first_id, last_id]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = self.db.execute(query, params).fetchall()
+        return [json.loads(data) for (data,) in reversed(rows)]
+
+    def store(self, chat: str, messages: list[dict], span: tuple = None, edits: int = None):
+        """
+        Grava mensagens (inserindo ou substituindo por id). `span` = (primeiro, último)
+        é um intervalo de ids que o chamador garante estar completo (uma página, ou
+        uma única mensagem); se ele encosta no intervalo em cache os dois se unem.
+        Um intervalo separado não altera o cache: a lacuna é preenchida na próxima
+        sincronização. `edits` avança a revisão de edições já aplicada.
+        """
+        self.db.executemany(
+            "INSERT OR REPLACE INTO messages (chat, id, data) VALUES (?, ?, ?)",
+            [(chat, m['id'], json.dumps(m)) for m in messages if m.get('id') is not None]
+        )
+
+        self._dirty = True
+
+        cursor = self.cursor(chat)
+        if cursor is None:
+            if span is None:
+                return
+            (first_id, last_id), revision = span, edits or 0
+        else:
+            first_id, last_id, revision = cursor
+            if span is not None:
+                low, high = span
+                if low <= last_id + 1 and high >= first_id - 1:
+                    first_id, last_id = min(first_id, low), max(last_id, high)
+            if edits is not None:
+                revision = max(revision, edits)
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO chats (chat, first_id, last_id, edits) VALUES (?, ?, ?, ?)",
+            (chat, first_id, last_id, revision)
+        )
+
+    def reset(self, chat: str):
+        """Descarta a conversa (ex.: o servidor perdeu o histórico que o cache conhece)"""
+        self.db.execute("DELETE FROM messages WHERE chat = ?", (chat,))
+        self.db.execute("DELETE FROM chats WHERE chat = ?", (chat,))
+        self._dirty = True
+
+    def flush(self):
+        if self._dirty:
+            self.db.commit()
+            self._dirty = False
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,300 @@
+"""
+Núcleo de protocolo do cliente, sem interface gráfica: conexão, handshake,
+envio e recepção de mensagens. Usado pela interface Tk (CLIENTE.py), por bots,
+testes e pelo gerador de carga.
+
+As funções abaixo montam as mensagens do protocolo; ClientCore cuida do
+transporte (socket bloqueante com uma thread leitora e uma escritora).
+"""
+import queue
+import socket
+import threading
+import json
+from datetime import datetime
+from codec import CODEC_NAMES, JSON, build_codecs, hello_frame
+from framing import FrameDecoder, recv_frame
+from logger import TRACE, get_logger
+
+log = get_logger("cliente")
+
+
+def timestamp() -> str:
+    return datetime.now().strftime("%H:%M:%S")
+
+
+def group_message(group: str, text: str) -> dict:
+    return {'type': 'group_message', 'group': group, 'message': text, 'timestamp': timestamp()}
+
+
+def private_message(recipient: str, text: str) -> dict:
+    return {
+        'type': 'private_message',
+        'recipient': recipient,
+        'message': {'recipient': recipient, 'message': text},
+        'timestamp': timestamp()
+    }
+
+
+def create_group(group_name: str) -> dict:
+    return {'type': 'create_group', 'group_name': group_name}
+
+
+def invite(group_name: str, contact_name: str) -> dict:
+    return {'type': 'invite_to_group', 'group_name': group_name, 'contact_name': contact_name}
+
+
+def invite_answer(group_name: str, username: str, accept: bool) -> dict:
+    return {'type': 'accept_invite' if accept else 'reject_invite', 'group_name': group_name, 'username': username}
+
+
+def history_request(chat_type: str, chat: str, before: int = None, after: int = None, limit: int = None,
+                    edits_since: int = None) -> dict:
+    request = {'type': 'history_request', 'chat_type': chat_type, 'chat': chat}
+    if before is not None:
+        request['before'] = before
+    if after is not None:
+        request['after'] = after
+    if limit is not None:
+        request['limit'] = limit
+    if edits_since is not None:
+        request['edits_since'] = edits_since
+    return request
+
+
+class ClientCore:
+    """
+    Conexão de um cliente com o servidor.
+
+    Depois de connect(), os eventos recebidos (mensagens, deltas de presença,
+    convites, páginas de histórico...) são entregues ao callback passado em
+    start() ou, sem callback, ficam disponíveis no iterador events(). Quando a
+    conexão cai é gerado um evento local {'type': 'disconnected'}.
+
+    Os envios apenas enfileiram o frame; a thread escritora junta tudo o que
+    estiver pendente em um único sendall.
+
+    Por padrão o cliente prefere JSON, que é mais barato de decodificar; com
+    codecs=('binary', 'json') ele pede o binário, que ocupa menos banda.
+
+    Mensagens de conversa chegam com a sequência de entrega (`seq`, ver
+    delivery.py no servidor): o cliente as entrega em ordem, descarta as
+    repetidas e confirma com um ack cumulativo a cada `ack_every` mensagens ou
+    `ack_delay` segundos. Ao reconectar com o mesmo objeto, o hello pede a
+    retomada a partir da última sequência recebida.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5050, codecs=('json', 'binary'),
+                 ack_every: int = 64, ack_delay: float = 0.2):
+        self.host = host
+        self.port = port
+        self.codecs = list(codecs)
+        self.codec = JSON  # trocado pelo codec negociado no connection_ack
+        self.username = None
+        self.sock = None
+        self.connected = False
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.epoch = None    # caixa de entrega no servidor (muda se ela for recriada)
+        self.last_seq = 0    # última sequência entregue ao callback
+        self._acked = 0
+        self._ack_timer = None
+        self._resuming = False
+        self._decoder = FrameDecoder()
+        self._on_event = None
+        self._events = queue.Queue()
+        self._outbox = []
+        self._cond = threading.Condition()
+
+    def connect(self, username: str, timeout: float = 10.0) -> dict:
+        """Conecta, faz o handshake e retorna o connection_ack"""
+        if username != self.username:
+            self.epoch, self.last_seq, self._acked = None, 0, 0
+        self.username = username
+        self._decoder = FrameDecoder()
+        self._outbox = []
+        self.sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        # Oferece os codecs e pede o que ficou sem ack desde a última sequência recebida;
+        # se o servidor não aceitar nenhum codec, a conexão segue em JSON
+        self.sock.sendall(hello_frame(username, self.codecs, {'epoch': self.epoch, 'seq': self.last_seq}))
+        self._resuming = True
+
+        # A confirmação vem sempre em JSON (frames seguintes ficam no decodificador)
+        frame = recv_frame(self.sock, self._decoder)
+        if frame is None:
+            raise ConnectionError("conexão encerrada pelo servidor")
+        ack = json.loads(frame.decode('utf-8'))
+        if ack.get('status') != 'success':
+            self.sock.close()
+            raise ConnectionError(ack.get('message', "Erro desconhecido"))
+
+        self.codec = build_codecs({'enabled': CODEC_NAMES}).get(ack.get('codec'), JSON)
+        self.sock.settimeout(None)
+        self.connected = True
+        return ack
+
+    def start(self, on_event=None):
+        """Inicia as threads de leitura e escrita; `on_event(message)` roda na thread leitora"""
+        self._on_event = on_event
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def events(self, timeout: float = None):
+        """Itera sobre os eventos recebidos (quando start() foi chamado sem callback)"""
+        while True:
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                return
+            yield event
+            if event.get('type') == 'disconnected':
+                return
+
+    def _emit(self, event: dict):
+        if self._on_event is not None:
+            self._on_event(event)
+        else:
+            self._events.put(event)
+
+    def _read_loop(self):
+        error = None
+        try:
+            while True:
+                # Processa primeiro o que já estiver no buffer (ex.: frames que chegaram junto com o ack)
+                for frame in self._decoder:
+                    try:
+                        message = self.codec.decode(frame)
+                    except ValueError as e:
+                        log.warning("ERRO DECODIFICAÇÃO", str(e), codec=self.codec.name)
+                        continue
+                    if log.enabled(TRACE):
+                        log.trace("RECEBIDO", str(message))
+                    if message.get('type') == 'ping':
+                        # Heartbeat do servidor: sem resposta a conexão é derrubada por inatividade
+                        self.send({'type': 'pong'})
+                        continue
+                    seq = message.get('seq')
+                    if seq is not None and not self._in_order(seq):
+                        continue
+                    if message.get('type') == 'resume_ack':
+                        self._resumed(message)
+                    self._emit(message)
+                    if seq is not None:
+                        self._ack_later()
+
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self._decoder.feed(data)
+        except Exception as e:
+            error = str(e)
+        self._disconnected(error)
+
+    def _in_order(self, seq: int) -> bool:
+        """Aceita só a próxima sequência; repetidas são descartadas e uma lacuna pede a retomada"""
+        if seq == self.last_seq + 1:
+            self.last_seq = seq
+            return True
+        if seq > self.last_seq and not self._resuming:
+            # Algo se perdeu no caminho (ex.: descartado pela fila do servidor): o servidor
+            # reenvia, em ordem, tudo o que veio depois da última sequência recebida
+            self._resuming = True
+            try:
+                self.send({'type': 'resume', 'epoch': self.epoch, 'seq': self.last_seq})
+            except ConnectionError:
+                pass
+        return False
+
+    def _resumed(self, ack: dict):
+        # Com reset, o que veio antes de `after` se perdeu e a sincronização é pelo histórico
+        self.epoch = ack.get('epoch')
+        self.last_seq = self._acked = ack.get('after', 0)
+        self._resuming = False
+
+    def _ack_later(self):
+        if self.last_seq - self._acked >= self.ack_every:
+            self._send_ack()
+        elif self._ack_timer is None:
+            self._ack_timer = threading.Timer(self.ack_delay, self._send_ack)
+            self._ack_timer.daemon = True
+            self._ack_timer.start()
+
+    def _send_ack(self):
+        """Confirma de uma vez tudo o que foi entregue até agora"""
+        self._ack_timer = None
+        seq = self.last_seq
+        if seq <= self._acked or not self.connected:
+            return
+        self._acked = seq
+        try:
+            self.send({'type': 'ack', 'seq': seq})
+        except ConnectionError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._outbox and self.connected:
+                    self._cond.wait()
+                if not self.connected:
+                    return
+                pending, self._outbox = self._outbox, []
+            try:
+                self.sock.sendall(b''.join(pending))
+            except OSError as e:
+                self._disconnected(str(e))
+                return
+
+    def _disconnected(self, error: str = None):
+        with self._cond:
+            if not self.connected:
+                return
+            self.connected = False
+            self._cond.notify_all()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self._emit({'type': 'disconnected', 'error': error})
+
+    def send(self, data: dict):
+        """Enfileira uma mensagem no codec negociado"""
+        frame = self.codec.frame(data)
+        with self._cond:
+            if not self.connected:
+                raise ConnectionError("não conectado")
+            self._outbox.append(frame)
+            self._cond.notify()
+
+    def send_group(self, group: str, text: str):
+        self.send(group_message(group, text))
+
+    def send_private(self, recipient: str, text: str):
+        self.send(private_message(recipient, text))
+
+    def command(self, group: str, command: str):
+        """Executa um comando (ex.: '/history', '/edit 3 texto') no contexto de um grupo"""
+        self.send_group(group, command if command.startswith('/') else '/' + command)
+
+    def create_group(self, group_name: str):
+        self.send(create_group(group_name))
+
+    def invite(self, group_name: str, contact_name: str):
+        self.send(invite(group_name, contact_name))
+
+    def accept_invite(self, group_name: str):
+        self.send(invite_answer(group_name, self.username, True))
+
+    def reject_invite(self, group_name: str):
+        self.send(invite_answer(group_name, self.username, False))
+
+    def request_history(self, chat_type: str, chat: str, before: int = None, after: int = None, limit: int = None,
+                        edits_since: int = None):
+        self.send(history_request(chat_type, chat, before, after, limit, edits_since))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._disconnected()
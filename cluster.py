@@ -0,0 +1,505 @@
+"""
+Modo cluster: vários servidores (nós), cada um com a sua porta de clientes,
+agem como um único serviço de chat. Os nós se ligam diretamente por TCP, sem
+broker externo, nos endereços listados em `cluster.nodes` da configuração.
+
+- Diretório de usuários: cada nó anuncia aos demais quem conectou e desconectou
+  nele, então todos sabem em que nó está cada usuário. Presença, grupos e
+  membros são replicados em todos os nós pelos mesmos eventos.
+- Cada conversa (grupo ou par de usuários) tem um nó dono, escolhido por
+  rendezvous hashing sobre os ids dos nós. Os pedidos de clientes sobre a
+  conversa (mensagens, comandos, histórico, convites) são encaminhados ao dono,
+  que guarda o histórico e atribui os ids.
+- Em cada nó, pedidos e eventos são aplicados um de cada vez, em uma única
+  ordem, e cada ligação entre dois nós é FIFO. Cada entrega de grupo leva a
+  sequência do grupo (mensagens + edições/remoções); quem recebe descarta o
+  que não for mais novo do que já entregou, então edições, remoções e a ordem
+  das mensagens são as mesmas em todos os nós.
+- Entrega: mensagens para usuários de outro nó seguem em um único evento por
+  nó de destino, com a lista de destinatários de lá; o fan-out de grupo só vai
+  aos nós que têm membros.
+- No login, o connection_ack junta os metadados das conversas de todos os nós.
+
+Evento entre nós (um frame de framing.py):
+    [tipo: 1 byte][tamanho do cabeçalho: 4 bytes][cabeçalho JSON][corpo]
+"""
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+from bus import LocalBus
+from codec import CODEC_NAMES, BinaryCodec
+from framing import HEADER_SIZE, MAX_FRAME_SIZE, FrameDecoder, encode_frame
+from logger import get_logger
+from message_store import MessageRecord
+
+EV_HELLO = 1          # primeiro evento de cada ligação: {'node': id}
+EV_FRAME = 2          # pedido de cliente para o dono da conversa (corpo: índice do codec + payload)
+EV_DELIVER = 3        # corpo: frame no codec binário; cabeçalho: destinatários no nó e sequência do grupo
+EV_ONLINE = 4
+EV_OFFLINE = 5
+EV_GROUP_CREATED = 6  # também usado na sincronização ao ligar, com a lista de membros
+EV_JOINED = 7
+EV_CHATS_REQUEST = 8  # metadados das conversas de quem está fazendo login
+EV_CHATS = 9
+
+HEADER = struct.Struct("!BI")
+# Um frame de cliente do tamanho máximo ainda cabe em um evento
+MAX_EVENT_SIZE = MAX_FRAME_SIZE + 64 * 1024
+RECONNECT_DELAY = 1.0
+# Tempo máximo de espera pelos metadados dos outros nós antes de enviar o connection_ack
+CHATS_TIMEOUT = 2.0
+
+# Codec usado entre os nós; clientes binários recebem o mesmo payload sem recodificação
+WIRE = BinaryCodec()
+
+log = get_logger("cluster")
+
+
+def parse_address(address: str) -> tuple:
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def encode_event(kind: int, header: dict = None, body: bytes = b'') -> bytes:
+    data = json.dumps(header or {}).encode('utf-8')
+    return encode_frame(HEADER.pack(kind, len(data)) + data + body, MAX_EVENT_SIZE)
+
+
+def decode_event(payload: bytes) -> tuple:
+    """(tipo, cabeçalho, corpo)"""
+    kind, size = HEADER.unpack_from(payload)
+    start = HEADER.size
+    return kind, json.loads(payload[start:start + size]), payload[start + size:]
+
+
+def home_node(nodes, chat_key: str) -> str:
+    """Rendezvous hashing: todos os nós chegam ao mesmo dono sem coordenação"""
+    return max(nodes, key=lambda node: zlib.crc32(f"{node}\0{chat_key}".encode('utf-8')))
+
+
+class SerialExecutor:
+    """Aplica as funções enviadas uma de cada vez, na ordem de chegada, em uma thread própria"""
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error("ERRO EVENTO", str(e), exc_info=True)
+
+
+class RemoteMessage:
+    """
+    Mensagem vinda de outro nó, no codec binário. Clientes binários recebem o
+    payload como veio; para os demais codecs ela é decodificada uma única vez.
+    """
+    __slots__ = ('payload', 'tracked', '_frames')
+
+    def __init__(self, payload: bytes, tracked: bool = False):
+        self.payload = payload
+        self.tracked = tracked
+        self._frames = {}
+
+    def frame(self, codec) -> bytes:
+        frame = self._frames.get(codec.name)
+        if frame is None:
+            if codec.name == WIRE.name:
+                frame = encode_frame(self.payload)
+            else:
+                frame = codec.frame(WIRE.decode(self.payload))
+            self._frames[codec.name] = frame
+        return frame
+
+
+class PeerLink:
+    """
+    Ligação de saída para outro nó, refeita quando cai. Enviar só enfileira o
+    evento (uma thread escritora envia); enquanto a ligação não está ativa os
+    eventos para aquele nó são descartados.
+    """
+
+    def __init__(self, bus: 'ClusterBus', node: str, address: str):
+        self.bus = bus
+        self.node = node
+        self.address = parse_address(address)
+        self.up = False  # alterado só no contexto serial do nó
+        self._outbox = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._sock = None
+        self._current = None  # identifica a conexão ativa; reset() a invalida
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, event: bytes) -> bool:
+        if not self.up:
+            return False
+        with self._cond:
+            self._outbox.append(event)
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while not self._closed:
+            try:
+                sock = socket.create_connection(self.address, timeout=RECONNECT_DELAY)
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            token = object()
+            with self._cond:
+                self._current = token
+                self._outbox = [encode_event(EV_HELLO, {'node': self.bus.node_id})]
+            self.bus.server.call_soon(self.bus._link_up, self)
+            self._write_loop(sock, token)
+            self.bus.server.call_soon(self.bus._link_down, self)
+            sock.close()
+            if not self._closed:
+                time.sleep(RECONNECT_DELAY)
+
+    def _write_loop(self, sock: socket.socket, token):
+        while True:
+            with self._cond:
+                while not self._outbox and not self._closed and self._current is token:
+                    self._cond.wait()
+                if self._closed or self._current is not token:
+                    return
+                pending, self._outbox = self._outbox, []
+            try:
+                sock.sendall(b''.join(pending))
+            except OSError as e:
+                log.warning("LIGAÇÃO PERDIDA", str(e), node=self.node)
+                return
+
+    def reset(self):
+        """
+        Refaz a ligação. Chamado quando a ligação de entrada do mesmo nó cai: sem
+        isso a de saída só perceberia a queda na próxima escrita, perdendo eventos.
+        """
+        self.up = False
+        with self._cond:
+            self._current = None
+            self._outbox = []
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ClusterBus(LocalBus):
+    """
+    Barramento de um nó do cluster. Todo pedido de cliente, conexão, desconexão
+    e evento de outro nó é aplicado por server.call_soon, que na engine thread é
+    um SerialExecutor e na engine asyncio o event loop: em ambos, um de cada vez.
+    """
+
+    def __init__(self, server, node_id: str, nodes: dict):
+        if node_id not in nodes:
+            raise ValueError(f"Nó {node_id} não está em cluster.nodes")
+        super().__init__(server)
+        self.node_id = node_id
+        self.nodes = dict(nodes)
+        self.directory = {}       # {username: id do nó onde está conectado}
+        self._inbound = {}        # {id do nó: socket da ligação de entrada ativa}
+        self._group_seq = {}      # {grupo: última sequência entregue}
+        self._gathering = {}      # {username: metadados das conversas aguardando os outros nós}
+        self.links = {node: PeerLink(self, node, address)
+                      for node, address in self.nodes.items() if node != node_id}
+        server.call_soon = SerialExecutor().submit
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(parse_address(self.nodes[node_id]))
+        self.listener.listen()
+
+    # --- roteamento --------------------------------------------------------
+
+    def group_home(self, group_name: str) -> str:
+        return home_node(self.nodes, f"group:{group_name}")
+
+    def private_home(self, user_a: str, user_b: str) -> str:
+        return home_node(self.nodes, "private:{}:{}".format(*sorted((user_a, user_b))))
+
+    def owns_group(self, group_name: str) -> bool:
+        return self.group_home(group_name) == self.node_id
+
+    def owns_private(self, user_a: str, user_b: str) -> bool:
+        return self.private_home(user_a, user_b) == self.node_id
+
+    def remote(self, username: str) -> bool:
+        return self.directory.get(username, self.node_id) != self.node_id
+
+    def _home_of(self, username: str, data: dict) -> str:
+        """Nó dono da conversa a que o pedido se refere"""
+        kind = data.get('type')
+        if kind == 'group_message':
+            return self.group_home(data.get('group'))
+        if kind in ('create_group', 'invite_to_group', 'accept_invite', 'reject_invite'):
+            return self.group_home(data.get('group_name'))
+        if kind == 'private_message':
+            return self.private_home(username, data.get('recipient'))
+        if kind == 'history_request':
+            if data.get('chat_type') == 'group':
+                return self.group_home(data.get('chat'))
+            return self.private_home(username, data.get('chat'))
+        return self.node_id
+
+    def publish_frame(self, username: str, codec, frame: bytes, data: dict):
+        self.server.call_soon(self._route, username, codec, frame, data)
+
+    def relay(self, username: str, data: dict):
+        """Encaminha um pedido gerado pelo próprio servidor (ex.: resposta de comando) ao dono da conversa"""
+        self.server.call_soon(self._route, username, WIRE, WIRE.frame(data)[HEADER_SIZE:], data)
+
+    def _route(self, username: str, codec, frame: bytes, data: dict):
+        node = self._home_of(username, data)
+        if node == self.node_id:
+            self.server._apply_frame(username, data)
+            return
+        body = bytes((CODEC_NAMES.index(codec.name),)) + frame
+        if self.links[node].send(encode_event(EV_FRAME, {'user': username}, body)):
+            self.server.metrics.incr('cluster_forwarded')
+        else:
+            self.server.metrics.incr('cluster_unroutable')
+            log.warning("SEM ROTA", f"Nó {node} indisponível", user=username, type=data.get('type'))
+
+    def forward(self, usernames, message) -> bool:
+        """Entrega aos usuários de outros nós: um evento por nó, com os destinatários de lá"""
+        targets = {}
+        for username in usernames:
+            node = self.directory.get(username)
+            if node is not None and node != self.node_id:
+                targets.setdefault(node, []).append(username)
+        if not targets:
+            return False
+
+        header = {}
+        if isinstance(message, MessageRecord) and message.group is not None:
+            chat_log = self.server.store.group_log(message.group)
+            if chat_log is not None:
+                header = {'group': message.group, 'seq': len(chat_log) + len(chat_log.edits)}
+        if message.tracked:
+            header['tracked'] = True
+        body = message.frame(WIRE)[HEADER_SIZE:]
+        sent = False
+        for node, names in targets.items():
+            if self.links[node].send(encode_event(EV_DELIVER, dict(header, to=names), body)):
+                sent = True
+                self.server.metrics.incr('cluster_deliveries')
+        return sent
+
+    def _broadcast(self, kind: int, header: dict):
+        event = encode_event(kind, header)
+        for link in self.links.values():
+            link.send(event)
+
+    # --- eventos locais ----------------------------------------------------
+
+    def connected(self, username: str):
+        self.server.call_soon(self._connected, username)
+
+    def _connected(self, username: str):
+        self.directory[username] = self.node_id
+        self._broadcast(EV_ONLINE, {'user': username})
+        self.server._user_online(username)
+
+    def disconnected(self, username: str, marks: dict):
+        self.server.call_soon(self._disconnected, username, marks)
+
+    def _disconnected(self, username: str, marks: dict):
+        if self.directory.get(username) == self.node_id:
+            del self.directory[username]
+            self._broadcast(EV_OFFLINE, {'user': username})
+        self.server._user_offline(username, marks)
+
+    def group_created(self, group_name: str, owner: str):
+        self._broadcast(EV_GROUP_CREATED, {'group': group_name, 'members': [owner]})
+
+    def member_joined(self, group_name: str, username: str):
+        self._broadcast(EV_JOINED, {'group': group_name, 'user': username})
+
+    def gather_chats(self, username: str, callback):
+        """
+        Pede aos outros nós os metadados das conversas do usuário e chama
+        `callback(username, chats)` com tudo junto. Até lá, o que for enviado ao
+        usuário fica retido no servidor para sair depois do connection_ack.
+        """
+        state = {'chats': self.server._chat_meta(username), 'callback': callback,
+                 'waiting': {node for node, link in self.links.items() if link.up}}
+        if not state['waiting']:
+            callback(username, state['chats'])
+            return
+        self._gathering[username] = state
+        for node in state['waiting']:
+            self.links[node].send(encode_event(EV_CHATS_REQUEST, {'user': username}))
+        self.server.call_later(CHATS_TIMEOUT, lambda: self.server.call_soon(self._gathered, username, state))
+
+    def _gathered(self, username: str, state: dict, node: str = None, chats: dict = None):
+        if state is None or self._gathering.get(username) is not state:
+            return
+        if node is not None:
+            state['waiting'].discard(node)
+            for chat_type, entries in chats.items():
+                state['chats'].setdefault(chat_type, {}).update(entries)
+            if state['waiting']:
+                return
+        del self._gathering[username]
+        state['callback'](username, state['chats'])
+
+    # --- eventos de outros nós ---------------------------------------------
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read_loop, args=(conn,), daemon=True).start()
+
+    def _read_loop(self, conn: socket.socket):
+        decoder = FrameDecoder(MAX_EVENT_SIZE)
+        node = None
+        try:
+            while True:
+                data = conn.recv(262144)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in decoder:
+                    kind, header, body = decode_event(frame)
+                    if kind == EV_HELLO:
+                        node = header['node']
+                        self.server.call_soon(self._node_up, node, conn)
+                    elif node is not None:
+                        self.server.call_soon(self._apply, node, kind, header, body)
+        except (OSError, ValueError) as e:
+            log.warning("LIGAÇÃO PERDIDA", str(e), node=node)
+        finally:
+            conn.close()
+            if node is not None:
+                self.server.call_soon(self._node_down, node, conn)
+
+    def _apply(self, node: str, kind: int, header: dict, body: bytes):
+        server = self.server
+        if kind == EV_FRAME:
+            codec = server.codecs.get(CODEC_NAMES[body[0]], WIRE)
+            server._apply_frame(header['user'], codec.decode(body[1:]))
+        elif kind == EV_DELIVER:
+            group_name = header.get('group')
+            if group_name is not None:
+                if header['seq'] <= self._group_seq.get(group_name, 0):
+                    server.metrics.incr('cluster_stale')
+                    return
+                self._group_seq[group_name] = header['seq']
+            message = RemoteMessage(body, header.get('tracked', False))
+            for username in header['to']:
+                # Quem mudou de nó nesse meio tempo não é reencaminhado; quem caiu
+                # fica só com a mensagem na caixa de entrega deste nó
+                if not self.remote(username):
+                    server._send_to(username, message)
+        elif kind == EV_ONLINE:
+            self.directory[header['user']] = node
+            server._user_online(header['user'])
+        elif kind == EV_OFFLINE:
+            if self.directory.get(header['user']) == node:
+                self._remote_offline(header['user'])
+        elif kind == EV_GROUP_CREATED:
+            server._group_created(header['group'])
+            for username in header['members']:
+                server._member_joined(header['group'], username)
+        elif kind == EV_JOINED:
+            server._member_joined(header['group'], header['user'])
+        elif kind == EV_CHATS_REQUEST:
+            self.links[node].send(encode_event(EV_CHATS, {
+                'user': header['user'], 'chats': server._chat_meta(header['user'])
+            }))
+        elif kind == EV_CHATS:
+            self._gathered(header['user'], self._gathering.get(header['user']), node, header['chats'])
+
+    def _remote_offline(self, username: str):
+        del self.directory[username]
+        self.server._user_offline(username, self.server._login_marks.pop(username, None))
+
+    def _node_up(self, node: str, conn: socket.socket):
+        previous = self._inbound.get(node)
+        if previous is not None and previous is not conn:
+            # O nó reiniciou antes de percebermos a queda da ligação anterior
+            self._node_down(node, previous)
+        self._inbound[node] = conn
+        log.info("NÓ CONECTADO", node)
+
+    def _node_down(self, node: str, conn: socket.socket):
+        if self._inbound.get(node) is not conn:
+            return
+        del self._inbound[node]
+        self.links[node].reset()
+        for username, location in list(self.directory.items()):
+            if location == node:
+                self._remote_offline(username)
+        for group_name in list(self._group_seq):
+            if self.group_home(group_name) == node:
+                del self._group_seq[group_name]
+        for username, state in list(self._gathering.items()):
+            if node in state['waiting']:
+                self._gathered(username, state, node, {})
+        log.warning("NÓ DESCONECTADO", node)
+
+    def _link_up(self, link: PeerLink):
+        """Ligação de saída ativa: envia o estado que o outro nó precisa conhecer deste"""
+        link.up = True
+        for username, location in self.directory.items():
+            if location == self.node_id:
+                link.send(encode_event(EV_ONLINE, {'user': username}))
+        membership = self.server.membership
+        for group_name in membership.group_names():
+            if self.owns_group(group_name):
+                link.send(encode_event(EV_GROUP_CREATED, {
+                    'group': group_name, 'members': list(membership.members(group_name))
+                }))
+
+    def _link_down(self, link: PeerLink):
+        link.up = False
+
+    # --- ciclo de vida -----------------------------------------------------
+
+    def wait_start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        for link in self.links.values():
+            link.start()
+
+    def stats(self) -> dict:
+        return {
+            'node': self.node_id,
+            'nodes': sorted(self.nodes),
+            'linked': sorted(node for node, link in self.links.items() if link.up),
+            'local_users': sum(1 for location in list(self.directory.values()) if location == self.node_id),
+            'remote_users': sum(1 for location in list(self.directory.values()) if location != self.node_id)
+        }
+
+    def close(self):
+        self.listener.close()
+        for link in self.links.values():
+            link.close()
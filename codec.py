@@ -0,0 +1,343 @@
+"""
+Codecs de payload negociados no handshake. O JSON continua disponível para
+compatibilidade; o binário usa apenas a biblioteca padrão:
+
+    [envelope: 1 byte (0 = puro, 1 = zlib)][valor]
+
+Mensagens com sequência de entrega (ver delivery.py) ganham um envelope na
+frente do original: [2][seq: 8 bytes][envelope original][valor].
+
+Cada valor começa com uma tag de 1 byte. Chaves e valores frequentes (ex.:
+'type', 'sender', 'group_message') são trocados pelo seu índice em tabelas
+estáticas, e mensagens do histórico viajam no mesmo formato binário usado
+em disco (MessageRecord.pack), sem passar por dicionários.
+
+As tabelas fazem parte do protocolo: só acrescente itens no final.
+"""
+import json
+import struct
+import zlib
+from framing import HEADER_SIZE, encode_frame, encode_json
+from message_store import MessageRecord, encode_messages
+
+
+STRINGS = (
+    # chaves
+    'type', 'sender', 'message', 'timestamp', 'group', 'recipient', 'id', 'edited',
+    'deleted', 'status', 'your_name', 'chats', 'contacts', 'groups', 'all_groups',
+    'online', 'offline', 'groups_created', 'joined', 'last_id', 'unread', 'chat_type',
+    'chat', 'before', 'after', 'limit', 'has_more', 'messages', 'group_name',
+    'contact_name', 'invited_by', 'username', 'codec',
+    # tipos de mensagem e valores comuns
+    'group_message', 'private_message', 'update', 'presence_delta', 'group_invite',
+    'history_request', 'history_page', 'connection_ack', 'create_group',
+    'invite_to_group', 'accept_invite', 'reject_invite', 'individual', 'success',
+    'Geral', 'Server',
+    # sincronização do cache do cliente
+    'edits', 'edits_since', 'reset',
+    # entrega com confirmação
+    'seq', 'ack', 'resume', 'resume_ack', 'epoch', 'replayed',
+    # heartbeat
+    'ping', 'pong',
+)
+STRING_INDEX = {s: i for i, s in enumerate(STRINGS)}
+
+ENVELOPE_PLAIN = 0
+ENVELOPE_ZLIB = 1
+ENVELOPE_SEQ = 2
+
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_SHORT_STR = 6
+T_INTERNED = 7
+T_LIST = 8
+T_DICT = 9
+T_RECORD = 10
+
+U8 = struct.Struct("!B")
+U32 = struct.Struct("!I")
+I64 = struct.Struct("!q")
+F64 = struct.Struct("!d")
+INTERNED = struct.Struct("!BB")
+SEQ_ENVELOPE = struct.Struct("!Bq")
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+
+class CodecError(ValueError):
+    """Payload que não pôde ser decodificado"""
+
+
+class JsonCodec:
+    """Codec original: JSON UTF-8"""
+    name = 'json'
+
+    def frame(self, data: dict) -> bytes:
+        return encode_json(data)
+
+    def decode(self, payload: bytes) -> dict:
+        return json.loads(payload.decode('utf-8'))
+
+    def record_frame(self, record: MessageRecord) -> bytes:
+        return record.frame()
+
+    def sequenced(self, frame: bytes, seq: int) -> bytes:
+        """Frame já serializado com a sequência de entrega como primeira chave"""
+        return encode_frame(b'{"seq": %d, ' % seq + frame[HEADER_SIZE + 1:])
+
+    def page_frame(self, header: dict, records: list[MessageRecord]) -> bytes:
+        # Reaproveita o JSON já serializado de cada mensagem
+        encoded = json.dumps(header).encode('utf-8')
+        return encode_frame(encoded[:-1] + b', "messages": ' + encode_messages(records) + b'}')
+
+
+class BinaryCodec:
+    """
+    Codec binário compacto. Payloads a partir de `compress_threshold` bytes
+    (ex.: páginas de histórico) são comprimidos com zlib quando isso reduz o tamanho.
+    """
+    name = 'binary'
+
+    def __init__(self, compress_threshold: int = 1024, compress_level: int = 1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def frame(self, data: dict) -> bytes:
+        out = bytearray()
+        self._encode(data, out)
+        return self._envelope(out)
+
+    def record_frame(self, record: MessageRecord) -> bytes:
+        packed = record.pack()
+        return self._envelope(U8.pack(T_RECORD) + U32.pack(len(packed)) + packed)
+
+    def page_frame(self, header: dict, records: list[MessageRecord]) -> bytes:
+        # Mesmo formato de frame(dict(header, messages=records)), mas a lista é montada
+        # juntando os bytes já serializados de cada registro, como no JSON
+        out = bytearray()
+        out += U8.pack(T_DICT) + U32.pack(len(header) + 1)
+        for key, value in header.items():
+            self._encode(key, out)
+            self._encode(value, out)
+        self._encode('messages', out)
+        out += U8.pack(T_LIST) + U32.pack(len(records))
+        out += b''.join([self._record_body(record) for record in records])
+        return self._envelope(out)
+
+    def _record_body(self, record: MessageRecord):
+        """Valor do registro (tag T_RECORD + registro), reaproveitando o frame em cache quando não comprimido"""
+        frame = record.frame(self)
+        if frame[HEADER_SIZE] == ENVELOPE_PLAIN:
+            return memoryview(frame)[HEADER_SIZE + 1:]
+        packed = record.pack()
+        return U8.pack(T_RECORD) + U32.pack(len(packed)) + packed
+
+    def sequenced(self, frame: bytes, seq: int) -> bytes:
+        """Frame já serializado com a sequência de entrega, sem recodificar o payload"""
+        return encode_frame(SEQ_ENVELOPE.pack(ENVELOPE_SEQ, seq) + frame[HEADER_SIZE:])
+
+    def _envelope(self, body) -> bytes:
+        if self.compress_threshold and len(body) >= self.compress_threshold:
+            compressed = zlib.compress(body, self.compress_level)
+            if len(compressed) < len(body):
+                return encode_frame(U8.pack(ENVELOPE_ZLIB) + compressed)
+        return encode_frame(U8.pack(ENVELOPE_PLAIN) + body)
+
+    def _encode(self, value, out: bytearray):
+        if value is None:
+            out.append(T_NONE)
+        elif value is True:
+            out.append(T_TRUE)
+        elif value is False:
+            out.append(T_FALSE)
+        elif isinstance(value, str):
+            index = STRING_INDEX.get(value)
+            if index is not None:
+                out += INTERNED.pack(T_INTERNED, index)
+                return
+            encoded = value.encode('utf-8')
+            if len(encoded) < 256:
+                out += INTERNED.pack(T_SHORT_STR, len(encoded))
+            else:
+                out += U8.pack(T_STR) + U32.pack(len(encoded))
+            out += encoded
+        elif isinstance(value, int):
+            if not INT_MIN <= value <= INT_MAX:
+                raise CodecError(f"inteiro fora do intervalo de 64 bits: {value}")
+            out += U8.pack(T_INT) + I64.pack(value)
+        elif isinstance(value, float):
+            out += U8.pack(T_FLOAT) + F64.pack(value)
+        elif isinstance(value, dict):
+            out += U8.pack(T_DICT) + U32.pack(len(value))
+            for key, item in value.items():
+                self._encode(key, out)
+                self._encode(item, out)
+        elif isinstance(value, (list, tuple)):
+            out += U8.pack(T_LIST) + U32.pack(len(value))
+            for item in value:
+                self._encode(item, out)
+        elif isinstance(value, MessageRecord):
+            out += self._record_body(value)
+        else:
+            raise TypeError(f"tipo não suportado pelo codec binário: {type(value).__name__}")
+
+    def decode(self, payload: bytes) -> dict:
+        if payload and payload[0] == ENVELOPE_SEQ:
+            if len(payload) < SEQ_ENVELOPE.size:
+                raise CodecError("envelope de sequência truncado")
+            _, seq = SEQ_ENVELOPE.unpack_from(payload)
+            value = self.decode(payload[SEQ_ENVELOPE.size:])
+            if not isinstance(value, dict):
+                raise CodecError("mensagem sequenciada não é um objeto")
+            value['seq'] = seq
+            return value
+        try:
+            if payload[0] == ENVELOPE_ZLIB:
+                payload = zlib.decompress(payload[1:])
+            else:
+                payload = payload[1:]
+            value, offset = self._decode(payload, 0)
+        except (IndexError, struct.error, zlib.error, UnicodeDecodeError) as e:
+            raise CodecError(f"payload binário inválido: {e}") from e
+        if offset != len(payload):
+            raise CodecError("bytes sobrando no payload binário")
+        return value
+
+    def _decode(self, buffer: bytes, offset: int):
+        tag = buffer[offset]
+        offset += 1
+        if tag == T_INTERNED:
+            return STRINGS[buffer[offset]], offset + 1
+        if tag == T_SHORT_STR:
+            size = buffer[offset]
+            start = offset + 1
+            return buffer[start:start + size].decode('utf-8'), start + size
+        if tag == T_DICT:
+            (count,) = U32.unpack_from(buffer, offset)
+            offset += 4
+            result = {}
+            for _ in range(count):
+                if buffer[offset] == T_INTERNED:
+                    key = STRINGS[buffer[offset + 1]]
+                    offset += 2
+                else:
+                    key, offset = self._decode(buffer, offset)
+                result[key], offset = self._decode(buffer, offset)
+            return result, offset
+        if tag == T_LIST:
+            (count,) = U32.unpack_from(buffer, offset)
+            offset += 4
+            result = []
+            append = result.append
+            unpack_dict = MessageRecord.unpack_dict
+            for _ in range(count):
+                if buffer[offset] == T_RECORD:
+                    # Páginas de histórico: registros lidos direto (pula a tag e o tamanho),
+                    # sem passar pelo despacho por tag
+                    item, offset = unpack_dict(buffer, offset + 5)
+                else:
+                    item, offset = self._decode(buffer, offset)
+                append(item)
+            return result, offset
+        if tag == T_RECORD:
+            (size,) = U32.unpack_from(buffer, offset)
+            offset += 4
+            return MessageRecord.unpack_dict(buffer, offset)[0], offset + size
+        if tag == T_NONE:
+            return None, offset
+        if tag == T_TRUE:
+            return True, offset
+        if tag == T_FALSE:
+            return False, offset
+        if tag == T_INT:
+            return I64.unpack_from(buffer, offset)[0], offset + 8
+        if tag == T_FLOAT:
+            return F64.unpack_from(buffer, offset)[0], offset + 8
+        if tag == T_STR:
+            (size,) = U32.unpack_from(buffer, offset)
+            start = offset + 4
+            return buffer[start:start + size].decode('utf-8'), start + size
+        raise CodecError(f"tag desconhecida: {tag}")
+
+
+JSON = JsonCodec()
+
+CODEC_NAMES = ('json', 'binary')
+
+
+def build_codecs(config: dict) -> dict:
+    """Codecs habilitados (o binário só se listado em `enabled`); o JSON está sempre disponível"""
+    codecs = {'json': JSON}
+    if 'binary' in config.get("enabled", ('json',)):
+        codecs['binary'] = BinaryCodec(config.get("compress_threshold", 1024),
+                                       config.get("compress_level", 1))
+    return codecs
+
+
+def parse_hello(frame: bytes) -> tuple:
+    """
+    Lê o primeiro frame da conexão: (usuário, codecs oferecidos, retomada).
+    A retomada ({'epoch', 'seq'}) só vem de clientes com entrega confirmada;
+    clientes antigos mandam apenas o nome de usuário e ficam com JSON.
+    """
+    if frame[:1] == b'{':
+        try:
+            hello = json.loads(frame.decode('utf-8'))
+        except ValueError:
+            hello = None
+        if isinstance(hello, dict) and hello.get('type') == 'hello':
+            resume = hello.get('resume')
+            return (str(hello.get('username', '')).strip(), list(hello.get('codecs', [])),
+                    resume if isinstance(resume, dict) else None)
+    return frame.decode('utf-8').strip(), [], None
+
+
+def hello_frame(username: str, codecs=('json', 'binary'), resume: dict = None) -> bytes:
+    hello = {'type': 'hello', 'username': username, 'codecs': list(codecs)}
+    if resume is not None:
+        hello['resume'] = resume
+    return encode_json(hello)
+
+
+def negotiate(offered: list, codecs: dict):
+    """Primeiro codec oferecido pelo cliente que o servidor suporta (ou JSON)"""
+    for name in offered:
+        if name in codecs:
+            return codecs[name]
+    return JSON
+
+
+class Message:
+    """
+    Mensagem a enviar para vários destinatários: serializada uma vez por
+    codec, na primeira vez que algum destinatário com aquele codec a pede.
+    """
+    __slots__ = ('data', '_frames')
+    tracked = False  # respostas e avisos não passam pela caixa de entrega
+
+    def __init__(self, data: dict):
+        self.data = data
+        self._frames = {}
+
+    def frame(self, codec) -> bytes:
+        frame = self._frames.get(codec.name)
+        if frame is None:
+            frame = self._frames[codec.name] = codec.frame(self.data)
+        return frame
+
+
+class HistoryPage:
+    """Página de histórico; as mensagens são serializadas direto dos registros"""
+    __slots__ = ('header', 'records')
+    tracked = False
+
+    def __init__(self, header: dict, records: list[MessageRecord]):
+        self.header = header
+        self.records = records
+
+    def frame(self, codec) -> bytes:
+        return codec.page_frame(self.header, self.records)
@@ -0,0 +1,93 @@
+"""
+Comandos do chat (/history, /edit...). A descrição de cada comando vem de
+config/commands.json, relido quando o arquivo muda, sem reiniciar o servidor;
+o tratamento vem da tabela de handlers do Server (nome → função).
+
+Comandos marcados com "offload" rodam em um pool de threads, fora da thread
+da conexão (ou do event loop), e respondem com uma mensagem privada do
+'Server'. Só devem ser marcados comandos que apenas leem o estado.
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from dtos import CommandDTO
+from logger import get_logger
+
+log = get_logger("comandos")
+
+# Comando já interpretado: o texto é dividido uma única vez
+ParsedCommand = namedtuple("ParsedCommand", ["command", "sender", "group", "args"])
+
+
+def split_command(text: str) -> list[str]:
+    """'/edit 3 texto' → ['edit', '3', 'texto']"""
+    return text[1:].split()
+
+
+class CommandRegistry:
+    """
+    Tabela nome → CommandDTO carregada de `path`. Uma thread confere a data de
+    modificação do arquivo a cada `reload_interval` segundos e troca a tabela
+    inteira quando ele muda; se o arquivo novo for inválido, a anterior continua.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._commands = {}
+        self._mtime = None
+        self._closed = False
+        self.reload()
+        if reload_interval:
+            threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    def get(self, name: str) -> CommandDTO:
+        return self._commands.get(name)
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def reload(self) -> bool:
+        """Relê o arquivo se ele mudou; True se a tabela foi trocada"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            log.error("ERRO", f"Falha ao carregar comandos em: {self.path}: {e}")
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            commands = {
+                command["name"]: CommandDTO(
+                    command["name"],
+                    command["description"],
+                    command["usage"],
+                    command["min_args"],
+                    command.get("offload", False)
+                )
+                for command in data
+            }
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error("ERRO", f"Falha ao carregar comandos em: {self.path}: {e}")
+            return False
+
+        if not commands:
+            log.error("ERRO", f"Falha ao carregar comandos em: {self.path}")
+            return False
+        self._commands = commands
+        log.info("INFO", f"{len(commands)} comandos carregados.")
+        return True
+
+    def _watch_loop(self):
+        while not self._closed:
+            time.sleep(self.reload_interval)
+            self.reload()
+
+    def close(self):
+        self._closed = True
@@ -0,0 +1,132 @@
+"""
+Entrega com confirmação (store-and-forward) por destinatário.
+
+Cada usuário que pediu retomada tem uma caixa de entrega (Mailbox) com um
+número de sequência próprio. Toda mensagem de conversa enviada a ele (nova,
+editada ou apagada) recebe o próximo número e fica guardada na caixa até o
+cliente confirmá-la; se ele estiver offline, ela só é guardada.
+
+O cliente confirma de forma cumulativa ({'type': 'ack', 'seq': N} confirma
+tudo até N), em lotes. Ao reconectar ele diz de onde parou (no hello, ou em
+um {'type': 'resume'} se perceber uma lacuna no meio da sessão) e recebe
+apenas o que ainda não confirmou, sempre em ordem. A entrega é "pelo menos
+uma vez": o cliente descarta as sequências que já viu.
+
+As caixas ficam só em memória e guardam até `max_pending` mensagens; a de
+quem passa mais de `offline_ttl` offline é removida. A época (`epoch`) muda
+quando a caixa é recriada (ex.: reinício do servidor ou caixa expirada). Se a
+posição do cliente não puder ser atendida, a resposta vem com reset e o
+cliente volta à sincronização pelo histórico.
+"""
+import threading
+from collections import OrderedDict, deque
+from dtos import DeliveryDTO
+
+
+def parse_delivery(config: dict) -> DeliveryDTO:
+    """DeliveryDTO a partir da seção "delivery" do config (None se desativada)"""
+    if not config.get("enabled", True):
+        return None
+    return DeliveryDTO(
+        max(1, config.get("max_pending", 1000)),
+        max(0.0, config.get("offline_ttl_hours", 24) * 3600)
+    )
+
+
+class Mailbox:
+    """
+    Mensagens enviadas a um usuário e ainda não confirmadas, em ordem de
+    sequência. O servidor numera e escreve na conexão com `lock` adquirido,
+    para que a ordem na fila de saída seja a ordem das sequências.
+    """
+    __slots__ = ('epoch', 'max_pending', 'last', 'acked', 'dropped', 'lock', '_pending')
+
+    def __init__(self, max_pending: int, epoch: int):
+        self.epoch = epoch
+        self.max_pending = max_pending
+        self.last = 0       # última sequência atribuída
+        self.acked = 0      # última sequência confirmada pelo cliente
+        self.dropped = 0    # descartadas sem confirmação por falta de espaço
+        self.lock = threading.RLock()
+        self._pending = deque()  # (seq, mensagem)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def push(self, message) -> int:
+        """Guarda a mensagem e devolve a sua sequência"""
+        self.last += 1
+        if len(self._pending) >= self.max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append((self.last, message))
+        return self.last
+
+    def ack(self, seq: int):
+        """Confirma tudo até `seq`"""
+        if seq > self.last:
+            seq = self.last
+        if seq <= self.acked:
+            return
+        self.acked = seq
+        pending = self._pending
+        while pending and pending[0][0] <= seq:
+            pending.popleft()
+
+    def resume(self, epoch, seq: int) -> tuple:
+        """
+        Retomada a partir de `seq` (última sequência que o cliente recebeu).
+        Devolve (sequência a partir da qual reenviar, [(seq, mensagem)], reset);
+        reset indica que o que houver antes disso se perdeu (caixa recriada ou cheia).
+        """
+        valid = epoch == self.epoch and 0 <= seq <= self.last
+        if valid:
+            self.ack(seq)
+        # Menor posição que ainda conseguimos atender
+        floor = self._pending[0][0] - 1 if self._pending else self.last
+        if valid and seq >= floor:
+            return seq, list(self._pending), False
+        return floor, list(self._pending), True
+
+
+class Mailboxes(dict):
+    """
+    Caixas de entrega por usuário ({username: Mailbox}). Guarda também desde
+    quando cada dono de caixa está offline, em ordem de saída, para que
+    expire() remova as de quem passou de `ttl` segundos fora (0 desativa)
+    olhando só o começo da fila. O horário vem de quem chama: no modo
+    multiprocesso é o do evento replicado, e as réplicas expiram igual.
+    """
+
+    def __init__(self, ttl: float):
+        super().__init__()
+        self.ttl = ttl
+        self.expired = 0
+        self._offline = OrderedDict()  # {username: desde quando está offline}
+        self._lock = threading.Lock()
+
+    def user_offline(self, username: str, now: float):
+        with self._lock:
+            if username in self and username not in self._offline:
+                self._offline[username] = now
+
+    def user_online(self, username: str):
+        with self._lock:
+            self._offline.pop(username, None)
+
+    def expire(self, now: float) -> int:
+        """Remove as caixas de quem está offline há pelo menos `ttl` segundos"""
+        if not self.ttl:
+            return 0
+        count = 0
+        with self._lock:
+            offline = self._offline
+            while offline:
+                username, since = next(iter(offline.items()))
+                if now - since < self.ttl:
+                    break
+                del offline[username]
+                self.pop(username, None)
+                count += 1
+        self.expired += count
+        return count
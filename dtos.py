@@ -1,3 +1,10 @@
 from collections import namedtuple
 
-CommandDTO = namedtuple("CommandDTO", ["name", "description", "usage", "min_args"])
\ No newline at end of file
+CommandDTO = namedtuple("CommandDTO", ["name", "description", "usage", "min_args", "offload"], defaults=(False,))
+OutboundPolicyDTO = namedtuple("OutboundPolicyDTO", ["max_queue", "policy", "block_timeout", "flush_window", "max_batch"],
+                               defaults=(0.0, 64))
+SocketOptionsDTO = namedtuple("SocketOptionsDTO", ["nodelay", "send_buffer", "recv_buffer"])
+RateLimitDTO = namedtuple("RateLimitDTO", ["rate", "burst"])
+RetentionDTO = namedtuple("RetentionDTO", ["max_messages", "max_age", "max_hot_bytes", "check_interval"])
+DeliveryDTO = namedtuple("DeliveryDTO", ["max_pending", "offline_ttl"])
+HeartbeatDTO = namedtuple("HeartbeatDTO", ["ping_interval", "idle_timeout", "tick"])
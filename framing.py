@@ -0,0 +1,95 @@
+import json
+import struct
+
+# Cada frame é: tamanho do payload (4 bytes, big-endian) + payload
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """Frame maior que o tamanho máximo permitido"""
+
+
+def encode_frame(payload: bytes, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    """Prefixa o payload com o seu tamanho"""
+    if len(payload) > max_size:
+        raise FrameTooLarge(f"frame de {len(payload)} bytes excede o limite de {max_size}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_json(data: dict, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    """Serializa um dicionário em JSON e o empacota em um frame"""
+    return encode_frame(json.dumps(data).encode('utf-8'), max_size)
+
+
+class FrameDecoder:
+    """
+    Decodificador incremental: recebe bytes na ordem em que chegam do socket
+    (em pedaços arbitrários) e devolve cada frame completo acumulado no buffer.
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def feed(self, data: bytes):
+        """Acrescenta bytes recebidos ao buffer"""
+        if self._offset and self._offset >= len(self._buffer) // 2:
+            # Compacta o buffer para não crescer indefinidamente
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    def next_frame(self) -> bytes:
+        """Retorna o próximo frame completo ou None se ainda faltam bytes"""
+        available = len(self._buffer) - self._offset
+        if available < HEADER_SIZE:
+            return None
+
+        (size,) = HEADER.unpack_from(self._buffer, self._offset)
+        if size > self.max_size:
+            raise FrameTooLarge(f"frame de {size} bytes excede o limite de {self.max_size}")
+        if available < HEADER_SIZE + size:
+            return None
+
+        start = self._offset + HEADER_SIZE
+        frame = bytes(self._buffer[start:start + size])
+        self._offset = start + size
+        if self._offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
+        return frame
+
+    def __iter__(self):
+        """Itera sobre os frames completos; bytes de frames parciais permanecem no buffer"""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def pending(self) -> int:
+        """Quantidade de bytes ainda não consumidos"""
+        return len(self._buffer) - self._offset
+
+
+def send_frame(sock, payload: bytes):
+    """Envia um frame completo por um socket bloqueante"""
+    sock.sendall(encode_frame(payload))
+
+
+def recv_frame(sock, decoder: FrameDecoder, bufsize: int = 65536) -> bytes:
+    """
+    Bloqueia até haver um frame completo no decodificador.
+    Retorna None se a conexão for encerrada antes disso.
+    """
+    frame = decoder.next_frame()
+    while frame is None:
+        data = sock.recv(bufsize)
+        if not data:
+            return None
+        decoder.feed(data)
+        frame = decoder.next_frame()
+    return frame
@@ -0,0 +1,137 @@
+"""
+Heartbeat e remoção de conexões inativas.
+
+Toda leitura do socket atualiza `last_seen` da conexão (só uma atribuição,
+sem mexer em estrutura nenhuma). Quem passa `ping_interval` segundos sem
+mandar nada recebe um {'type': 'ping'}, a que o cliente responde com
+{'type': 'pong'}; quem chega a `idle_timeout` segundos é derrubado pelo
+caminho normal de desconexão. Assim um socket meio aberto (cliente que
+sumiu sem fechar a conexão) deixa de receber fan-out e libera a sua thread.
+
+Os prazos ficam em uma roda de temporização (TimerWheel) com um balde por
+`tick`: cada conexão está em um único balde e só é olhada quando ele vence.
+Se houve atividade nesse meio tempo, ela apenas volta para o balde do novo
+prazo. O custo é O(1) por conexão a cada intervalo, sem um timer por socket
+e sem percorrer todas as conexões a cada tick.
+"""
+import random
+import threading
+import time
+from codec import Message
+from dtos import HeartbeatDTO
+
+PING = Message({'type': 'ping'})
+PONG = Message({'type': 'pong'})
+
+
+def parse_heartbeat(config: dict) -> HeartbeatDTO:
+    """HeartbeatDTO a partir da seção "heartbeat" do config (None se desativada)"""
+    if not config.get("enabled", True):
+        return None
+    policy = HeartbeatDTO(
+        config.get("ping_interval_s", 30),
+        config.get("idle_timeout_s", 90),
+        config.get("tick_ms", 1000) / 1000
+    )
+    if policy.tick <= 0 or policy.ping_interval <= 0 or policy.idle_timeout < policy.ping_interval:
+        raise ValueError(f"Heartbeat inválido: {config}")
+    return policy
+
+
+class TimerWheel:
+    """
+    Roda de temporização: baldes de `tick` segundos cobrindo até `span` segundos.
+    Agendar é O(1) e advance() devolve os itens dos baldes vencidos. Não há
+    cancelamento: quem usa a roda ignora os itens que não acompanha mais quando
+    eles vencem. Atrasos maiores que a volta caem no último balde.
+    """
+
+    def __init__(self, tick: float, span: float, now: float):
+        self.tick = tick
+        self._size = int(span / tick) + 2
+        self._slots = [[] for _ in range(self._size)]
+        self._cursor = 0
+        self._time = now   # início do balde atual
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self._slots)
+
+    def schedule(self, item, delay: float):
+        """Agenda `item` para daqui a `delay` segundos (vence no tick seguinte ao prazo)"""
+        ticks = min(int(delay / self.tick) + 1, self._size - 1)
+        self._slots[(self._cursor + ticks) % self._size].append(item)
+
+    def advance(self, now: float) -> list:
+        """Avança até `now` e retira os itens dos baldes que venceram"""
+        expired = []
+        while self._time + self.tick <= now:
+            self._time += self.tick
+            self._cursor = (self._cursor + 1) % self._size
+            slot = self._slots[self._cursor]
+            if slot:
+                self._slots[self._cursor] = []
+                expired.extend(slot)
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Prazos de inatividade das conexões deste processo. `ping(username, conn)` e
+    `reap(username, conn)` são chamados fora do lock, na thread (ou no event
+    loop) que chama tick(). Cada conexão monitorada está em um único balde da
+    roda; as esquecidas saem dela quando o seu balde vence.
+    """
+
+    def __init__(self, policy: HeartbeatDTO, ping, reap):
+        self.policy = policy
+        self._ping = ping
+        self._reap = reap
+        self._wheel = TimerWheel(policy.tick, policy.idle_timeout, time.monotonic())
+        self._users = {}  # {conexão: username}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def watch(self, username: str, conn):
+        # Espalha o primeiro prazo para que uma reconexão em massa não vença toda no mesmo tick
+        delay = self.policy.ping_interval * random.uniform(0.1, 1.0)
+        with self._lock:
+            self._users[conn] = username
+            self._wheel.schedule(conn, delay)
+
+    def forget(self, conn):
+        with self._lock:
+            self._users.pop(conn, None)
+
+    def tick(self, now: float = None) -> tuple:
+        """Confere as conexões cujo prazo venceu; devolve (pings, derrubadas)"""
+        if now is None:
+            now = time.monotonic()
+        ping_interval = self.policy.ping_interval
+        idle_timeout = self.policy.idle_timeout
+        users = self._users
+        schedule = self._wheel.schedule
+        pings = []
+        reaped = []
+        with self._lock:
+            for conn in self._wheel.advance(now):
+                username = users.get(conn)
+                if username is None:
+                    continue
+                idle = now - conn.last_seen
+                if idle < ping_interval:
+                    # Houve atividade: só volta para o balde do novo prazo
+                    schedule(conn, ping_interval - idle)
+                elif conn.closed or idle >= idle_timeout:
+                    del users[conn]
+                    if not conn.closed:
+                        reaped.append((username, conn))
+                else:
+                    pings.append((username, conn))
+                    schedule(conn, min(ping_interval, idle_timeout - idle))
+        for username, conn in pings:
+            self._ping(username, conn)
+        for username, conn in reaped:
+            self._reap(username, conn)
+        return len(pings), len(reaped)
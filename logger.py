@@ -0,0 +1,184 @@
+"""
+Log estruturado e assíncrono para o servidor e o cliente.
+
+Cada registro tem um evento (a antiga etiqueta entre colchetes, ex.: 'NOVA
+CONEXÃO'), uma mensagem e campos nomeados. A thread que loga só coloca o
+registro em uma fila limitada; uma thread de fundo formata e escreve. Se a
+fila encher, o registro é descartado e contado em vez de bloquear quem envia
+mensagens.
+
+O nível TRACE (abaixo de DEBUG) é usado para o detalhe por destinatário e
+fica desligado no padrão; chamadas abaixo do nível configurado custam só uma
+comparação.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+LEVELS = {
+    'TRACE': TRACE,
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+}
+FORMATS = ('text', 'json')
+
+ROOT_NAME = "mensageria"
+
+
+class Logger:
+    """Logger com evento e campos: log.info('NOVA CONEXÃO', 'alice conectou', codec='binary')"""
+    __slots__ = ('_logger',)
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(f"{ROOT_NAME}.{name}")
+
+    def enabled(self, level: int) -> bool:
+        """Para evitar montar campos caros quando o nível está desligado"""
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level: int, event: str, message: str = "", exc_info=False, **fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, message, exc_info=exc_info, extra={'event': event, 'fields': fields})
+
+    def trace(self, event: str, message: str = "", **fields):
+        self.log(TRACE, event, message, **fields)
+
+    def debug(self, event: str, message: str = "", **fields):
+        self.log(logging.DEBUG, event, message, **fields)
+
+    def info(self, event: str, message: str = "", **fields):
+        self.log(logging.INFO, event, message, **fields)
+
+    def warning(self, event: str, message: str = "", **fields):
+        self.log(logging.WARNING, event, message, **fields)
+
+    def error(self, event: str, message: str = "", exc_info=False, **fields):
+        self.log(logging.ERROR, event, message, exc_info=exc_info, **fields)
+
+
+def get_logger(name: str) -> Logger:
+    return Logger(name)
+
+
+class TextFormatter(logging.Formatter):
+    """12:00:00.123 INFO  [NOVA CONEXÃO] alice conectou codec=binary (com `label`, ex.: 'w1', logo após o horário)"""
+
+    def __init__(self, label: str = None):
+        super().__init__()
+        self.prefix = f" {label}" if label else ""
+
+    def format(self, record: logging.LogRecord) -> str:
+        clock = time.strftime("%H:%M:%S", time.localtime(record.created))
+        line = f"{clock}.{int(record.msecs):03d}{self.prefix} {record.levelname:<5} [{getattr(record, 'event', record.name)}]"
+        message = record.getMessage()
+        if message:
+            line += " " + message
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por registro, para ferramentas de coleta de log"""
+
+    def __init__(self, label: str = None):
+        super().__init__()
+        self.label = label
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'process': self.label,
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que nunca bloqueia: com a fila cheia, descarta o registro"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # A mensagem é formatada na thread de fundo; só o traceback precisa ser capturado aqui
+        if record.exc_info:
+            record.msg = f"{record.getMessage()}\n{logging.Formatter().formatException(record.exc_info)}"
+            record.args = None
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: DroppingQueueHandler = None
+_listener: logging.handlers.QueueListener = None
+
+
+def setup_logging(config: dict = None, label: str = None):
+    """
+    Configura o log a partir da seção "logging" da configuração:
+    level (TRACE/DEBUG/INFO/WARNING/ERROR), format (text/json), file (padrão:
+    saída padrão) e queue_size (registros pendentes antes de descartar).
+    `label` identifica o processo no modo multiprocesso.
+    """
+    global _handler, _listener
+    config = config or {}
+    level = str(config.get("level", "INFO")).upper()
+    if level not in LEVELS:
+        raise ValueError(f"Nível de log desconhecido: {level}")
+    log_format = config.get("format", "text")
+    if log_format not in FORMATS:
+        raise ValueError(f"Formato de log desconhecido: {log_format}")
+
+    shutdown_logging()
+    output = logging.FileHandler(config["file"], encoding="utf-8") if config.get("file") \
+        else logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter(label) if log_format == "json" else TextFormatter(label))
+
+    log_queue = queue.Queue(config.get("queue_size", 10000))
+    _handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger(ROOT_NAME)
+    root.handlers[:] = [_handler]
+    root.setLevel(LEVELS[level])
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+
+
+def dropped_records() -> int:
+    """Registros descartados por fila cheia desde setup_logging()"""
+    return _handler.dropped if _handler is not None else 0
+
+
+def shutdown_logging():
+    """Escreve o que ainda estiver na fila e para a thread de fundo"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,76 @@
+import threading
+
+
+class Membership:
+    """
+    Mantém em sincronia os índices grupo→membros e usuário→grupos.
+    Toda alteração de participação (criação de grupo, convite aceito,
+    desconexão) passa por aqui, então consultar os grupos de um usuário
+    custa O(grupos desse usuário) em vez de percorrer todos os grupos.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._members = {}      # {group_name: set(usernames)}
+        self._user_groups = {}  # {username: set(group_names)}
+
+    def create_group(self, group_name: str, owner: str = None) -> bool:
+        """Cria o grupo (opcionalmente com o criador como membro); False se já existir"""
+        with self._lock:
+            if group_name in self._members:
+                return False
+            self._members[group_name] = set()
+            if owner is not None:
+                self.add(group_name, owner)
+            return True
+
+    def add(self, group_name: str, username: str) -> bool:
+        """Adiciona o usuário ao grupo; False se o grupo não existir ou ele já for membro"""
+        with self._lock:
+            members = self._members.get(group_name)
+            if members is None or username in members:
+                return False
+            members.add(username)
+            self._user_groups.setdefault(username, set()).add(group_name)
+            return True
+
+    def remove(self, group_name: str, username: str) -> bool:
+        with self._lock:
+            members = self._members.get(group_name)
+            if members is None or username not in members:
+                return False
+            members.discard(username)
+            groups = self._user_groups.get(username)
+            if groups is not None:
+                groups.discard(group_name)
+                if not groups:
+                    del self._user_groups[username]
+            return True
+
+    def remove_user(self, username: str) -> list[str]:
+        """Remove o usuário de todos os seus grupos e retorna quais eram"""
+        with self._lock:
+            groups = self._user_groups.pop(username, set())
+            for group_name in groups:
+                self._members[group_name].discard(username)
+            return list(groups)
+
+    def members(self, group_name: str) -> tuple:
+        """Cópia dos membros atuais (segura para iterar durante o fan-out)"""
+        with self._lock:
+            return tuple(self._members.get(group_name, ()))
+
+    def groups_of(self, username: str) -> list[str]:
+        with self._lock:
+            return list(self._user_groups.get(username, ()))
+
+    def is_member(self, group_name: str, username: str) -> bool:
+        with self._lock:
+            return username in self._members.get(group_name, ())
+
+    def group_names(self) -> list[str]:
+        with self._lock:
+            return list(self._members.keys())
+
+    def __contains__(self, group_name: str) -> bool:
+        return group_name in self._members
@@ -0,0 +1,460 @@
+import bisect
+import functools
+import json
+import struct
+import sys
+import threading
+import time
+from framing import HEADER_SIZE, encode_frame
+
+# Bits de MessageRecord.flags
+EDITED = 1
+DELETED = 2
+
+# Formato binário de um registro (usado pelo log em disco e pelos snapshots):
+# tipo, id, horário, flags, seguidos de remetente, grupo/destinatário e texto
+OP_GROUP_MESSAGE = 1
+OP_PRIVATE_MESSAGE = 2
+RECORD_HEADER = struct.Struct("!BIdBHHI")
+
+
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(seconds: int) -> str:
+    # Mensagens próximas caem no mesmo segundo; evita formatar a data de novo
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+class MessageRecord:
+    """
+    Registro compacto de uma mensagem. Usa __slots__ (sem __dict__ por instância),
+    nomes de remetente/grupo internados e o horário como float; o dicionário do
+    protocolo só é montado na hora de serializar.
+
+    O frame serializado é gerado uma única vez por codec e reaproveitado no
+    fan-out e no envio do histórico; edição e remoção invalidam o cache.
+    """
+    __slots__ = ('id', 'sender', 'group', 'recipient', 'text', 'created', 'flags', '_frame', '_binary')
+    tracked = True  # numerado e guardado na caixa de entrega do destinatário (delivery.py)
+
+    def __init__(self, message_id: int, sender: str, text: str, group: str = None,
+                 recipient: str = None, created: float = None, flags: int = 0):
+        self.id = message_id
+        self.sender = sys.intern(sender)
+        self.group = sys.intern(group) if group is not None else None
+        self.recipient = sys.intern(recipient) if recipient is not None else None
+        self.text = text
+        self.created = created if created is not None else time.time()
+        self.flags = flags
+        self._frame = None
+        self._binary = None
+
+    @property
+    def edited(self) -> bool:
+        return bool(self.flags & EDITED)
+
+    @property
+    def deleted(self) -> bool:
+        return bool(self.flags & DELETED)
+
+    def to_dict(self) -> dict:
+        """Mensagem no formato do protocolo"""
+        data = {
+            'type': 'group_message' if self.group is not None else 'private_message',
+            'sender': self.sender,
+            'message': {'message': self.text},
+            'timestamp': format_timestamp(int(self.created)),
+            'group': self.group
+        }
+        if self.recipient is not None:
+            data['message']['recipient'] = self.recipient
+            data['recipient'] = self.recipient
+        data['id'] = self.id
+        if self.flags & EDITED:
+            data['edited'] = True
+        if self.flags & DELETED:
+            data['deleted'] = True
+        return data
+
+    def frame(self, codec=None) -> bytes:
+        """Frame pronto para envio no codec do destinatário (JSON se `codec` for None)"""
+        if codec is None or codec.name == 'json':
+            if self._frame is None:
+                self._frame = encode_frame(json.dumps(self.to_dict()).encode('utf-8'))
+            return self._frame
+        if self._binary is None:
+            self._binary = codec.record_frame(self)
+        return self._binary
+
+    def encoded(self) -> memoryview:
+        """Apenas o JSON da mensagem, sem o prefixo de tamanho"""
+        return memoryview(self.frame())[HEADER_SIZE:]
+
+    def invalidate(self):
+        self._frame = None
+        self._binary = None
+
+    def pack(self) -> bytes:
+        """Serializa o registro no formato binário compacto"""
+        sender = self.sender.encode('utf-8')
+        chat = (self.group if self.group is not None else self.recipient).encode('utf-8')
+        text = self.text.encode('utf-8')
+        op = OP_GROUP_MESSAGE if self.group is not None else OP_PRIVATE_MESSAGE
+        return RECORD_HEADER.pack(op, self.id, self.created, self.flags,
+                                  len(sender), len(chat), len(text)) + sender + chat + text
+
+    @classmethod
+    def unpack(cls, buffer, offset: int = 0) -> 'MessageRecord':
+        op, message_id, created, flags, sender_len, chat_len, text_len = RECORD_HEADER.unpack_from(buffer, offset)
+        start = offset + RECORD_HEADER.size
+        sender = str(buffer[start:start + sender_len], 'utf-8')
+        start += sender_len
+        chat = str(buffer[start:start + chat_len], 'utf-8')
+        start += chat_len
+        text = str(buffer[start:start + text_len], 'utf-8')
+        if op == OP_GROUP_MESSAGE:
+            return cls(message_id, sender, text, group=chat, created=created, flags=flags)
+        return cls(message_id, sender, text, recipient=chat, created=created, flags=flags)
+
+    @staticmethod
+    def unpack_dict(buffer, offset: int = 0) -> tuple:
+        """
+        Lê um registro de pack() direto no formato do protocolo (o mesmo de to_dict),
+        sem montar o MessageRecord. Devolve (mensagem, offset depois do registro).
+        `buffer` precisa ser bytes: bytes.decode é bem mais barato que str(memoryview).
+        """
+        op, message_id, created, flags, sender_len, chat_len, text_len = RECORD_HEADER.unpack_from(buffer, offset)
+        start = offset + RECORD_HEADER.size
+        chat_start = start + sender_len
+        text_start = chat_start + chat_len
+        end = text_start + text_len
+        sender = buffer[start:chat_start].decode('utf-8')
+        chat = buffer[chat_start:text_start].decode('utf-8')
+        text = buffer[text_start:end].decode('utf-8')
+        if op == OP_GROUP_MESSAGE:
+            data = {'type': 'group_message', 'sender': sender, 'message': {'message': text},
+                    'timestamp': format_timestamp(int(created)), 'group': chat, 'id': message_id}
+        else:
+            data = {'type': 'private_message', 'sender': sender, 'message': {'message': text, 'recipient': chat},
+                    'timestamp': format_timestamp(int(created)), 'group': None, 'recipient': chat, 'id': message_id}
+        if flags & EDITED:
+            data['edited'] = True
+        if flags & DELETED:
+            data['deleted'] = True
+        return data, end
+
+
+def record_size(record: MessageRecord) -> int:
+    """Bytes aproximados de um registro em memória (objeto + texto, sem os frames em cache)"""
+    return sys.getsizeof(record) + sys.getsizeof(record.text)
+
+
+class ChatLog:
+    """
+    Mensagens de uma conversa; o id de cada mensagem é a sua posição.
+    Os primeiros ids podem estar em um segmento frio (ex.: snapshot mapeado em
+    memória), lido sob demanda; as mensagens novas ficam na lista `hot`.
+    Registros frios alterados (edição/remoção) ficam fixados em `pinned`.
+
+    Segmento frio, lista quente, índice por remetente e fixados formam um único
+    estado, trocado de uma vez quando mensagens antigas vão para o disco
+    (`evict`), então quem lê sem o lock do store nunca vê uma mistura.
+
+    `edits` lista, em ordem, os ids de cada edição/remoção; o tamanho da lista
+    é a revisão de edições da conversa, usada pelos clientes para buscar só
+    o que mudou desde a última sincronização.
+    """
+    __slots__ = ('_state', 'edits', 'hot_bytes')
+
+    def __init__(self, cold=None, edits=None):
+        # (segmento frio, [registros quentes], {sender: [ids quentes]}, {id: registro frio alterado})
+        self._state = (cold, [], {}, {})
+        self.edits = list(edits) if edits else []
+        self.hot_bytes = 0
+
+    @property
+    def cold(self):
+        return self._state[0]
+
+    @property
+    def hot(self) -> list[MessageRecord]:
+        return self._state[1]
+
+    @property
+    def by_sender(self) -> dict:
+        return self._state[2]
+
+    @property
+    def pinned(self) -> dict:
+        return self._state[3]
+
+    def _cold_count(self) -> int:
+        cold = self._state[0]
+        return len(cold) if cold is not None else 0
+
+    def __len__(self) -> int:
+        cold, hot, _, _ = self._state
+        return (len(cold) if cold is not None else 0) + len(hot)
+
+    def append(self, record: MessageRecord):
+        _, hot, by_sender, _ = self._state
+        hot.append(record)
+        by_sender.setdefault(record.sender, []).append(record.id)
+        self.hot_bytes += record_size(record)
+
+    def get(self, message_id: int) -> MessageRecord:
+        cold, hot, _, pinned = self._state
+        cold_count = len(cold) if cold is not None else 0
+        if 0 <= message_id < cold_count:
+            record = pinned.get(message_id)
+            return record if record is not None else cold.get(message_id)
+        if cold_count <= message_id < cold_count + len(hot):
+            return hot[message_id - cold_count]
+        return None
+
+    def changed(self, record: MessageRecord):
+        """Registra a edição/remoção; registros frios alterados ficam em memória"""
+        if record.id < self._cold_count():
+            self.pinned[record.id] = record
+        self.edits.append(record.id)
+
+    def edited_since(self, revision: int, up_to: int) -> list[int]:
+        """Ids (sem repetição, em ordem) alterados depois de `revision`, até o id `up_to`"""
+        return sorted({i for i in self.edits[revision:] if i <= up_to})
+
+    def records(self, start: int = 0, stop: int = None) -> list[MessageRecord]:
+        stop = len(self) if stop is None else min(stop, len(self))
+        return [self.get(i) for i in range(max(start, 0), stop)]
+
+    def sender_ids(self, sender: str) -> list[int]:
+        cold, _, by_sender, _ = self._state
+        ids = list(cold.sender_ids(sender)) if cold is not None else []
+        return ids + by_sender.get(sender, [])
+
+    def evict(self, cold, upto: int, recent_edits) -> int:
+        """
+        Passa a ler os ids menores que `upto` de `cold` (segmento de um snapshot que
+        os contém) e libera os registros quentes correspondentes. Os ids de
+        `recent_edits`, alterados depois do snapshot, continuam fixados em memória.
+        Devolve quantos registros saíram da memória. Chamado com o lock do store.
+        """
+        old_cold, hot, by_sender, _ = self._state
+        base = len(old_cold) if old_cold is not None else 0
+        drop = max(0, upto - base)
+
+        pinned = {}
+        for message_id in recent_edits:
+            if message_id < upto:
+                pinned[message_id] = self.get(message_id)
+        remaining = {}
+        for sender, ids in by_sender.items():
+            first = bisect.bisect_left(ids, upto)
+            if first < len(ids):
+                remaining[sender] = ids[first:] if first else ids
+
+        self._state = (cold, hot[drop:], remaining, pinned)
+        self.hot_bytes = max(0, self.hot_bytes - sum(record_size(record) for record in hot[:drop]))
+        return drop
+
+
+class MessageStore:
+    """
+    Histórico em memória de grupos e conversas privadas.
+    Busca por id em O(1) e índice por remetente para o /history.
+
+    Se `journal` estiver definido, toda alteração é registrada nele dentro do
+    mesmo lock que atribui os ids, então a ordem no log é a ordem dos ids.
+    Do mesmo jeito, `index` (SearchIndex) recebe as mensagens novas, editadas
+    e removidas.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.journal = None
+        self.index = None
+        self.groups = {}          # {group_name: ChatLog}
+        self.private = {}         # {(user_a, user_b): ChatLog}
+        self._private_index = {}  # {username: set(chaves das conversas privadas)}
+
+    @staticmethod
+    def private_key(user_a: str, user_b: str) -> tuple:
+        return tuple(sorted((user_a, user_b)))
+
+    def create_group(self, group_name: str):
+        with self._lock:
+            if group_name in self.groups:
+                return
+            self.groups[group_name] = ChatLog()
+            if self.journal is not None:
+                self.journal.group_created(group_name)
+
+    def _private_log(self, key: tuple, cold=None) -> ChatLog:
+        # Chamado com self._lock adquirido
+        log = self.private.get(key)
+        if log is None:
+            log = self.private[key] = ChatLog(cold)
+            for username in key:
+                self._private_index.setdefault(username, set()).add(key)
+        return log
+
+    def append_group(self, group_name: str, sender: str, text: str, created: float = None) -> MessageRecord:
+        with self._lock:
+            log = self.groups.get(group_name)
+            if log is None:
+                log = self.groups[group_name] = ChatLog()
+            record = MessageRecord(len(log), sender, text, group=group_name, created=created)
+            log.append(record)
+            if self.journal is not None:
+                self.journal.message_appended(record)
+            if self.index is not None:
+                self.index.message_appended(record)
+            return record
+
+    def append_private(self, sender: str, recipient: str, text: str, created: float = None) -> MessageRecord:
+        with self._lock:
+            log = self._private_log(self.private_key(sender, recipient))
+            record = MessageRecord(len(log), sender, text, recipient=recipient, created=created)
+            log.append(record)
+            if self.journal is not None:
+                self.journal.message_appended(record)
+            if self.index is not None:
+                self.index.message_appended(record)
+            return record
+
+    def restore(self, record: MessageRecord):
+        """Reinsere um registro lido do disco; ignora ids que já existem"""
+        with self._lock:
+            if record.group is not None:
+                log = self.groups.get(record.group)
+                if log is None:
+                    log = self.groups[record.group] = ChatLog()
+            else:
+                log = self._private_log(self.private_key(record.sender, record.recipient))
+            if record.id == len(log):
+                log.append(record)
+
+    def restore_chat(self, group_name: str = None, private_key: tuple = None, cold=None, edits=None):
+        """Cria uma conversa apoiada em um segmento frio (ex.: carregada de um snapshot)"""
+        with self._lock:
+            if group_name is not None:
+                self.groups[group_name] = ChatLog(cold, edits)
+            else:
+                self._private_log(tuple(private_key), cold).edits = list(edits or ())
+
+    def apply_update(self, update: MessageRecord):
+        """Aplica texto e flags de uma edição/remoção lida do disco"""
+        with self._lock:
+            if update.group is not None:
+                log = self.groups.get(update.group)
+            else:
+                log = self.private.get(self.private_key(update.sender, update.recipient))
+            record = log.get(update.id) if log is not None else None
+            if record is None:
+                return
+            record.text = update.text
+            record.flags = update.flags
+            record.invalidate()
+            self._changed(record)
+
+    def checkpoint(self, before=None) -> tuple:
+        """
+        Captura atomicamente (descritor, ChatLog, quantidade) de cada conversa;
+        o descritor inclui a lista de edições até o ponto de corte.
+        `before` roda com o store travado (ex.: marcar a posição do log).
+        """
+        with self._lock:
+            marker = before() if before is not None else None
+            chats = [({'group': name, 'edits': list(log.edits)}, log, len(log))
+                     for name, log in self.groups.items()]
+            chats += [({'private': list(key), 'edits': list(log.edits)}, log, len(log))
+                      for key, log in self.private.items()]
+            return marker, chats
+
+    def group_log(self, group_name: str) -> ChatLog:
+        return self.groups.get(group_name)
+
+    def private_log(self, user_a: str, user_b: str) -> ChatLog:
+        return self.private.get(self.private_key(user_a, user_b))
+
+    def private_chats(self, username: str) -> dict:
+        """{outro participante: ChatLog} de todas as conversas privadas do usuário"""
+        chats = {}
+        for key in list(self._private_index.get(username, ())):
+            other_user = key[0] if key[0] != username else key[1]
+            chats[other_user] = self.private[key]
+        return chats
+
+    def get_group_message(self, group_name: str, message_id: int) -> MessageRecord:
+        log = self.groups.get(group_name)
+        return log.get(message_id) if log is not None else None
+
+    def sender_messages(self, group_name: str, sender: str) -> list[MessageRecord]:
+        log = self.groups.get(group_name)
+        if log is None:
+            return []
+        return [log.get(i) for i in log.sender_ids(sender)]
+
+    def edit(self, record: MessageRecord, text: str):
+        with self._lock:
+            old_text = record.text
+            record.text = text
+            record.flags |= EDITED
+            record.invalidate()
+            self._changed(record)
+            if self.journal is not None:
+                self.journal.message_edited(record)
+            if self.index is not None:
+                self.index.message_edited(record, old_text)
+
+    def delete(self, record: MessageRecord):
+        with self._lock:
+            record.flags |= DELETED
+            record.invalidate()
+            self._changed(record)
+            if self.journal is not None:
+                self.journal.message_deleted(record)
+            if self.index is not None:
+                self.index.message_deleted(record)
+
+    def _changed(self, record: MessageRecord):
+        # Chamado com self._lock adquirido
+        if record.group is not None:
+            log = self.groups.get(record.group)
+        else:
+            log = self.private.get(self.private_key(record.sender, record.recipient))
+        if log is not None:
+            log.changed(record)
+
+    def spill(self, log: ChatLog, cold, count: int, edits_at_cut: int, upto: int) -> int:
+        """
+        Troca o segmento frio de `log` por `cold`, de um snapshot com as `count`
+        primeiras mensagens e as `edits_at_cut` primeiras edições da conversa,
+        mantendo em memória só os ids a partir de `upto`. Ignora a conversa se ela
+        ainda não chegou ao ponto do snapshot (réplica atrasada no modo multiprocesso).
+        """
+        with self._lock:
+            if len(log) < count or len(log.edits) < edits_at_cut:
+                return 0
+            return log.evict(cold, upto, set(log.edits[edits_at_cut:]))
+
+    def memory(self) -> dict:
+        """Mensagens em memória (quentes e frias alteradas), no disco, e bytes aproximados das quentes"""
+        logs = list(self.groups.values()) + list(self.private.values())
+        hot = pinned = hot_bytes = total = 0
+        for log in logs:
+            hot += len(log.hot)
+            pinned += len(log.pinned)
+            hot_bytes += log.hot_bytes
+            total += len(log)
+        return {'hot_messages': hot, 'cold_messages': total - hot, 'pinned': pinned, 'hot_bytes': hot_bytes}
+
+    def __len__(self) -> int:
+        logs = list(self.groups.values()) + list(self.private.values())
+        return sum(len(log) for log in logs)
+
+
+def encode_messages(messages: list[MessageRecord]) -> bytes:
+    """
+    Monta o JSON de uma lista de mensagens concatenando os bytes já
+    serializados de cada uma, sem passar a lista pelo json.dumps.
+    """
+    return b'[' + b', '.join(message.encoded() for message in messages) + b']'
@@ -0,0 +1,145 @@
+"""
+Métricas internas do servidor: contadores, histogramas de latência/tamanho e
+um profiler por amostragem.
+
+Os histogramas usam baldes em potências de 2 (valor em microssegundos ou em
+unidades, conforme o nome), então registrar uma amostra custa uma operação de
+bits e duas somas; os percentis são aproximados pelo limite superior do balde.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class Histogram:
+    """Distribuição de valores inteiros não negativos em baldes [2^(i-1), 2^i)"""
+    __slots__ = ('buckets', 'count', 'total', 'max', '_lock')
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: int):
+        value = max(int(value), 0)
+        with self._lock:
+            self.buckets[value.bit_length()] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p: float) -> int:
+        """Limite superior do balde que contém o percentil `p` (0..1)"""
+        target = self.count * p
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if amount and seen >= target:
+                return min((1 << index) - 1, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 1),
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max
+        }
+
+
+class Metrics:
+    """
+    Registro de métricas. Contadores são somados sem lock (o pior caso é perder
+    uma contagem em uma disputa entre threads); histogramas são criados sob
+    demanda pelo nome.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = Counter()
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: int):
+        self.histogram(name).observe(value)
+
+    def timed(self, name: str, start: float):
+        """Registra em `name` o tempo desde `start` (time.perf_counter()) em microssegundos"""
+        self.histogram(name).observe((time.perf_counter() - start) * 1_000_000)
+
+    def snapshot(self) -> dict:
+        return {
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'counters': dict(sorted(self.counters.items())),
+            'histograms': {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())}
+        }
+
+
+def rss_kb() -> int:
+    """RSS atual do processo em KiB (Linux, via /proc; None em outros sistemas)"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _location(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}:{code.co_name}"
+
+
+def profile(seconds: float = 5.0, interval: float = 0.005, top: int = 20) -> dict:
+    """
+    Amostra as pilhas de todas as threads a cada `interval` segundos durante
+    `seconds` e devolve as funções mais quentes: `self` conta as amostras em
+    que a função estava no topo da pilha e `total` as que ela aparecia na pilha.
+    Bloqueia quem chamou pelo tempo pedido.
+    """
+    own = threading.get_ident()
+    on_top = Counter()
+    on_stack = Counter()
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            samples += 1
+            on_top[_location(frame.f_code)] += 1
+            seen = set()
+            while frame is not None:
+                location = _location(frame.f_code)
+                if location not in seen:
+                    seen.add(location)
+                    on_stack[location] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+
+    return {
+        'seconds': seconds,
+        'samples': samples,
+        'self': [{'function': name, 'samples': count} for name, count in on_top.most_common(top)],
+        'total': [{'function': name, 'samples': count} for name, count in on_stack.most_common(top)]
+    }
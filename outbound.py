@@ -0,0 +1,185 @@
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dtos import OutboundPolicyDTO, SocketOptionsDTO
+
+# Políticas aplicadas quando a fila de saída de um cliente está cheia
+POLICIES = ('drop_oldest', 'disconnect', 'block')
+
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+def configure_socket(sock, options: SocketOptionsDTO):
+    """Aplica TCP_NODELAY e os tamanhos de buffer configurados a uma conexão aceita"""
+    if options.nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if options.send_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, options.send_buffer)
+    if options.recv_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options.recv_buffer)
+
+
+def send_vectored(sock: socket.socket, buffers: list) -> int:
+    """
+    Envia os frames de `buffers` em um único sendmsg (writev), sem concatená-los,
+    retomando de onde um envio parcial parou. Devolve quantas chamadas ao sistema fez.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return 1
+    views = [memoryview(buffer) for buffer in buffers]
+    first = 0
+    syscalls = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        syscalls += 1
+        while sent:
+            size = views[first].nbytes
+            if sent >= size:
+                sent -= size
+                first += 1
+            else:
+                views[first] = views[first][sent:]
+                sent = 0
+    return syscalls
+
+
+class SlowConsumerError(ConnectionError):
+    """Cliente não está consumindo as mensagens rápido o suficiente"""
+
+
+class OutboundQueue(ABC):
+    """
+    Fila de saída limitada de uma conexão. O broadcast apenas enfileira os frames;
+    quem escreve no socket é o writer da própria conexão, então um cliente lento
+    não atrasa os demais nem a thread de leitura de quem enviou.
+
+    Cada engine tem a sua subclasse, com o envio, o fechamento e a espera da
+    política 'block' do seu modelo de concorrência.
+    """
+
+    def __init__(self, policy: OutboundPolicyDTO):
+        if policy.policy not in POLICIES:
+            raise ValueError(f"Política de fila desconhecida: {policy.policy}")
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.codec = None    # escolhido no handshake
+        self.sequenced = False  # frames de conversa levam a sequência de entrega (ver delivery.py)
+        self.last_seen = time.monotonic()  # última leitura do socket (ver heartbeat.py)
+        self.metrics = None  # Metrics do servidor: chamadas de envio e tamanho dos lotes
+        self._queue = deque()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def _admit(self):
+        """Garante espaço para mais um frame conforme a política ou lança SlowConsumerError"""
+        if len(self._queue) < self.policy.max_queue:
+            return
+        if self.policy.policy == 'drop_oldest':
+            self._queue.popleft()
+            self.dropped += 1
+        elif self.policy.policy == 'disconnect':
+            raise SlowConsumerError(f"fila de saída cheia ({self.policy.max_queue})")
+        else:
+            self._wait_for_room()
+
+    @abstractmethod
+    def send(self, data: bytes):
+        """Enfileira um frame já codificado"""
+
+    @abstractmethod
+    def close(self):
+        """Encerra a conexão e descarta o que estiver na fila"""
+
+    @abstractmethod
+    def _wait_for_room(self):
+        """Política 'block': espera haver espaço na fila ou lança SlowConsumerError"""
+
+    def _take_batch(self) -> list:
+        """Retira da fila até max_batch frames para uma única escrita"""
+        count = min(len(self._queue), self.policy.max_batch)
+        return [self._queue.popleft() for _ in range(count)]
+
+    def _count_write(self, frames: int, syscalls: int = None):
+        """Registra um lote escrito; `syscalls` só quando as chamadas de envio são contadas de fato"""
+        if self.metrics is not None:
+            if syscalls is not None:
+                self.metrics.incr('send_syscalls', syscalls)
+            self.metrics.observe('write_batch', frames)
+
+
+class ClientConnection(OutboundQueue):
+    """
+    Conexão da engine thread: a fila é drenada por uma thread escritora própria,
+    que envia os frames pendentes em lote (até max_batch por sendmsg). Com
+    flush_window, ela espera esse tempo antes de enviar para juntar uma rajada.
+    """
+
+    def __init__(self, sock: socket.socket, policy: OutboundPolicyDTO):
+        super().__init__(policy)
+        self.sock = sock
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def send(self, data: bytes):
+        """Enfileira um frame já codificado"""
+        with self._cond:
+            if self.closed:
+                raise ConnectionError("conexão encerrada")
+            self._admit()
+            self._queue.append(data)
+            self._cond.notify_all()
+
+    def _wait_for_room(self):
+        # Chamado com self._cond adquirido
+        has_room = self._cond.wait_for(
+            lambda: self.closed or len(self._queue) < self.policy.max_queue,
+            timeout=self.policy.block_timeout
+        )
+        if self.closed:
+            raise ConnectionError("conexão encerrada")
+        if not has_room:
+            raise SlowConsumerError(f"fila de saída cheia por mais de {self.policy.block_timeout}s")
+
+    def _write_loop(self):
+        window = self.policy.flush_window
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self.closed)
+                if window and len(self._queue) < self.policy.max_batch:
+                    self._cond.wait_for(lambda: self.closed or len(self._queue) >= self.policy.max_batch,
+                                        timeout=window)
+                if self.closed:
+                    return
+                batch = self._take_batch()
+                self._cond.notify_all()
+            try:
+                syscalls = send_vectored(self.sock, batch)
+            except OSError:
+                # Derruba o socket para que a thread de leitura perceba e faça a desconexão
+                self.close()
+                return
+            self._count_write(len(batch), syscalls)
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
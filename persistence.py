@@ -0,0 +1,505 @@
+import array
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from dtos import RetentionDTO
+from logger import get_logger
+from message_store import OP_GROUP_MESSAGE, OP_PRIVATE_MESSAGE, MessageRecord, MessageStore
+from retention import MIN_SPILL, plan
+
+# Operações do log além das mensagens (OP_GROUP_MESSAGE / OP_PRIVATE_MESSAGE)
+OP_GROUP_CREATED = 10
+OP_UPDATE = 11          # edição/remoção: registro da mensagem com texto e flags novos
+OP_INVITE = 12
+OP_INVITE_CLOSED = 13
+
+FSYNC_MODES = ('always', 'interval', 'none')
+
+log = get_logger("persistencia")
+
+# Cada entrada do WAL: tamanho do payload, crc32 do payload, payload
+WAL_ENTRY = struct.Struct("!II")
+SNAPSHOT_MAGIC = b"MSGSNAP1"
+SNAPSHOT_TRAILER = struct.Struct("!Q8s")
+RECORD_SIZE = struct.Struct("!I")
+
+
+def pack_strings(op: int, *values: str) -> bytes:
+    parts = [bytes([op])]
+    for value in values:
+        data = value.encode('utf-8')
+        parts.append(RECORD_SIZE.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_strings(buffer, offset: int = 1) -> list[str]:
+    values = []
+    while offset < len(buffer):
+        (size,) = RECORD_SIZE.unpack_from(buffer, offset)
+        offset += RECORD_SIZE.size
+        values.append(str(buffer[offset:offset + size], 'utf-8'))
+        offset += size
+    return values
+
+
+class WriteAheadLog:
+    """
+    Log append-only dividido em segmentos (wal-000001.log, ...).
+    fsync: 'always' sincroniza a cada registro; 'interval' acumula e sincroniza
+    a cada `fsync_interval` segundos em uma thread, sem segurar quem escreve;
+    'none' deixa a cargo do SO.
+    """
+
+    def __init__(self, directory: str, fsync: str = 'interval', fsync_interval: float = 0.05,
+                 segment_bytes: int = 64 * 1024 * 1024):
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"Modo de fsync desconhecido: {fsync}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._dirty = False
+        self._closed = False
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"wal-{segment:06d}.log")
+
+    def segments(self) -> list[int]:
+        names = glob.glob(os.path.join(self.directory, "wal-*.log"))
+        return sorted(int(os.path.basename(name)[4:-4]) for name in names)
+
+    def replay(self, segment: int, offset: int, repair: bool = True):
+        """
+        Itera sobre os payloads a partir da posição (segmento, offset).
+        Um registro incompleto ou corrompido no fim do último segmento (escrita
+        interrompida) é descartado e, com `repair`, o arquivo truncado nesse ponto.
+        """
+        segments = [s for s in self.segments() if s >= segment]
+        for index, current in enumerate(segments):
+            with open(self.path(current), 'rb') as f:
+                data = f.read()
+            position = offset if current == segment else 0
+            while position < len(data):
+                end = position + WAL_ENTRY.size
+                if end > len(data):
+                    break
+                size, crc = WAL_ENTRY.unpack_from(data, position)
+                payload = data[end:end + size]
+                if len(payload) < size or zlib.crc32(payload) != crc:
+                    break
+                yield payload
+                position = end + size
+
+            if position < len(data):
+                if index == len(segments) - 1:
+                    log.warning("WAL", f"Registro incompleto descartado em {self.path(current)}:{position}")
+                    if repair:
+                        os.truncate(self.path(current), position)
+                else:
+                    log.error("WAL", f"Segmento corrompido {self.path(current)}:{position}, ignorando o restante")
+                    return
+
+    def open(self):
+        """Abre o segmento atual para escrita (após a recuperação)"""
+        self._file = open(self.path(self.segment), 'ab')
+        self._size = self._file.tell()
+        if self.fsync != 'always':
+            threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def append(self, payload: bytes):
+        entry = WAL_ENTRY.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            self._file.write(entry)
+            self._size += len(entry)
+            self.appended += 1
+            if self.fsync == 'always':
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            else:
+                self._dirty = True
+            if self._size >= self.segment_bytes:
+                self._rotate()
+
+    def position(self) -> tuple:
+        with self._lock:
+            return (self.segment, self._size)
+
+    def rotate(self) -> tuple:
+        """Inicia um novo segmento e retorna a posição inicial dele"""
+        with self._lock:
+            self._rotate()
+            return (self.segment, 0)
+
+    def _rotate(self):
+        # Chamado com self._lock adquirido
+        self._sync()
+        self._file.close()
+        self.segment += 1
+        self._file = open(self.path(self.segment), 'ab')
+        self._size = 0
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync != 'none':
+            os.fsync(self._file.fileno())
+        self._dirty = False
+
+    def _sync_loop(self):
+        while not self._closed:
+            time.sleep(self.fsync_interval)
+            # Sob o lock só o flush do buffer: o fsync roda fora dele, para que append()
+            # (chamado com o lock do MessageStore) nunca espere o disco. Ele usa uma cópia
+            # do descritor, então _rotate/close podem fechar o arquivo durante o fsync
+            with self._lock:
+                if not self._dirty or self._closed:
+                    continue
+                self._file.flush()
+                self._dirty = False
+                if self.fsync == 'none':
+                    continue
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def delete_before(self, segment: int):
+        for current in self.segments():
+            if current < segment:
+                os.remove(self.path(current))
+
+    def close(self):
+        with self._lock:
+            if self._closed or self._file is None:
+                return
+            self._closed = True
+            self._sync()
+            self._file.close()
+
+
+class ColdSegment:
+    """
+    Mensagens de uma conversa dentro de um snapshot mapeado em memória (mmap).
+    Nada é decodificado na carga: cada registro é lido sob demanda pelo offset.
+    """
+    __slots__ = ('_buffer', '_offsets', '_senders')
+
+    def __init__(self, buffer: memoryview, offsets_pos: int, count: int, senders: dict):
+        self._buffer = buffer
+        self._offsets = buffer[offsets_pos:offsets_pos + 8 * count].cast('Q')
+        self._senders = senders  # {sender: [posição, quantidade]}
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def raw(self, message_id: int) -> memoryview:
+        offset = self._offsets[message_id]
+        (size,) = RECORD_SIZE.unpack_from(self._buffer, offset)
+        start = offset + RECORD_SIZE.size
+        return self._buffer[start:start + size]
+
+    def get(self, message_id: int) -> MessageRecord:
+        return MessageRecord.unpack(self.raw(message_id))
+
+    def sender_ids(self, sender: str):
+        entry = self._senders.get(sender)
+        if entry is None:
+            return ()
+        position, count = entry
+        ids = self._buffer[position:position + 4 * count].cast('I')
+        # O segmento pode cobrir só o começo da conversa no snapshot (retenção)
+        return ids[:bisect.bisect_left(ids, len(self))]
+
+    def senders(self) -> dict:
+        return {sender: self.sender_ids(sender) for sender in self._senders}
+
+
+def write_snapshot(path: str, wal_position: tuple, chats: list, invites: dict):
+    """
+    Grava um snapshot: registros de cada conversa, tabela de offsets por id e
+    índice por remetente, com um rodapé JSON descrevendo onde fica cada parte.
+    """
+    tmp_path = path + ".tmp"
+    index = []
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        position = len(SNAPSHOT_MAGIC)
+        for descriptor, log, count in chats:
+            offsets = array.array('Q')
+            by_sender = {}
+            cold_count = len(log.cold) if log.cold is not None else 0
+
+            if cold_count:
+                for sender, ids in log.cold.senders().items():
+                    by_sender[sender] = array.array('I', ids)
+
+            for message_id in range(count):
+                pinned = log.pinned.get(message_id)
+                if message_id < cold_count and pinned is None:
+                    # Registro frio sem alterações: copia os bytes direto do snapshot anterior
+                    data = log.cold.raw(message_id)
+                else:
+                    record = pinned if pinned is not None else log.get(message_id)
+                    data = record.pack()
+                    if message_id >= cold_count:
+                        by_sender.setdefault(record.sender, array.array('I')).append(message_id)
+                offsets.append(position)
+                f.write(RECORD_SIZE.pack(len(data)))
+                f.write(data)
+                position += RECORD_SIZE.size + len(data)
+
+            entry = dict(descriptor, count=count, offsets=position, senders={})
+            f.write(offsets.tobytes())
+            position += len(offsets) * offsets.itemsize
+            for sender, ids in by_sender.items():
+                entry['senders'][sender] = [position, len(ids)]
+                f.write(ids.tobytes())
+                position += len(ids) * ids.itemsize
+            index.append(entry)
+
+        footer = json.dumps({'wal': list(wal_position), 'invites': invites, 'chats': index}).encode('utf-8')
+        f.write(footer)
+        f.write(SNAPSHOT_TRAILER.pack(len(footer), SNAPSHOT_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str) -> tuple:
+    """Mapeia o snapshot em memória e retorna (buffer, rodapé)"""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer = memoryview(mapped)
+    footer_size, magic = SNAPSHOT_TRAILER.unpack_from(buffer, len(buffer) - SNAPSHOT_TRAILER.size)
+    if magic != SNAPSHOT_MAGIC or buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"Snapshot inválido: {path}")
+    footer_end = len(buffer) - SNAPSHOT_TRAILER.size
+    footer = json.loads(bytes(buffer[footer_end - footer_size:footer_end]))
+    return buffer, footer
+
+
+class Persistence:
+    """
+    Journal do MessageStore: registra cada alteração no WAL e gera snapshots
+    periódicos. Na inicialização carrega o snapshot mais recente via mmap e
+    reaplica apenas o trecho do log posterior a ele.
+
+    Com uma política de retenção, cada snapshot novo também vira a camada fria
+    do histórico: as conversas passam a ler dele as mensagens antigas e os
+    registros que saíram da política deixam a memória (retention.py).
+    """
+
+    def __init__(self, directory: str, store: MessageStore, invites: dict, fsync: str = 'interval',
+                 fsync_interval: float = 0.05, segment_bytes: int = 64 * 1024 * 1024,
+                 snapshot_every: int = 100000, retention: RetentionDTO = None):
+        self.directory = directory
+        self.store = store
+        self.invites = invites
+        self.snapshot_every = snapshot_every
+        self.retention = retention
+        self.wal = WriteAheadLog(directory, fsync, fsync_interval, segment_bytes)
+        self._snapshot_lock = threading.Lock()
+        self._last_snapshot_count = 0
+        self._last_retention_check = time.monotonic()
+        self._closed = False
+
+    # --- recuperação -------------------------------------------------------
+
+    def _snapshots(self) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "snapshot-*.snap")))
+
+    def recover(self, writer: bool = True) -> dict:
+        """
+        Restaura o estado do disco e passa a registrar as alterações do store.
+        Com `writer=False` apenas lê (réplicas no modo multiprocesso, onde um
+        único processo grava o log).
+        """
+        start = time.perf_counter()
+        position = (self.wal.segments()[0], 0) if self.wal.segments() else (1, 0)
+        snapshot_messages = 0
+
+        snapshots = self._snapshots()
+        if snapshots:
+            buffer, footer = load_snapshot(snapshots[-1])
+            for chat in footer['chats']:
+                cold = ColdSegment(buffer, chat['offsets'], chat['count'], chat['senders'])
+                self.store.restore_chat(chat.get('group'), chat.get('private'), cold, chat.get('edits'))
+                snapshot_messages += chat['count']
+            for username, invites in footer['invites'].items():
+                self.invites[username] = invites
+            position = tuple(footer['wal'])
+
+        replayed = 0
+        for payload in self.wal.replay(*position, repair=writer):
+            self._apply(payload)
+            replayed += 1
+
+        if writer:
+            self.wal.open()
+            self.store.journal = self
+            threading.Thread(target=self._snapshot_loop, daemon=True).start()
+        elif self.retention is not None:
+            threading.Thread(target=self._follow_loop, args=(snapshots[-1] if snapshots else None,),
+                             daemon=True).start()
+        return {
+            'snapshot_messages': snapshot_messages,
+            'replayed': replayed,
+            'seconds': time.perf_counter() - start
+        }
+
+    def _apply(self, payload: bytes):
+        op = payload[0]
+        if op in (OP_GROUP_MESSAGE, OP_PRIVATE_MESSAGE):
+            self.store.restore(MessageRecord.unpack(payload))
+        elif op == OP_UPDATE:
+            self.store.apply_update(MessageRecord.unpack(payload, 1))
+        elif op == OP_GROUP_CREATED:
+            (group_name,) = unpack_strings(payload)
+            self.store.create_group(group_name)
+        elif op == OP_INVITE:
+            username, group_name, invited_by = unpack_strings(payload)
+            invite = {'group': group_name, 'invited_by': invited_by}
+            invites = self.invites.setdefault(username, [])
+            if invite not in invites:
+                invites.append(invite)
+        elif op == OP_INVITE_CLOSED:
+            username, group_name = unpack_strings(payload)
+            self._close_invite(username, group_name)
+
+    def _close_invite(self, username: str, group_name: str):
+        if username in self.invites:
+            self.invites[username] = [i for i in self.invites[username] if i['group'] != group_name]
+            if not self.invites[username]:
+                del self.invites[username]
+
+    # --- journal (chamado pelo MessageStore dentro do seu lock) -----------
+
+    def message_appended(self, record: MessageRecord):
+        self.wal.append(record.pack())
+
+    def message_edited(self, record: MessageRecord):
+        self.wal.append(bytes([OP_UPDATE]) + record.pack())
+
+    def message_deleted(self, record: MessageRecord):
+        self.wal.append(bytes([OP_UPDATE]) + record.pack())
+
+    def group_created(self, group_name: str):
+        self.wal.append(pack_strings(OP_GROUP_CREATED, group_name))
+
+    # --- convites (chamados pelo Server depois de alterar pending_invites) -
+
+    def invite_added(self, username: str, group_name: str, invited_by: str):
+        self.wal.append(pack_strings(OP_INVITE, username, group_name, invited_by))
+
+    def invite_closed(self, username: str, group_name: str):
+        self.wal.append(pack_strings(OP_INVITE_CLOSED, username, group_name))
+
+    # --- snapshots ---------------------------------------------------------
+
+    def snapshot(self) -> str:
+        """
+        Gera um snapshot do estado atual. O ponto de corte é capturado com o
+        store travado; a gravação acontece sem travar, e alterações feitas
+        durante ela também estão no log (reaplicá-las é idempotente).
+        """
+        with self._snapshot_lock:
+            position, chats = self.store.checkpoint(self.wal.rotate)
+            invites = json.loads(json.dumps(self.invites))
+            self._last_snapshot_count = self.wal.appended
+
+            path = os.path.join(self.directory, f"snapshot-{position[0]:06d}.snap")
+            write_snapshot(path, position, chats, invites)
+
+            # O novo snapshot substitui os anteriores e os segmentos que ele já cobre
+            for old in self._snapshots():
+                if old != path:
+                    try:
+                        os.remove(old)
+                    except OSError:
+                        pass
+            self.wal.delete_before(position[0])
+            if self.retention is not None:
+                self._spill(path)
+            return path
+
+    def _spill(self, path: str):
+        """
+        Passa a ler do snapshot `path` as mensagens que ele contém e libera da
+        memória as que a política de retenção não mantém quentes. Todas as
+        conversas trocam de segmento, então os snapshots anteriores deixam de
+        ficar mapeados.
+        """
+        buffer, footer = load_snapshot(path)
+        chats = []
+        for chat in footer['chats']:
+            if 'group' in chat:
+                chat_log = self.store.group_log(chat['group'])
+            else:
+                chat_log = self.store.private.get(tuple(chat['private']))
+            if chat_log is not None:
+                chats.append((chat, chat_log))
+
+        boundaries, _, _ = plan([chat_log for _, chat_log in chats], self.retention, time.time())
+        evicted = 0
+        for chat, chat_log in chats:
+            base = len(chat_log.cold) if chat_log.cold is not None else 0
+            upto = min(chat['count'], max(base, boundaries.get(chat_log, base)))
+            if not upto or upto < base:
+                continue
+            cold = ColdSegment(buffer, chat['offsets'], upto, chat['senders'])
+            evicted += self.store.spill(chat_log, cold, chat['count'], len(chat.get('edits', ())), upto)
+        log.info("RETENÇÃO", f"{evicted} mensagens passaram para o disco", snapshot=os.path.basename(path),
+                 **self.store.memory())
+
+    def _retention_due(self) -> bool:
+        """Se vale gerar um snapshot antes da hora para liberar memória"""
+        now = time.monotonic()
+        if self.retention is None or now - self._last_retention_check < self.retention.check_interval:
+            return False
+        self._last_retention_check = now
+        logs = list(self.store.groups.values()) + list(self.store.private.values())
+        _, evicted, over_budget = plan(logs, self.retention, time.time())
+        return evicted >= MIN_SPILL or (over_budget and evicted > 0)
+
+    def _snapshot_loop(self):
+        while not self._closed:
+            time.sleep(1)
+            if self.wal.appended - self._last_snapshot_count >= self.snapshot_every or self._retention_due():
+                start = time.perf_counter()
+                path = self.snapshot()
+                log.info("SNAPSHOT", path, seconds=round(time.perf_counter() - start, 2))
+
+    def _follow_loop(self, current: str):
+        """
+        Réplicas do modo multiprocesso não gravam: acompanham os snapshots do
+        trabalhador 0 e aplicam a mesma retenção a partir deles.
+        """
+        while not self._closed:
+            time.sleep(self.retention.check_interval)
+            snapshots = self._snapshots()
+            if not snapshots or snapshots[-1] == current:
+                continue
+            try:
+                self._spill(snapshots[-1])
+                current = snapshots[-1]
+            except (OSError, ValueError) as e:
+                # Substituído por um mais novo enquanto era lido; fica para a próxima
+                log.warning("RETENÇÃO", f"Snapshot {snapshots[-1]} indisponível: {e}")
+
+    def close(self):
+        self._closed = True
+        self.wal.close()
@@ -0,0 +1,68 @@
+import threading
+
+
+class PresenceCoalescer:
+    """
+    Acumula eventos de presença e de grupos e os entrega como um único delta
+    a cada janela de `window` segundos. Dentro da janela só vale o último estado
+    de cada usuário (ex.: sair e voltar vira apenas 'online').
+
+    `flush(delta)` é chamado com o delta pronto; `schedule(delay, fn)` agenda a
+    execução do flush (thread Timer ou event loop, conforme a engine).
+    """
+
+    def __init__(self, window: float, flush, schedule):
+        self.window = window
+        self._flush_callback = flush
+        self._schedule = schedule
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._reset()
+
+    def _reset(self):
+        self._presence = {}       # {username: True (online) / False (offline)}
+        self._groups_created = []
+        self._joined = {}         # {group_name: [usernames]}
+
+    def user_online(self, username: str):
+        with self._lock:
+            self._presence[username] = True
+            self._schedule_flush()
+
+    def user_offline(self, username: str):
+        with self._lock:
+            self._presence[username] = False
+            self._schedule_flush()
+
+    def group_created(self, group_name: str):
+        with self._lock:
+            self._groups_created.append(group_name)
+            self._schedule_flush()
+
+    def member_joined(self, group_name: str, username: str):
+        with self._lock:
+            members = self._joined.setdefault(group_name, [])
+            if username not in members:
+                members.append(username)
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        # Chamado com self._lock adquirido
+        if not self._scheduled:
+            self._scheduled = True
+            self._schedule(self.window, self.flush)
+
+    def flush(self):
+        with self._lock:
+            self._scheduled = False
+            delta = {
+                'type': 'presence_delta',
+                'online': [u for u, online in self._presence.items() if online],
+                'offline': [u for u, online in self._presence.items() if not online],
+                'groups_created': self._groups_created,
+                'joined': self._joined
+            }
+            self._reset()
+
+        if delta['online'] or delta['offline'] or delta['groups_created'] or delta['joined']:
+            self._flush_callback(delta)
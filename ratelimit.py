@@ -0,0 +1,99 @@
+"""
+Limite de taxa por usuário (token bucket), aplicado a cada frame recebido antes
+de ele ir para o barramento.
+
+Cada usuário tem um balde para o total de frames e um por tipo de mensagem (ou
+por comando, no caso de mensagens de grupo que começam com '/'), com a taxa e a
+rajada definidas em config/server.json. Quem passa do limite não tem o pedido
+recusado: a conexão espera o tempo que o balde leva para repor a ficha antes
+de tratar o frame, e não lê o socket enquanto isso. Com a leitura parada o
+buffer do kernel enche e o próprio cliente passa a esperar para enviar.
+"""
+import time
+from dtos import RateLimitDTO
+
+COMMAND_PREFIX = "/"
+
+
+class TokenBucket:
+    """Até `burst` fichas, repostas a `rate` por segundo; o saldo pode ficar negativo"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, limit: RateLimitDTO, now: float):
+        self.rate = limit.rate
+        self.burst = limit.burst
+        self.tokens = float(limit.burst)
+        self.stamp = now
+
+    def take(self, now: float) -> float:
+        """Gasta uma ficha; devolve os segundos até o saldo voltar a zero (0 se havia ficha)"""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        tokens -= 1
+        self.tokens = tokens
+        self.stamp = now
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+
+def parse_limit(config: dict) -> RateLimitDTO:
+    limit = RateLimitDTO(float(config["rate"]), float(config.get("burst", config["rate"])))
+    if limit.rate <= 0 or limit.burst < 1:
+        raise ValueError(f"Limite de taxa inválido: {config}")
+    return limit
+
+
+class RateLimiter:
+    """
+    Baldes de cada usuário: {username: {tipo: TokenBucket}}. Cada usuário só é
+    tratado pela sua conexão (thread ou task), então não há lock.
+
+    `total` limita todos os frames do usuário; `types` cada tipo de mensagem e
+    `commands` cada comando. Comandos sem limite próprio contam como group_message;
+    tipos sem limite só contam no total.
+    """
+
+    def __init__(self, config: dict):
+        self.total = parse_limit(config["total"]) if config.get("total") else None
+        self.limits = {kind: parse_limit(limit) for kind, limit in config.get("types", {}).items()}
+        for name, limit in config.get("commands", {}).items():
+            self.limits[COMMAND_PREFIX + name] = parse_limit(limit)
+        self._buckets = {}
+
+    @staticmethod
+    def kind_of(data: dict) -> str:
+        kind = data.get('type')
+        if kind == 'group_message':
+            text = data.get('message')
+            if isinstance(text, str) and text.startswith(COMMAND_PREFIX):
+                name = text[1:].split(None, 1)
+                return COMMAND_PREFIX + name[0] if name else kind
+        return kind
+
+    def _take(self, buckets: dict, kind: str, limit: RateLimitDTO, now: float) -> float:
+        bucket = buckets.get(kind)
+        if bucket is None:
+            bucket = buckets[kind] = TokenBucket(limit, now)
+        return bucket.take(now)
+
+    def acquire(self, username: str, data: dict) -> float:
+        """Debita o frame `data` de `username`; devolve quantos segundos a conexão deve esperar"""
+        buckets = self._buckets.get(username)
+        if buckets is None:
+            buckets = self._buckets[username] = {}
+        now = time.monotonic()
+        delay = 0.0
+        if self.total is not None:
+            delay = self._take(buckets, None, self.total, now)
+
+        kind = self.kind_of(data)
+        limit = self.limits.get(kind)
+        if limit is None and kind is not None and kind.startswith(COMMAND_PREFIX):
+            kind = 'group_message'
+            limit = self.limits.get(kind)
+        if limit is not None:
+            delay = max(delay, self._take(buckets, kind, limit, now))
+        return delay
+
+    def forget(self, username: str):
+        self._buckets.pop(username, None)
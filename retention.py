@@ -0,0 +1,78 @@
+"""
+Política de retenção do histórico em memória.
+
+As mensagens de cada conversa ficam em memória (quentes) até passarem de um
+dos limites: `max_messages` por conversa, `max_age` segundos de idade ou, na
+soma de todas as conversas, `max_hot_bytes`. As que passam continuam no
+histórico, mas só no disco: a cada snapshot a Persistence troca o segmento
+frio de cada conversa pelo do snapshot novo e libera os registros quentes que
+ele já cobre (ChatLog.evict). Os ids não mudam, e /history e a sincronização
+do histórico leem as mensagens frias do snapshot mapeado em memória.
+"""
+import bisect
+import heapq
+from dtos import RetentionDTO
+from message_store import ChatLog, record_size
+
+# Um snapshot fora de hora só é gerado se liberar pelo menos isso (ou se o orçamento estourou)
+MIN_SPILL = 1000
+
+
+def parse_retention(config: dict) -> RetentionDTO:
+    """RetentionDTO a partir da seção "retention" do config (None se desativada)"""
+    if not config.get("enabled", False):
+        return None
+    return RetentionDTO(
+        config.get("max_messages", 0),
+        config.get("max_age_hours", 0) * 3600,
+        config.get("max_hot_mb", 0) * 1024 * 1024,
+        config.get("check_interval_s", 30)
+    )
+
+
+def plan(logs: list[ChatLog], policy: RetentionDTO, now: float) -> tuple:
+    """
+    Calcula até onde cada conversa pode sair da memória. Devolve
+    ({ChatLog: primeiro id que fica quente}, mensagens liberadas, orçamento estourado).
+    """
+    boundaries = {}
+    evicted = 0
+    hot_bytes = 0
+    for log in logs:
+        cold, hot = log.cold, log.hot
+        base = len(cold) if cold is not None else 0
+        total = base + len(hot)
+        boundary = base
+        if policy.max_messages:
+            boundary = max(boundary, total - policy.max_messages)
+        if policy.max_age:
+            boundary = max(boundary, base + bisect.bisect_left(hot, now - policy.max_age,
+                                                               key=lambda record: record.created))
+        boundary = min(boundary, total)
+        hot_bytes += log.hot_bytes
+        if boundary > base:
+            boundaries[log] = boundary
+            evicted += boundary - base
+            if policy.max_hot_bytes:
+                hot_bytes -= sum(record_size(record) for record in hot[:boundary - base])
+
+    over_budget = bool(policy.max_hot_bytes) and hot_bytes > policy.max_hot_bytes
+    if over_budget:
+        # Libera as mensagens mais antigas entre todas as conversas até caber no orçamento
+        heap = []
+        for order, log in enumerate(logs):
+            cold, hot = log.cold, log.hot
+            base = len(cold) if cold is not None else 0
+            position = boundaries.get(log, base) - base
+            if position < len(hot):
+                heap.append((hot[position].created, order, log, position, base))
+        heapq.heapify(heap)
+        while heap and hot_bytes > policy.max_hot_bytes:
+            _, order, log, position, base = heapq.heappop(heap)
+            hot = log.hot
+            hot_bytes -= record_size(hot[position])
+            boundaries[log] = base + position + 1
+            evicted += 1
+            if position + 1 < len(hot):
+                heapq.heappush(heap, (hot[position + 1].created, order, log, position + 1, base))
+    return boundaries, evicted, over_budget
@@ -0,0 +1,262 @@
+"""
+Índice invertido do histórico, usado pelo /search.
+
+Para cada conversa (grupo ou par de usuários) o índice guarda, por termo, um
+array('I') ordenado com os ids das mensagens que o contêm. Os termos são as
+palavras do texto em minúsculas e sem acentos, internadas e compartilhadas
+entre as conversas.
+
+Uma busca exige todos os termos. Em cada conversa visível ao usuário, percorre
+os ids do termo mais raro, da mensagem mais nova para a mais antiga, confere
+os demais termos por busca binária e intercala as conversas pelo horário.
+Como todo resultado contém os mesmos termos, a ordem é da mais nova para a
+mais antiga, e o custo de uma página é proporcional a ela, não ao total de
+resultados.
+
+O MessageStore atualiza o índice a cada mensagem nova, edição e remoção. Na
+inicialização, as conversas recuperadas do disco são indexadas em uma thread
+de fundo; até isso terminar a busca nelas pode vir incompleta. Cada resultado
+é conferido com o texto atual da mensagem antes de ser devolvido.
+"""
+import array
+import bisect
+import heapq
+import re
+import sys
+import threading
+import time
+import unicodedata
+from message_store import MessageRecord
+
+WORD = re.compile(r"\w+")
+COMBINING = re.compile("[̀-ͯ]")  # acentos separados pelo NFKD
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text: str) -> set[str]:
+    """Termos distintos do texto: 'Histórico do GRUPO' → {'historico', 'do', 'grupo'}"""
+    text = text.lower()
+    if not text.isascii():
+        text = COMBINING.sub('', unicodedata.normalize('NFKD', text))
+    return {word for word in WORD.findall(text) if len(word) <= MAX_TERM_LENGTH}
+
+
+def chat_key(record: MessageRecord) -> tuple:
+    """('group', nome) ou ('individual', (usuário_a, usuário_b))"""
+    if record.group is not None:
+        return ('group', record.group)
+    return ('individual', tuple(sorted((record.sender, record.recipient))))
+
+
+class ChatIndex:
+    """Termos de uma conversa: {termo: array('I') com os ids em ordem crescente}"""
+    __slots__ = ('postings', 'ready')
+
+    def __init__(self, ready: bool = True):
+        self.postings = {}
+        self.ready = ready
+
+    def add(self, message_id: int, terms):
+        postings = self.postings
+        for term in terms:
+            ids = postings.get(term)
+            if ids is None:
+                postings[sys.intern(term)] = array.array('I', (message_id,))
+            elif ids[-1] < message_id:
+                ids.append(message_id)
+            else:
+                # Edição de uma mensagem antiga: insere na posição
+                position = bisect.bisect_left(ids, message_id)
+                if position == len(ids) or ids[position] != message_id:
+                    ids.insert(position, message_id)
+
+    def remove(self, message_id: int, terms):
+        postings = self.postings
+        for term in terms:
+            ids = postings.get(term)
+            if ids is None:
+                continue
+            position = bisect.bisect_left(ids, message_id)
+            if position < len(ids) and ids[position] == message_id:
+                del ids[position]
+                if not ids:
+                    del postings[term]
+
+    def matches(self, terms: list[str]):
+        """Ids que contêm todos os termos, do mais novo para o mais antigo"""
+        lists = []
+        for term in terms:
+            ids = self.postings.get(term)
+            if not ids:
+                return
+            lists.append(ids)
+        lists.sort(key=len)
+        rarest, others = lists[0], lists[1:]
+        position = len(rarest) - 1
+        while position >= 0:
+            if position >= len(rarest):
+                # A lista encolheu (remoção concorrente)
+                position = len(rarest) - 1
+                continue
+            message_id = rarest[position]
+            position -= 1
+            for ids in others:
+                found = bisect.bisect_left(ids, message_id)
+                if found == len(ids) or ids[found] != message_id:
+                    break
+            else:
+                yield message_id
+
+
+class SearchIndex:
+    """
+    Índice de todas as conversas. As atualizações vêm do MessageStore, dentro
+    do lock dele; as buscas não travam nada (rodam no pool de comandos).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chats = {}  # {chat_key: ChatIndex}
+        self.building = False
+
+    def _chat(self, key: tuple) -> ChatIndex:
+        chat = self.chats.get(key)
+        if chat is None:
+            chat = self.chats[key] = ChatIndex()
+        return chat
+
+    # --- atualizações (chamadas pelo MessageStore dentro do seu lock) ------
+
+    def message_appended(self, record: MessageRecord):
+        terms = tokenize(record.text)
+        with self._lock:
+            self._chat(chat_key(record)).add(record.id, terms)
+
+    def message_edited(self, record: MessageRecord, old_text: str):
+        old_terms = tokenize(old_text)
+        new_terms = tokenize(record.text)
+        with self._lock:
+            chat = self._chat(chat_key(record))
+            chat.remove(record.id, old_terms - new_terms)
+            chat.add(record.id, new_terms - old_terms)
+
+    def message_deleted(self, record: MessageRecord):
+        terms = tokenize(record.text)
+        with self._lock:
+            self._chat(chat_key(record)).remove(record.id, terms)
+
+    # --- construção inicial ------------------------------------------------
+
+    def attach(self, store):
+        """
+        Passa a receber as alterações do store e indexa em segundo plano as
+        conversas que ele já tem. O ponto de corte é capturado com o store
+        travado: o que vier depois entra pelas atualizações normais.
+        """
+        def mark():
+            store.index = self
+            self.building = True
+
+        _, chats = store.checkpoint(mark)
+        pending = []
+        with self._lock:
+            for descriptor, log, count in chats:
+                if not count:
+                    continue
+                if 'group' in descriptor:
+                    key = ('group', descriptor['group'])
+                else:
+                    key = ('individual', tuple(descriptor['private']))
+                # Pode já ter recebido mensagens novas depois do ponto de corte
+                self._chat(key).ready = False
+                pending.append((key, log, count))
+        threading.Thread(target=self._build, args=(pending,), daemon=True).start()
+
+    def _build(self, pending: list):
+        for key, log, count in pending:
+            base = {}
+            for message_id in range(count):
+                record = log.get(message_id)
+                if record is None or record.deleted:
+                    continue
+                for term in tokenize(record.text):
+                    ids = base.get(term)
+                    if ids is None:
+                        base[sys.intern(term)] = array.array('I', (message_id,))
+                    else:
+                        ids.append(message_id)
+                if message_id % 10000 == 0:
+                    time.sleep(0)  # cede a vez às threads que atendem os clientes
+
+            with self._lock:
+                chat = self.chats[key]
+                # Alterações feitas durante a construção foram para chat.postings
+                for term, live in chat.postings.items():
+                    ids = base.get(term)
+                    if ids is None:
+                        base[term] = live
+                    elif live[0] > ids[-1]:
+                        ids.extend(live)
+                    else:
+                        base[term] = array.array('I', sorted(set(ids) | set(live)))
+                chat.postings = base
+                chat.ready = True
+        self.building = False
+
+    # --- consulta ----------------------------------------------------------
+
+    def search(self, chats: list[tuple], query: str, offset: int = 0, limit: int = 10) -> tuple:
+        """
+        Busca `query` nas conversas `chats` ([(chat_key, ChatLog)]) e devolve
+        ([(chat_key, MessageRecord)], has_more), da mensagem mais nova para a mais antiga.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return [], False
+        ordered = sorted(terms)
+
+        heap = []
+        for order, (key, log) in enumerate(chats):
+            chat = self.chats.get(key)
+            if chat is None or log is None:
+                continue
+            matches = chat.matches(ordered)
+            self._push(heap, order, key, log, matches, terms)
+
+        hits = []
+        while heap and len(hits) <= offset + limit:
+            _, order, _, key, record, log, matches = heapq.heappop(heap)
+            hits.append((key, record))
+            self._push(heap, order, key, log, matches, terms)
+        return hits[offset:offset + limit], len(hits) > offset + limit
+
+    @staticmethod
+    def _push(heap: list, order: int, key: tuple, log, matches, terms: set):
+        # Próximo resultado válido da conversa; descarta o que mudou depois de indexado
+        for message_id in matches:
+            record = log.get(message_id)
+            if record is None or record.deleted or not terms <= tokenize(record.text):
+                continue
+            heapq.heappush(heap, (-record.created, order, -message_id, key, record, log, matches))
+            return
+
+    def stats(self) -> dict:
+        """Tamanho do índice: conversas, termos distintos, ocorrências e bytes ocupados"""
+        size = sys.getsizeof(self.chats)
+        terms = set()
+        postings = 0
+        for chat in list(self.chats.values()):
+            size += sys.getsizeof(chat) + sys.getsizeof(chat.postings)
+            for term, ids in list(chat.postings.items()):
+                postings += len(ids)
+                size += sys.getsizeof(ids)
+                if term not in terms:
+                    terms.add(term)
+                    size += sys.getsizeof(term)
+        return {
+            'chats': len(self.chats),
+            'terms': len(terms),
+            'postings': postings,
+            'bytes': size,
+            'building': self.building
+        }